@@ -1,32 +1,11 @@
 from gcode_generator_v1_2 import *  # Import all functions from gcode_generator_v1_1
-from io import StringIO
-import sys
+from tip_planner import NewTipOnSourceChange, plan_tips, run_tip_plan
 
 
-class GCodePrinter:
-    def __init__(self, filename):
-        self.terminal = sys.stdout
-        self.gcode_file = open(filename, 'w')
-        self.gcode_buffer = StringIO()
-
-    def write(self, message):
-        if message.strip().startswith('G'):
-            self.gcode_buffer.write(message)
-            self.gcode_file.write(message)
-        if message.strip().startswith('M'):
-            self.gcode_buffer.write(message)
-            self.gcode_file.write(message)
-        self.terminal.write(message)
-
-    def flush(self):
-        self.terminal.flush()
-        self.gcode_file.flush()
-
-
-def generate_and_save_gcode():
-    gcode_printer = GCodePrinter(f"{__file__[:-3]}.gcode")
-    sys.stdout = gcode_printer
+def generate_and_save_gcode(filename=f"{__file__[:-3]}.gcode"):
+    get_emitter().clear()
 
+    protocol_step('Setup')
     # 1. Start the system by homing!
     # start()
     G28()
@@ -46,6 +25,7 @@ def generate_and_save_gcode():
 
     # 3. Your main code here
     # Step 0: Create serial dilution of input DNA
+    protocol_step('Step 0: serial dilution')
     serial_dilution_NFW = ['100ng', '10ng', '1ng', '100pg', '10pg', '1pg']
 
     new_tip(E1_yellow_tips)
@@ -64,14 +44,11 @@ def generate_and_save_gcode():
         eject()
 
     # Step 1: Premix qPCR master mix and primers with water
+    protocol_step('Step 1: premix')
     # Adding qPCR master mix into mixing tube
     new_tip(E1_yellow_tips)
-    aspirate_volume(297 / 3, custom_name='PT2X', deadpump_vol=5)  # Part 1
-    dispense_volume(custom_name='Premix', blowout=False, direct=True)
-    aspirate_volume(297 / 3, custom_name='PT2X', deadpump_vol=5)  # Part 2
-    dispense_volume(custom_name='Premix', blowout=False, direct=True)
-    aspirate_volume(297 / 3, custom_name='PT2X', deadpump_vol=5)  # Part 3
-    dispense_volume(custom_name='Premix', blowout=True, touch_tip=True, direct=True)
+    # 297uL does not fit in one tip, the planner splits it into equal aspirations
+    run_transfers([('PT2X', 'Premix', 297)], deadpump_vol=5, direct=True, blowout='last', touch_tip='last')
     eject()
 
     # Adding primers into mixing tube
@@ -89,30 +66,16 @@ def generate_and_save_gcode():
     mix(20, custom_name='Premix', aspirate_feedrate=1500, dispense_feedrate=1500)
 
     # Step 2: Aliquot 15uL of the premixed master mix to plate
-    def aliquot_premix(well_locations_plate):
-        transferred_volume = 15
-        dispensed_volumes_plate = [transferred_volume] * len(well_locations_plate)
-
-        dispense_iteration = len(well_locations_plate)
-        total_mix_asp = transferred_volume*(dispense_iteration) + 10 # Part 1
-        aspirate_volume(total_mix_asp, custom_name='Premix', deadpump=False)
-        dispense_volume(dispensed_volumes_plate, dispense_modules=[plate_384_biorad]*dispense_iteration,
-                        well_locations=well_locations_plate, touch_tip=True, direct=True)
-
-    well_locations_plate = ['B2', 'B4', 'B6', 'B8', 'B10', 'B12']
-    aliquot_premix(well_locations_plate)
-
-    well_locations_plate = ['B14', 'B16', 'B18', 'B20', 'B22', 'C2']
-    aliquot_premix(well_locations_plate)
-
-    well_locations_plate = ['C4', 'C6', 'C8', 'C10', 'C12', 'C14']
-    aliquot_premix(well_locations_plate)
-
-    well_locations_plate = ['C16', 'C18', 'C20']
-    aliquot_premix(well_locations_plate)
+    protocol_step('Step 2: master mix aliquot')
+    # The planner packs as many wells per aspiration as the tip holds (10uL excess, no dead pump)
+    well_locations_plate = ['B2', 'B4', 'B6', 'B8', 'B10', 'B12', 'B14', 'B16', 'B18', 'B20', 'B22',
+                            'C2', 'C4', 'C6', 'C8', 'C10', 'C12', 'C14', 'C16', 'C18', 'C20']
+    run_transfers([('Premix', (plate_384_biorad, well), 15) for well in well_locations_plate],
+                  excess_vol=10, deadpump=False, touch_tip=True, direct=True)
     eject()
 
     # Aliquot 20uL of NFW to the plate as negative control
+    protocol_step('Step 2: negative control')
     new_tip(E1_yellow_tips)
     well_locations_plate = ['C22', 'D2', 'D4']
     transferred_volume = 20
@@ -127,51 +90,35 @@ def generate_and_save_gcode():
     eject()
 
     # Step 3: Aliquot 5uL of the DNA template to subsequent plate wells
+    protocol_step('Step 3: template aliquot')
     # 1 - 10pg
+    # Templates go to three wells each, holding premix already: one aspiration per template, so no tip goes back
+    # into a template
     transferred_volume = 5
-    def aliquot_template(template_name, well_locations_plate):
-        new_tip(E1_yellow_tips)
-        aspirate_volume(transferred_volume, custom_name=template_name, air_gap=True)
-        dispense_volume(transferred_volume, dispense_modules=[plate_384_biorad],
-                        well_locations=well_locations_plate, touch_tip=True, direct=True, blowout=True)
-        eject()
-
-    aliquot_template('100ng', 'B2')
-    aliquot_template('100ng', 'B4')
-    aliquot_template('100ng', 'B6')
-
-    aliquot_template('10ng', 'B8')
-    aliquot_template('10ng', 'B10')
-    aliquot_template('10ng', 'B12')
-
-    aliquot_template('1ng', 'B14')
-    aliquot_template('1ng', 'B16')
-    aliquot_template('1ng', 'B18')
-
-    aliquot_template('100pg', 'B20')
-    aliquot_template('100pg', 'B22')
-    aliquot_template('100pg', 'D2')
-
-    aliquot_template('10pg', 'B4')
-    aliquot_template('10pg', 'B6')
-    aliquot_template('10pg', 'B8')
-
-    aliquot_template('1pg', 'B10')
-    aliquot_template('1pg', 'B12')
-    aliquot_template('1pg', 'B14')
-
-    aliquot_template('NFW', 'B16')
-    aliquot_template('NFW', 'B18')
-    aliquot_template('NFW', 'B20')
-
+    template_wells = {
+        '100ng': ['B2', 'B4', 'B6'],
+        '10ng': ['B8', 'B10', 'B12'],
+        '1ng': ['B14', 'B16', 'B18'],
+        '100pg': ['B20', 'B22', 'D2'],
+        '10pg': ['B4', 'B6', 'B8'],
+        '1pg': ['B10', 'B12', 'B14'],
+        'NFW': ['B16', 'B18', 'B20'],
+    }
+    template_transfers = [(template_name, well_location, transferred_volume)
+                          for template_name, well_locations in template_wells.items()
+                          for well_location in well_locations]
+    template_tips = plan_tips(template_transfers, rules=[NewTipOnSourceChange()], destination_module=plate_384_biorad,
+                              air_gap=True)
+    run_tip_plan(template_tips, E1_yellow_tips, destination_module=plate_384_biorad, air_gap=True, touch_tip=True,
+                 direct=True, blowout=True)
+
+    protocol_step('End')
     end()
 
-    # Reset stdout
-    sys.stdout = sys.__stdout__
+    # Save the buffered G-code
+    get_emitter().to_file(filename)
 
-    print(f"G-code has been saved to {__file__[:-3]}.gcode")
-    # print("G-code commands:")
-    # print(gcode_printer.gcode_buffer.getvalue())
+    print(f"G-code has been saved to {filename}")
 
 
 if __name__ == "__main__":
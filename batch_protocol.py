@@ -0,0 +1,253 @@
+"""
+Batch expansion of single-sample protocols.
+
+A protocol script describes one sample with:
+    SAMPLE_LAYOUT               - role -> (labware, position, volume in μL); each role is a custom name its steps use
+                                  (e.g. 'Sample', 'waste1')
+    process_sample(names, volumes)
+                                - every step for one sample; names maps each role to the custom name preloaded for
+                                  the sample, volumes each role to its starting volume
+expand() runs the samples of a sample sheet in one program: every sample gets its own positions, each role taking the
+next free position of its labware (the magnet positions 13-24 of the 0.2mL racks for roles that sit there in the
+layout, as pipette_pellet() needs), then the deck is homed once and the samples are processed one after the other.
+Racks at the same place (tube3 and tube3_rimless) share their positions. Before anything is emitted, the batch is
+checked against the deck: free positions and tube capacities, and the tips left in the racks (counted on a dry run of
+one sample) when the context's TipManager does not swap racks. Otherwise a large batch runs on with rack swap prompts.
+
+A protocol that also defines sample_steps(names, volumes) (see step_scheduler.py) has the steps of all samples
+scheduled together instead, so one sample's incubations are filled with the other samples' work.
+
+The sample sheet is a CSV file with a 'sample' column (the sample id). Other columns are named after roles and give
+that sample's starting volume, e.g. a 'Sample' column for the sample volumes.
+
+Usage:
+    python batch_protocol.py pUC19_cleanup.py samples.csv -o batch.gcode
+    python batch_protocol.py magnetic_extraction_w_heater.py --samples 2
+"""
+import argparse
+import csv
+import os
+from contextlib import redirect_stdout
+
+from compile_protocols import load_protocol
+from gcode_generator_v1_2 import (G28, ProtocolContext, TipRack, current_context, deck, end, log, preload_volume,
+                                  protocol_step, tube3, tube3_rimless, well_index)
+from gcode_time_estimator import estimate_runtime
+from step_scheduler import schedule
+
+MAGNET_RACKS = (tube3, tube3_rimless)
+MAGNET_POSITIONS = tuple(str(n) for n in range(13, 25))  # Next to the magnet, see pipette_pellet()
+
+
+def read_sample_sheet(filename):
+    """
+    Read a sample sheet.
+
+    :param filename: CSV file with a 'sample' column and optional volume columns named after roles
+    :return: List of dictionaries {'sample': id, role: volume, ...}
+    """
+    with open(filename, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        if 'sample' not in (reader.fieldnames or []):
+            raise ValueError(f"-Sample sheet {filename} needs a 'sample' column.")
+        samples = []
+        for row in reader:
+            sample = {'sample': row.pop('sample').strip()}
+            for role, volume in row.items():
+                if volume and volume.strip():
+                    sample[role] = float(volume)
+            samples.append(sample)
+    return samples
+
+
+def _pool(module, position):
+    """Positions a role can be allocated to: the magnet positions, or the rest of the rack, like its own position."""
+    names = module.well_names()
+    if any(module is rack for rack in MAGNET_RACKS):
+        magnet = str(position) in MAGNET_POSITIONS
+        return [name for name in names if (name in MAGNET_POSITIONS) == magnet]
+    return names
+
+
+def _spot(module, position):
+    """Place of a position on the deck, so racks at the same place share their positions."""
+    index = well_index(module, position)
+    return round(float(module.Xf[index]), 1), round(float(module.Yf[index]), 1)
+
+
+def allocate(layout, count, reserved=()):
+    """
+    Choose the positions of every sample of a batch.
+
+    :param layout: SAMPLE_LAYOUT of the protocol
+    :param count: Number of samples
+    :param reserved: (labware, position) pairs already in use
+    :return: List (one per sample) of dictionaries role -> (labware, position)
+    :raises ValueError: If the labware does not have enough free positions for the whole batch
+    """
+    taken = {_spot(module, position) for module, position in reserved}
+    pools = {}  # Role -> candidate positions
+    demand = {}  # Spots of a pool -> [description, roles per sample]
+    for role, (module, position, _) in layout.items():
+        pools[role] = _pool(module, position)
+        spots = frozenset(_spot(module, name) for name in pools[role])
+        magnet = str(position) in MAGNET_POSITIONS and any(module is rack for rack in MAGNET_RACKS)
+        kind = 'magnet positions' if magnet else 'positions'
+        demand.setdefault(spots, [f'{kind} of {module.name}', 0])[1] += 1
+
+    shortages = []
+    for spots, (description, per_sample) in demand.items():
+        free = len(spots - taken)
+        if per_sample * count > free:
+            shortages.append(f'{per_sample * count} {description} ({per_sample} per sample), only {free} free: room '
+                             f'for {free // per_sample} samples')
+    if shortages:
+        raise ValueError(f'-{count} samples do not fit on the deck: ' + '; '.join(shortages))
+
+    allocation = []
+    for _ in range(count):
+        positions = {}
+        for role, (module, _, _) in layout.items():
+            position = next(name for name in pools[role] if _spot(module, name) not in taken)
+            taken.add(_spot(module, position))
+            positions[role] = (module, position)
+        allocation.append(positions)
+    return allocation
+
+
+def sample_volumes(layout, sample):
+    """Starting volume of every role for one sample: the sheet's value, or the layout's."""
+    volumes = {}
+    for role, (module, _, volume) in layout.items():
+        volumes[role] = sample.get(role, volume)
+        if module.capacity is not None and volumes[role] > module.capacity:
+            raise ValueError(f"-{volumes[role]} μL of {role} for sample {sample['sample']} exceeds the "
+                             f"{module.capacity} μL of {module.name}.")
+    return volumes
+
+
+def tips_per_sample(process_sample, layout):
+    """
+    Tips one sample takes from each rack, counted on a dry run in a scratch context.
+
+    :return: Dictionary tip rack name -> number of tips
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), ProtocolContext() as ctx:
+        for role, (module, position, volume) in layout.items():
+            preload_volume(module, position, volume, role)
+        process_sample({role: role for role in layout}, {role: volume for role, (_, _, volume) in layout.items()})
+    return dict(ctx.tips.taken)
+
+
+def check_tips(process_sample, layout, count):
+    """
+    Raise ValueError if the tip racks of the active context run out before the end of the batch; never when its
+    TipManager swaps racks.
+    """
+    ctx = current_context()
+    if ctx.tips.swap:
+        return
+    racks = {rack.name: rack for rack in deck.labware if isinstance(rack, TipRack)}
+    for name, tips in tips_per_sample(process_sample, layout).items():
+        left = ctx.tips.left(racks[name])
+        if tips * count > left:
+            raise ValueError(f'-{count} samples need {tips * count} tips from {name} ({tips} per sample), only '
+                             f'{left} are left: room for {left // tips} samples')
+
+
+def expand(process_sample, layout, samples, sample_steps=None):
+    """
+    Generate a batch in the active context: preload every sample, home once and process the samples.
+
+    :param process_sample: The protocol's single-sample function
+    :param layout: The protocol's SAMPLE_LAYOUT
+    :param samples: Sample ids, or dictionaries from read_sample_sheet()
+    :param sample_steps: The protocol's sample_steps() function; when given, the steps of all samples are scheduled
+                         together (default is None: the samples run one after the other)
+    :return: List (one per sample) of dictionaries with the sample id, the custom names and the positions
+    :raises ValueError: If the batch does not fit on the deck (nothing is emitted then)
+    """
+    samples = [sample if isinstance(sample, dict) else {'sample': str(sample)} for sample in samples]
+    ids = [sample['sample'] for sample in samples]
+    duplicates = sorted({sample_id for sample_id in ids if ids.count(sample_id) > 1})
+    if duplicates:
+        raise ValueError(f"-Duplicate sample ids: {', '.join(duplicates)}")
+
+    ctx = current_context()
+    reserved = [(preload['module'], preload['well_location']) for preload in ctx.preloads.values()]
+    allocation = allocate(layout, len(samples), reserved)
+    volumes = [sample_volumes(layout, sample) for sample in samples]
+    check_tips(process_sample, layout, len(samples))
+
+    batch = []
+    for sample, positions, sample_volume in zip(samples, allocation, volumes):
+        names = {role: f"{sample['sample']} {role}" for role in layout}
+        for role, (module, position) in positions.items():
+            preload_volume(module, position, sample_volume[role], names[role])
+        batch.append({'sample': sample['sample'], 'names': names, 'positions': positions})
+
+    G28()
+    if sample_steps is None:
+        for entry, sample_volume in zip(batch, volumes):
+            protocol_step(f"Sample {entry['sample']}")
+            log(f"-Sample {entry['sample']}")
+            process_sample(entry['names'], sample_volume)
+    else:
+        steps = []
+        for entry, sample_volume in zip(batch, volumes):
+            for step in sample_steps(entry['names'], sample_volume):
+                step.name = f"{entry['sample']} {step.name}"
+                steps.append(step)
+        schedule(steps)
+    end()
+    return batch
+
+
+def generate_batch(path, samples, filename=None):
+    """
+    Generate a batch of a protocol script in a fresh context.
+
+    :param path: Protocol script defining SAMPLE_LAYOUT and process_sample()
+    :param samples: Sample ids, or dictionaries from read_sample_sheet()
+    :param filename: Where to write the G-code (default: do not write)
+    :return: Tuple (context, batch from expand())
+    """
+    module = load_protocol(path)
+    if not hasattr(module, 'SAMPLE_LAYOUT') or not hasattr(module, 'process_sample'):
+        raise ValueError(f'-{os.path.basename(path)} does not define SAMPLE_LAYOUT and process_sample().')
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), ProtocolContext() as ctx:
+        batch = expand(module.process_sample, module.SAMPLE_LAYOUT, samples, getattr(module, 'sample_steps', None))
+    if filename:
+        ctx.emitter.to_file(filename)
+    return ctx, batch
+
+
+def format_batch(batch):
+    roles = list(batch[0]['positions'])
+    rows = ['Sample  ' + '  '.join(roles)]
+    for entry in batch:
+        rows.append(f"{entry['sample']:<6}  " + '  '.join(f'{entry["positions"][role][1]:>{len(role)}}'
+                                                         for role in roles))
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run several samples of a single-sample protocol in one program.')
+    parser.add_argument('script', help='Protocol script defining SAMPLE_LAYOUT and process_sample()')
+    parser.add_argument('sheet', nargs='?', help="Sample sheet (CSV with a 'sample' column)")
+    parser.add_argument('--samples', type=int, help='Number of samples S1, S2, ... (instead of a sample sheet)')
+    parser.add_argument('-o', '--output', help='Where to write the G-code (default: <script>_batch.gcode)')
+    args = parser.parse_args()
+
+    if (args.sheet is None) == (args.samples is None):
+        parser.error('Give either a sample sheet or --samples')
+    samples = read_sample_sheet(args.sheet) if args.sheet else [f'S{n + 1}' for n in range(args.samples)]
+    output = args.output or os.path.splitext(args.script)[0] + '_batch.gcode'
+    try:
+        ctx, batch = generate_batch(args.script, samples, output)
+    except ValueError as error:
+        parser.exit(1, f'{error}\n')
+    print(format_batch(batch))
+    estimate = estimate_runtime(ctx.emitter.lines)
+    print(f"{len(batch)} samples, {len(ctx.emitter.lines)} lines, {estimate['total'] / 60:.1f} min estimated; "
+          f"written to {output}")
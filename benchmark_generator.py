@@ -0,0 +1,267 @@
+"""
+Generation-throughput benchmarks for gcode_generator_v1_2.
+
+Every workload runs in a fresh ProtocolContext, so the module-level labware is never touched:
+    aspirate_volume, dispense_volume, mix, pipette_pellet, move_to_well_location
+                    - one action called many times (time per action)
+    plate_96        - aspirate, dispense and mix into every well of a 96-well plate
+    plate_384       - aspirate and dispense into every well of a 384-well plate
+    worklist_10k    - 10,000 synthetic transfers from the tube racks to random plate wells
+    protocols       - regeneration of every shipped protocol script
+
+For each workload the suite reports the best wall-clock time over the repeats, lines and bytes of G-code per second,
+the time per action call and the peak memory allocated during one run (measured with tracemalloc in a separate run,
+so it does not slow down the timed runs). Results can be saved to JSON and compared with an earlier run.
+
+Usage:
+    python benchmark_generator.py -o bench.json
+    python benchmark_generator.py plate_384 worklist_10k --repeat 5 --compare bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from compile_protocols import ENTRY_POINT, HERE, find_protocols, load_protocol
+from gcode_generator_v1_2 import (GENERATOR_VERSION, ProtocolContext, aspirate_volume, current_context, dispense_volume,
+                                  mix, move_to_well_location, pipette_pellet, plate_96_biorad, plate_384_biorad,
+                                  preload_volume, tube1, tube2, tube3)
+
+
+def _reservoirs():
+    """Name the large tubes as sources with plenty of liquid; returns the custom names."""
+    names = []
+    for rack in (tube1, tube2):
+        for well in rack.well_names()[:6]:
+            name = f'{rack.name} {well}'
+            preload_volume(rack, well, 1e6, name)
+            names.append(name)
+    return names
+
+
+def bench_aspirate_volume(count=1000):
+    sources = _reservoirs()
+    for n in range(count):
+        aspirate_volume(20, sources[n % len(sources)])
+    return count
+
+
+def bench_dispense_volume(count=1000, batch=50):
+    ctx = current_context()
+    wells = plate_384_biorad.well_names()
+    for n in range(count):
+        if n % batch == 0:
+            ctx.aspirated_volume = batch  # A full tip without timing the aspiration
+        dispense_volume(1, dispense_modules=plate_384_biorad, well_locations=wells[n % len(wells)])
+    return count
+
+
+def bench_mix(count=200):
+    names = []
+    for well in plate_96_biorad.well_names():
+        names.append(f'{plate_96_biorad.name} {well}')
+        preload_volume(plate_96_biorad, well, 50, names[-1])
+    for n in range(count):
+        mix(3, 20, names[n % len(names)])
+    return count
+
+
+def bench_pipette_pellet(count=200):
+    for n in range(count):
+        pipette_pellet(pellet_duration=1, module=tube3, location=str(13 + n % 12))
+    return count
+
+
+def bench_move_to_well_location(count=5000):
+    wells = plate_384_biorad.well_names()
+    for n in range(count):
+        move_to_well_location(plate_384_biorad, wells[n % len(wells)], direct=n % 2 == 0)
+    return count
+
+
+def bench_plate(plate, volume, mix_cycles=0):
+    source = _reservoirs()[0]
+    actions = 0
+    for well in plate.well_names():
+        name = f'{plate.name} {well}'
+        preload_volume(plate, well, 0, name)
+        aspirate_volume(volume, source)
+        dispense_volume(volume, name)
+        actions += 2
+        if mix_cycles:
+            mix(mix_cycles, volume, name)
+            actions += 1
+    return actions
+
+
+def bench_worklist(count=10000, seed=0):
+    rng = np.random.default_rng(seed)
+    sources = _reservoirs()
+    plates = [(plate, plate.well_names()) for plate in (plate_96_biorad, plate_384_biorad)]
+    for n in range(count):
+        plate, wells = plates[rng.integers(len(plates))]
+        well = wells[rng.integers(len(wells))]
+        volume = round(float(rng.uniform(1, 10)), 1)
+        aspirate_volume(volume, sources[rng.integers(len(sources))])
+        dispense_volume(volume, dispense_modules=plate, well_locations=well)
+    return 2 * count
+
+
+def bench_protocols(directory=HERE):
+    """Regenerate every protocol script, each in its own context; returns the number of scripts and their lines."""
+    lines = []
+    scripts = find_protocols(directory)
+    modules = [load_protocol(path) for path in scripts]
+    for module in modules:
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), ProtocolContext() as ctx:
+            getattr(module, ENTRY_POINT)(os.devnull)
+        lines.extend(ctx.emitter.lines)
+    return len(scripts), lines
+
+
+WORKLOADS = {
+    'aspirate_volume': bench_aspirate_volume,
+    'dispense_volume': bench_dispense_volume,
+    'mix': bench_mix,
+    'pipette_pellet': bench_pipette_pellet,
+    'move_to_well_location': bench_move_to_well_location,
+    'plate_96': lambda: bench_plate(plate_96_biorad, 50, mix_cycles=2),
+    'plate_384': lambda: bench_plate(plate_384_biorad, 10),
+    'worklist_10k': bench_worklist,
+    'protocols': bench_protocols,
+}
+
+
+def run_once(workload):
+    """
+    Run a workload once in a fresh context.
+
+    :param workload: Workload function
+    :return: Tuple (seconds, actions, lines)
+    """
+    with ProtocolContext() as ctx:
+        start = time.perf_counter()
+        result = workload()
+        seconds = time.perf_counter() - start
+    if isinstance(result, tuple):
+        return seconds, result[0], result[1]
+    return seconds, result, ctx.emitter.lines
+
+
+def run_workload(name, repeat=3, memory=True):
+    """
+    Benchmark one workload.
+
+    :param name: Name of the workload in WORKLOADS
+    :param repeat: Number of timed runs; the best one is reported (default is 3)
+    :param memory: Also measure the peak memory in an extra run (default is True)
+    :return: Result dictionary
+    """
+    workload = WORKLOADS[name]
+    timings = []
+    for _ in range(repeat):
+        seconds, actions, lines = run_once(workload)
+        timings.append(seconds)
+    best = min(timings)
+    size = sum(len(line) + 1 for line in lines)
+    result = {
+        'seconds': best,
+        'seconds_all': timings,
+        'actions': actions,
+        'lines': len(lines),
+        'bytes': size,
+        'lines_per_second': len(lines) / best if best else None,
+        'bytes_per_second': size / best if best else None,
+        'seconds_per_action': best / actions if actions else None,
+    }
+    del lines
+    if memory:
+        tracemalloc.start()
+        try:
+            run_once(workload)
+            result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def git_commit(directory=HERE):
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=directory, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names=None, repeat=3, memory=True):
+    """
+    Run the benchmark suite.
+
+    :param names: Workloads to run (default is all of WORKLOADS)
+    :param repeat: Number of timed runs per workload (default is 3)
+    :param memory: Measure the peak memory of each workload (default is True)
+    :return: Dictionary with the environment and a result per workload
+    """
+    return {
+        'generator_version': GENERATOR_VERSION,
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'repeat': repeat,
+        'workloads': {name: run_workload(name, repeat, memory) for name in names or WORKLOADS},
+    }
+
+
+def format_results(results, baseline=None):
+    """
+    Format benchmark results as a table.
+
+    :param results: Dictionary from run_benchmarks()
+    :param baseline: Earlier results to compare with; adds the speed-up of each workload
+    """
+    width = max(len(name) for name in results['workloads'])
+    rows = [f"{'Workload':<{width}}  {'Seconds':>8}  {'Lines':>8}  {'Lines/s':>10}  {'us/action':>10}  {'Peak MiB':>8}"
+            + ('  Speed-up' if baseline else '')]
+    for name, result in results['workloads'].items():
+        peak = result.get('peak_memory_bytes')
+        row = (f"{name:<{width}}  {result['seconds']:>8.3f}  {result['lines']:>8}  {result['lines_per_second']:>10.0f}  "
+               f"{1e6 * result['seconds_per_action']:>10.1f}  {'' if peak is None else f'{peak / 2 ** 20:.1f}':>8}")
+        before = (baseline or {}).get('workloads', {}).get(name)
+        if before:
+            row += f"  {before['seconds'] / result['seconds']:>7.2f}x"
+        rows.append(row)
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark G-code generation throughput.')
+    parser.add_argument('workloads', nargs='*', metavar='workload',
+                        help=f"Workloads to run (default: all of {', '.join(WORKLOADS)})")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed runs per workload (default: 3)')
+    parser.add_argument('-o', '--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    parser.add_argument('--no-memory', action='store_true', help='Skip the peak memory runs')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.workloads if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"Unknown workload(s): {', '.join(unknown)}")
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    results = run_benchmarks(args.workloads, repeat=args.repeat, memory=not args.no_memory)
+    print(format_results(results, baseline))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,242 @@
+"""
+Parallel, cached compiler for protocol scripts.
+
+Every protocol script defines generate_and_save_gcode(filename). The compiler runs many scripts at once in a process
+pool; each script runs in a fresh worker process, so the module-level state of the generator (preloads, tip counter,
+well volumes) never leaks from one protocol into another.
+
+Outputs are cached by the hash of the script source, the sources of the local modules it imports (the generator,
+planners, ...), GENERATOR_VERSION and the labware definitions on the deck. A script whose key is already in the cache
+is not run again; its cached G-code is copied to the output directory.
+
+Usage:
+    python compile_protocols.py                          # every protocol script in this directory
+    python compile_protocols.py variants/*.py -o out -j 8
+    python compile_protocols.py --force                  # ignore the cache
+"""
+import argparse
+import hashlib
+import importlib.util
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_OUTPUT_DIR = os.path.join(HERE, 'Gcodes_protocol_library')
+DEFAULT_CACHE_DIR = os.path.join(HERE, '.gcode_cache')
+ENTRY_POINT = 'generate_and_save_gcode'
+
+IMPORT_PATTERN = re.compile(r'^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w.]+))', re.MULTILINE)
+
+
+def find_protocols(directory=HERE):
+    """List the protocol scripts (files defining generate_and_save_gcode) in a directory."""
+    scripts = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith('.py') and os.path.isfile(path):
+            with open(path, encoding='utf-8') as f:
+                if f'def {ENTRY_POINT}(' in f.read():
+                    scripts.append(path)
+    return scripts
+
+
+def local_dependencies(path, search_path=(HERE,)):
+    """
+    Local modules imported by a script, followed recursively.
+
+    :param path: Path of the script
+    :param search_path: Directories searched for the imported modules (besides the directory of the script)
+    :return: Sorted list of module file paths
+    """
+    found = set()
+    pending = [path]
+    while pending:
+        with open(pending.pop(), encoding='utf-8') as f:
+            source = f.read()
+        for match in IMPORT_PATTERN.finditer(source):
+            module = (match.group(1) or match.group(2)).split('.')[0]
+            for directory in (os.path.dirname(os.path.abspath(path)), *search_path):
+                candidate = os.path.join(directory, module + '.py')
+                if os.path.isfile(candidate):
+                    if candidate not in found:
+                        found.add(candidate)
+                        pending.append(candidate)
+                    break
+    return sorted(found)
+
+
+def labware_fingerprint(deck=None):
+    """
+    Hash of the labware definitions on the deck: geometry, initial volumes and the fixed stations.
+
+    :param deck: The deck (default is the generator deck)
+    :return: Hex digest
+    """
+    if deck is None:
+        from gcode_generator_v1_2 import deck
+    digest = hashlib.sha256()
+    for labware in deck.labware:
+        digest.update(type(labware).__name__.encode())
+        for name in labware._slot_names():
+            value = getattr(labware, name, None)
+            if name.startswith('_') or callable(value):
+                continue  # caches, and height models (their code is covered by the generator source)
+            digest.update(name.encode())
+            if isinstance(value, np.ndarray):
+                digest.update(str(value.dtype).encode() + np.ascontiguousarray(value).tobytes())
+            else:
+                digest.update(repr(value).encode())
+    for station in deck.stations:
+        digest.update(repr(sorted(station.items())).encode())
+    return digest.hexdigest()
+
+
+def cache_key(path, version, fingerprint):
+    """
+    Cache key of a script: its source, the sources of its local dependencies, the generator version and the labware
+    fingerprint.
+    """
+    digest = hashlib.sha256()
+    digest.update(version.encode() + b'\0' + fingerprint.encode())
+    for source_path in [path] + local_dependencies(path):
+        with open(source_path, 'rb') as f:
+            digest.update(b'\0' + os.path.basename(source_path).encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def load_protocol(path):
+    """
+    Import a protocol script as a fresh module (its output during import is discarded).
+
+    :param path: Path of the protocol script
+    :return: The module
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    name = os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        spec.loader.exec_module(module)
+    return module
+
+
+def compile_script(path, output):
+    """
+    Run the generate_and_save_gcode() of one script (in the calling process) and write the G-code to output.
+
+    :param path: Path of the protocol script
+    :param output: Path of the .gcode file to write
+    :return: Tuple (path, seconds)
+    """
+    start = time.perf_counter()
+    module = load_protocol(path)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        getattr(module, ENTRY_POINT)(output)
+    return path, time.perf_counter() - start
+
+
+def _compile_to_cache(path, cached):
+    # Write next to the cache entry first so a crashed worker never leaves a partial entry behind
+    partial = f'{cached}.{os.getpid()}.tmp'
+    try:
+        result = compile_script(path, partial)
+        os.replace(partial, cached)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return result
+
+
+def compile_protocols(scripts, output_dir=DEFAULT_OUTPUT_DIR, cache_dir=DEFAULT_CACHE_DIR, jobs=None, force=False,
+                      progress=None):
+    """
+    Compile protocol scripts in parallel, reusing cached outputs.
+
+    :param scripts: List of script paths
+    :param output_dir: Directory the .gcode files are written to (default is Gcodes_protocol_library)
+    :param cache_dir: Directory of the cache (default is .gcode_cache)
+    :param jobs: Number of worker processes (default is the number of CPUs)
+    :param force: Recompile every script even if it is cached (default is False)
+    :param progress: Optional callable receiving (status, path, seconds) as every script finishes
+    :return: Dictionary with the 'compiled', 'cached' and 'failed' scripts (failed maps path to the error)
+    """
+    from gcode_generator_v1_2 import GENERATOR_VERSION
+
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = labware_fingerprint()
+    result = {'compiled': [], 'cached': [], 'failed': {}}
+
+    def publish(path, cached):
+        name = os.path.splitext(os.path.basename(path))[0] + '.gcode'
+        shutil.copyfile(cached, os.path.join(output_dir, name))
+
+    pending = {}
+    for path in scripts:
+        cached = os.path.join(cache_dir, cache_key(path, GENERATOR_VERSION, fingerprint) + '.gcode')
+        if not force and os.path.exists(cached):
+            publish(path, cached)
+            result['cached'].append(path)
+            if progress:
+                progress('cached', path, 0.0)
+        else:
+            pending[path] = cached
+
+    if pending:
+        # One task per worker process, forked from a clean server process that has already imported the generator:
+        # every script starts from pristine generator state, even if the caller has generated protocols itself
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['gcode_generator_v1_2'])
+        else:
+            context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context, max_tasks_per_child=1) as pool:
+            futures = {pool.submit(_compile_to_cache, path, cached): path for path, cached in pending.items()}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    _, seconds = future.result()
+                except Exception as error:
+                    result['failed'][path] = error
+                    if progress:
+                        progress('failed', path, 0.0)
+                    continue
+                publish(path, pending[path])
+                result['compiled'].append(path)
+                if progress:
+                    progress('compiled', path, seconds)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile protocol scripts to G-code in parallel, with caching.')
+    parser.add_argument('scripts', nargs='*', help='Protocol scripts (default: every protocol script in this directory)')
+    parser.add_argument('-o', '--output-dir', default=DEFAULT_OUTPUT_DIR, help='Where to write the .gcode files')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help='Cache directory')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='Ignore the cache and recompile everything')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+
+    def report(status, path, seconds):
+        print(f'{status:>8} {os.path.basename(path)}' + (f' ({seconds:.2f} s)' if seconds else ''))
+
+    summary = compile_protocols(args.scripts or find_protocols(), output_dir=args.output_dir,
+                                cache_dir=args.cache_dir, jobs=args.jobs, force=args.force, progress=report)
+    for path, error in summary['failed'].items():
+        print(f'{os.path.basename(path)}: {type(error).__name__}: {error}', file=sys.stderr)
+    print(f"{len(summary['compiled'])} compiled, {len(summary['cached'])} cached, {len(summary['failed'])} failed "
+          f"in {time.perf_counter() - start:.2f} s")
+    if summary['failed']:
+        sys.exit(1)
@@ -0,0 +1,54 @@
+import importlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+from compile_protocols import ENTRY_POINT, HERE
+from gcode_generator_v1_2 import ProtocolContext
+
+PROTOCOLS = ['YWHAZ_qPCR_protocol', 'pUC19_amplification', 'pUC19_cleanup', 'magnetic_extraction_w_heater']
+
+
+@pytest.fixture(params=PROTOCOLS)
+def protocol_name(request):
+    """Each of the example protocols in turn."""
+    return request.param
+
+
+@pytest.fixture
+def ctx():
+    """A fresh ProtocolContext, active for the whole test."""
+    with ProtocolContext() as ctx:
+        yield ctx
+
+
+@pytest.fixture(scope='session')
+def generate():
+    """
+    Generate a protocol in a fresh ProtocolContext.
+
+    :return: function taking a protocol name or loaded module and ProtocolContext options, returning the context
+    """
+    def generate(protocol, **options):
+        module = importlib.import_module(protocol) if isinstance(protocol, str) else protocol
+        with ProtocolContext(**options) as ctx:
+            getattr(module, ENTRY_POINT)(os.devnull)
+        return ctx
+    return generate
+
+
+@pytest.fixture
+def run_script(tmp_path):
+    """
+    Run a protocol script on its own, in the default context of a fresh interpreter.
+
+    :return: function taking a protocol name, returning the G-code lines the script saves
+    """
+    def run_script(name):
+        path = tmp_path / f'{name}.gcode'
+        subprocess.run([sys.executable, '-c', f'import {name}; {name}.{ENTRY_POINT}({str(path)!r})'], cwd=HERE,
+                       check=True, stdout=subprocess.DEVNULL)
+        return path.read_text(encoding='utf-8').splitlines()
+    return run_script
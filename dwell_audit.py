@@ -0,0 +1,82 @@
+"""
+Dwell audit for protocol scripts.
+
+Generates every protocol twice, once with the former fixed pauses (dwell_model='fixed') and once with the settle
+model (no pauses after air-only plunger moves, settle time scaled to the volume and rate just moved), merges
+back-to-back dwells with the peephole optimizer and reports the estimated dwell seconds before and after.
+
+Usage:
+    python dwell_audit.py                        # every protocol script in this directory
+    python dwell_audit.py pUC19_cleanup.py --lines
+"""
+import argparse
+import os
+from contextlib import redirect_stdout
+
+from compile_protocols import ENTRY_POINT, find_protocols, load_protocol
+from gcode_generator_v1_2 import ProtocolContext
+from gcode_optimizer import optimize
+from gcode_time_estimator import estimate_runtime
+
+
+def generate(module, dwell_model):
+    """
+    Generate a loaded protocol script in a fresh context.
+
+    :param module: The protocol module
+    :param dwell_model: 'fixed' or 'settle', see ProtocolContext
+    :return: List of G-code lines
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), ProtocolContext(dwell_model=dwell_model) as ctx:
+        getattr(module, ENTRY_POINT)(os.devnull)
+    return list(ctx.emitter.lines)
+
+
+def count_dwells(lines):
+    return sum(1 for line in lines if line.split(';', 1)[0].split()[:1] == ['G4'])
+
+
+def audit_protocol(path):
+    """
+    Compare the dwells of one protocol under the fixed pauses and the settle model.
+
+    :param path: Path of the protocol script
+    :return: Dictionary with the dwell seconds, dwell counts and total estimated seconds before and after
+    """
+    module = load_protocol(path)
+    before = generate(module, 'fixed')
+    after = optimize(generate(module, 'settle'))
+    before_estimate = estimate_runtime(before)
+    after_estimate = estimate_runtime(after)
+    return {
+        'protocol': os.path.basename(path),
+        'dwell_before': before_estimate['breakdown']['dwell'],
+        'dwell_after': after_estimate['breakdown']['dwell'],
+        'dwells_before': count_dwells(before),
+        'dwells_after': count_dwells(after),
+        'total_before': before_estimate['total'],
+        'total_after': after_estimate['total'],
+    }
+
+
+def format_audit(results, lines=False):
+    width = max([len('Protocol')] + [len(result['protocol']) for result in results])
+    rows = [f"{'Protocol':<{width}}  {'Dwell before':>12}  {'Dwell after':>11}  {'Saved':>7}  {'Total before':>12}  "
+            f"{'Total after':>11}"]
+    for result in results:
+        rows.append(f"{result['protocol']:<{width}}  {result['dwell_before']:>10.1f} s  {result['dwell_after']:>9.1f} s  "
+                    f"{result['dwell_before'] - result['dwell_after']:>5.1f} s  {result['total_before']:>10.1f} s  "
+                    f"{result['total_after']:>9.1f} s")
+        if lines:
+            rows.append(f"{'':<{width}}  {result['dwells_before']:>10} G4  {result['dwells_after']:>9} G4")
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Report the dwell seconds of protocols before and after the settle '
+                                                 'model.')
+    parser.add_argument('scripts', nargs='*', help='Protocol scripts (default: every protocol in this directory)')
+    parser.add_argument('--lines', action='store_true', help='Also report the number of G4 lines')
+    args = parser.parse_args()
+
+    print(format_audit([audit_protocol(path) for path in args.scripts or find_protocols()], lines=args.lines))
@@ -0,0 +1,299 @@
+"""
+Compact binary G-code ("PALH compact G-code").
+
+Each command is tokenized instead of spelled out:
+    command byte    - 5 bits command number (see COMMANDS) and 3 bits word count
+    word byte       - 4 bits letter number (see LETTERS), 1 bit "no value" (e.g. G28 X) and 3 bits decimals
+    value           - fixed-point: the digits without the decimal point (130.4 -> 1304 with 1 decimal), as a
+                      zigzag varint (1 byte up to 63, 2 bytes up to 8191, ...)
+Lines that do not fit the scheme (comments, M0 prompts, unknown commands, more than 7 words, unusual number
+formats) are stored as raw text. Decoding gives back the original lines exactly, so a decoded file is
+byte-identical to the ASCII one.
+
+A file starts with the MAGIC header and a format version byte. Over a serial link the same encoding is sent one
+command per packet (see pack()/unpack_payload()), when the firmware advertises the COMPACT_GCODE capability.
+
+Usage:
+    python gcode_binary.py encode in.gcode -o out.pgcb
+    python gcode_binary.py decode out.pgcb -o in.gcode
+    python gcode_binary.py compare Gcodes_protocol_library/*.gcode
+"""
+import argparse
+import gzip
+import os
+import re
+import time
+
+MAGIC = b'PGCB'
+VERSION = 1
+EXTENSION = '.pgcb'
+
+COMMANDS = ('G0', 'G1', 'G2', 'G3', 'G4', 'G28', 'G90', 'G91', 'G92', 'M0', 'M1', 'M17', 'M18', 'M82', 'M83', 'M84',
+            'M92', 'M104', 'M105', 'M106', 'M107', 'M109', 'M110', 'M114', 'M115', 'M140', 'M190', 'M201', 'M203',
+            'M204', 'M400')
+LETTERS = 'XYZVFIJPSTRENHDB'
+RAW = 31  # Command number of a raw text line
+MAX_WORDS = 7
+MAX_DECIMALS = 6
+NO_VALUE = 0x08
+
+PACKET_START = 0xFF  # First byte of a compact packet on the serial link; never starts an ASCII line
+
+_COMMAND_NUMBERS = {command: n for n, command in enumerate(COMMANDS)}
+_LETTER_NUMBERS = {letter: n for n, letter in enumerate(LETTERS)}
+_NUMBER = re.compile(r'(-?)(\d+)(?:\.(\d{1,%d}))?' % MAX_DECIMALS)
+
+
+def _varint(value, out):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode_raw(line, out):
+    text = line.encode('utf-8')
+    out.append(RAW << 3)
+    _varint(len(text), out)
+    out += text
+
+
+def encode_command(line, out=None):
+    """
+    Encode one line.
+
+    :param line: G-code line without the newline
+    :param out: bytearray to append to (default is a new one)
+    :return: The bytearray
+    """
+    out = bytearray() if out is None else out
+    tokens = line.split(' ')
+    number = _COMMAND_NUMBERS.get(tokens[0])
+    if number is None or len(tokens) - 1 > MAX_WORDS:
+        _encode_raw(line, out)
+        return out
+    start = len(out)
+    out.append(number << 3 | len(tokens) - 1)
+    for token in tokens[1:]:
+        letter = _LETTER_NUMBERS.get(token[:1])
+        if letter is None:
+            del out[start:]
+            _encode_raw(line, out)
+            return out
+        if len(token) == 1:
+            out.append(letter << 4 | NO_VALUE)
+            continue
+        match = _NUMBER.fullmatch(token, 1)
+        if match is None or (match.group(1) and not int(match.group(2) + (match.group(3) or ''))):
+            del out[start:]  # Not a plain decimal, or a negative zero: keep the line as text
+            _encode_raw(line, out)
+            return out
+        sign, whole, fraction = match.groups()
+        if len(whole) > 1 and whole[0] == '0':
+            del out[start:]  # Leading zeros would be lost
+            _encode_raw(line, out)
+            return out
+        fraction = fraction or ''
+        mantissa = int(whole + fraction)
+        out.append(letter << 4 | len(fraction))
+        _varint(mantissa << 1 if not sign else (mantissa << 1) - 1, out)  # zigzag
+    return out
+
+
+def decode_command(data, offset=0):
+    """
+    Decode one command.
+
+    :param data: Encoded bytes
+    :param offset: Position of the command byte
+    :return: Tuple (line, offset of the next command)
+    """
+    head = data[offset]
+    offset += 1
+    number, count = head >> 3, head & 0x07
+    if number == RAW:
+        length, offset = _read_varint(data, offset)
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    words = [COMMANDS[number]]
+    for _ in range(count):
+        word = data[offset]
+        offset += 1
+        letter = LETTERS[word >> 4]
+        if word & NO_VALUE:
+            words.append(letter)
+            continue
+        zigzag, offset = _read_varint(data, offset)
+        mantissa = -((zigzag + 1) >> 1) if zigzag & 1 else zigzag >> 1
+        decimals = word & 0x07
+        if decimals:
+            digits = str(abs(mantissa)).rjust(decimals + 1, '0')
+            text = f"{'-' if mantissa < 0 else ''}{digits[:-decimals]}.{digits[-decimals:]}"
+        else:
+            text = str(mantissa)
+        words.append(letter + text)
+    return ' '.join(words), offset
+
+
+def encode(lines):
+    """
+    Encode a G-code stream.
+
+    :param lines: Iterable of lines (trailing newlines are ignored)
+    :return: bytes, starting with MAGIC and VERSION
+    """
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    for line in lines:
+        encode_command(line.rstrip('\r\n'), out)
+    return bytes(out)
+
+
+def decode(data):
+    """
+    Decode a stream written by encode().
+
+    :param data: bytes
+    :return: List of lines (without newlines)
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('-Not a compact G-code file (bad header).')
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError(f'-Unsupported compact G-code version {data[len(MAGIC)]}.')
+    lines = []
+    offset = len(MAGIC) + 1
+    while offset < len(data):
+        line, offset = decode_command(data, offset)
+        lines.append(line)
+    return lines
+
+
+def is_compact(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def read_lines(filename):
+    """Lines of a G-code file in either format."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if is_compact(data):
+        return decode(data)
+    return data.decode('utf-8').splitlines()
+
+
+# Serial packets: PACKET_START, payload length, payload (line number varint + one encoded command), XOR checksum
+def pack(number, command):
+    """
+    Frame one command for the serial link.
+
+    :param number: Line number
+    :param command: G-code command (without comment)
+    :return: bytes of the packet
+    """
+    payload = bytearray()
+    _varint(number, payload)
+    encode_command(command, payload)
+    if len(payload) > 0xFF:
+        raise ValueError(f'-Command too long for a compact packet: {command}')
+    check = 0
+    for byte in payload:
+        check ^= byte
+    return bytes((PACKET_START, len(payload))) + bytes(payload) + bytes((check,))
+
+
+def unpack_payload(payload, check):
+    """
+    Check and decode the payload of a packet.
+
+    :param payload: Payload bytes
+    :param check: Received checksum byte
+    :return: Tuple (line number, command), or None if the checksum does not match
+    """
+    value = 0
+    for byte in payload:
+        value ^= byte
+    if value != check:
+        return None
+    number, offset = _read_varint(payload, 0)
+    command, _ = decode_command(payload, offset)
+    return number, command
+
+
+def compare_file(filename, repeat=5):
+    """
+    Size and speed of the compact format for one ASCII G-code file.
+
+    :param filename: Path of the .gcode file
+    :param repeat: Number of timed runs (the best is kept)
+    :return: Dictionary with the sizes (ASCII, compact, gzip of the ASCII), encode/decode seconds and whether the
+             round trip is exact
+    """
+    with open(filename, 'rb') as f:
+        ascii_data = f.read()
+    lines = ascii_data.decode('utf-8').splitlines()
+    encode_seconds = decode_seconds = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        data = encode(lines)
+        encode_seconds = min(encode_seconds, time.perf_counter() - start)
+        start = time.perf_counter()
+        decoded = decode(data)
+        decode_seconds = min(decode_seconds, time.perf_counter() - start)
+    return {
+        'file': os.path.basename(filename),
+        'lines': len(lines),
+        'ascii_bytes': len(ascii_data),
+        'compact_bytes': len(data),
+        'gzip_bytes': len(gzip.compress(ascii_data)),
+        'raw_lines': sum(1 for line in lines if encode_command(line)[0] >> 3 == RAW),
+        'encode_seconds': encode_seconds,
+        'decode_seconds': decode_seconds,
+        'round_trip': '\n'.join(decoded) + '\n' == ascii_data.decode('utf-8'),
+    }
+
+
+def format_comparison(results, baud=115200):
+    # 10 bits per byte on the wire (8N1)
+    rows = [f"{'File':<36}  {'ASCII':>8}  {'Compact':>8}  {'Ratio':>6}  {'gzip':>8}  {'Serial s':>13}  "
+            f"{'Encode ms':>9}  {'Decode ms':>9}  Round trip"]
+    for result in results:
+        rows.append(f"{result['file']:<36}  {result['ascii_bytes']:>8}  {result['compact_bytes']:>8}  "
+                    f"{result['compact_bytes'] / result['ascii_bytes']:>6.2f}  {result['gzip_bytes']:>8}  "
+                    f"{10 * result['ascii_bytes'] / baud:>5.1f} -> {10 * result['compact_bytes'] / baud:>4.1f}  "
+                    f"{1e3 * result['encode_seconds']:>9.1f}  {1e3 * result['decode_seconds']:>9.1f}  "
+                    f"{'exact' if result['round_trip'] else 'MISMATCH'}")
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert G-code to and from the compact binary format.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('encode', 'ASCII G-code to compact'), ('decode', 'compact to ASCII G-code')):
+        sub = commands.add_parser(name, help=help_text)
+        sub.add_argument('input')
+        sub.add_argument('-o', '--output', help='Output file (default: the input with the other extension)')
+    sub = commands.add_parser('compare', help='Size and speed comparison on ASCII G-code files')
+    sub.add_argument('inputs', nargs='+')
+    sub.add_argument('--baud', type=int, default=115200, help='Baud rate for the serial transfer estimate')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        print(format_comparison([compare_file(filename) for filename in args.inputs], baud=args.baud))
+    elif args.command == 'encode':
+        output = args.output or os.path.splitext(args.input)[0] + EXTENSION
+        with open(args.input) as f, open(output, 'wb') as out:
+            out.write(encode(f))
+    else:
+        output = args.output or os.path.splitext(args.input)[0] + '.gcode'
+        with open(output, 'w') as out:
+            out.writelines(line + '\n' for line in read_lines(args.input))
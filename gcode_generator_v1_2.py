@@ -1,80 +1,736 @@
+import json
+
 import numpy as np
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+import gcode_binary
+
+GENERATOR_VERSION = '1.2'
+
 
 # Custom output function
+class GCodeEmitter:
+    """
+    In-memory sink for the generated protocol.
+
+    G-code commands are buffered line by line (without trailing newlines) and human-readable log messages are kept
+    on a separate channel, so a protocol can be generated without writing anything to the terminal.
+
+    :param echo: Print log messages to the terminal as they are recorded (default is False)
+    """
+
+    def __init__(self, echo=False):
+        self.lines = []
+        self.messages = []
+        self.echo = echo
+
+    def emit(self, line):
+        self.lines.append(line)
+
+    def log(self, message):
+        self.messages.append(message)
+        if self.echo:
+            print(message)
+
+    def clear(self):
+        self.lines.clear()
+        self.messages.clear()
+
+    def iter_lines(self):
+        """Yield each buffered command terminated by a newline."""
+        for line in self.lines:
+            yield line + '\n'
+
+    def getvalue(self):
+        return ''.join(self.iter_lines())
+
+    def to_bytes(self, encoding='ascii'):
+        return self.getvalue().encode(encoding)
+
+    def to_compact(self):
+        """All buffered commands in the compact binary format (see gcode_binary.py)."""
+        return gcode_binary.encode(self.lines)
+
+    def to_file(self, file, compact=None):
+        """
+        Write all buffered commands to a file in one go.
+
+        :param file: Path of the .gcode file or an open file object (binary when compact)
+        :param compact: Write the compact binary format (default is None: only for paths ending in .pgcb)
+        """
+        if compact is None:
+            compact = not hasattr(file, 'write') and str(file).endswith(gcode_binary.EXTENSION)
+        if hasattr(file, 'write'):
+            if compact:
+                file.write(self.to_compact())
+            else:
+                file.writelines(self.iter_lines())
+        elif compact:
+            with open(file, 'wb') as f:
+                f.write(self.to_compact())
+        else:
+            with open(file, 'w') as f:
+                f.writelines(self.iter_lines())
+
+
+# Protocol state
+class TipManager:
+    """
+    Tips left in the tip racks, as an occupancy bitmap per rack (True where the tip is still in the rack, in pick-up
+    order).
+
+    The racks in the slots hold the same tips and form one pool: new_tip(rack) takes the next tip of that rack, then of
+    the other slots in order. When the whole pool is empty, new_tip() raises the pipette and asks the operator to put
+    full racks in (M0, see swap_tip_racks()), so a protocol can use any number of tips. A rack that is not in the
+    slots is a pool of its own.
+
+    One manager can be shared by the contexts of several protocols generated one after the other, and saved to a file
+    (save()/load()), so the next program starts with the tips the previous one left.
+
+    :param slots: Tip racks on the deck that form one pool (default is None: every tip rack on the deck)
+    :param swap: Prompt for full racks when the pool is empty (default is True); False raises ValueError instead
+    """
+
+    def __init__(self, slots=None, swap=True):
+        self.slots = list(slots) if slots is not None else None
+        self.swap = swap
+        self.occupied = {}  # Tip rack name -> occupancy bitmap, created on first use from TipRack.next
+        self.taken = {}  # Tip rack name -> number of tips taken, swaps included
+        self.swaps = 0  # Number of rack swaps
+        self.last = None  # Tip rack of the last tip taken
+
+    def pool(self, tips):
+        """The racks new_tip(tips) takes tips from, in order."""
+        slots = self.slots if self.slots is not None else [module for module in deck.labware
+                                                             if isinstance(module, TipRack)]
+        if not any(rack is tips for rack in slots):
+            return [tips]
+        return [tips] + [rack for rack in slots if rack is not tips]
+
+    def bitmap(self, tips):
+        """Occupancy bitmap of a tip rack (the array itself, so it can be edited for a partly used rack)."""
+        occupied = self.occupied.get(tips.name)
+        if occupied is None:
+            occupied = self.occupied[tips.name] = np.arange(len(tips.locs)) >= tips.next - 1
+        return occupied
+
+    def left(self, tips):
+        """Number of tips left in the pool of a tip rack."""
+        return sum(int(np.count_nonzero(self.bitmap(rack))) for rack in self.pool(tips))
+
+    def take(self, tips):
+        """
+        Mark the next tip of the pool as taken.
+
+        :param tips: The tip rack asked for
+        :return: Tuple (tip rack, 0-based tip index), or None when the pool is empty
+        """
+        for rack in self.pool(tips):
+            occupied = self.bitmap(rack)
+            index = int(occupied.argmax())
+            if occupied[index]:
+                occupied[index] = False
+                self.taken[rack.name] = self.taken.get(rack.name, 0) + 1
+                self.last = rack
+                return rack, index
+        return None
+
+    def refill(self, tips):
+        """Mark every rack of the pool of a tip rack as full."""
+        for rack in self.pool(tips):
+            self.bitmap(rack)[:] = True
+        self.swaps += 1
+
+    def snapshot(self):
+        """Copy of the state, for step_cache.capture_state()."""
+        return {
+            'occupied': {name: occupied.copy() for name, occupied in self.occupied.items()},
+            'taken': dict(self.taken),
+            'swaps': self.swaps,
+            'last': self.last.name if self.last is not None else None,
+        }
+
+    def restore(self, state):
+        self.occupied = {name: occupied.copy() for name, occupied in state['occupied'].items()}
+        self.taken = dict(state['taken'])
+        self.swaps = state['swaps']
+        racks = (self.slots or []) + [module for module in deck.labware if isinstance(module, TipRack)]
+        self.last = next((rack for rack in racks if rack.name == state['last']), None)
+
+    def copy(self):
+        """Another manager with the same slots and state, which can be used up separately."""
+        clone = TipManager(self.slots, self.swap)
+        clone.restore(self.snapshot())
+        return clone
+
+    def save(self, filename):
+        """Write the bitmaps to a JSON file, one string of 1 (tip in the rack) and 0 (taken) per rack."""
+        racks = {name: ''.join('1' if tip else '0' for tip in occupied) for name, occupied in self.occupied.items()}
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump({'racks': racks}, f, indent=2)
+
+    def load(self, filename):
+        """Read the bitmaps written by save(); racks not in the file keep their state."""
+        with open(filename, encoding='utf-8') as f:
+            state = json.load(f)
+        for name, bits in state['racks'].items():
+            self.occupied[name] = np.array([bit == '1' for bit in bits], dtype=bool)
+
+
+class ProtocolContext:
+    """
+    Everything that changes while a protocol is generated: the emitter, the pipette contents, the named preloads, the
+    tips left in the racks, the last commanded position and the liquid volumes in the labware.
+
+    A context keeps its own copy of the well volumes (the labware geometry is shared), so protocols generated in
+    different contexts never see each other's state and can be generated concurrently in threads. The action
+    functions work on the active context: activate one for a block with `with ProtocolContext() as ctx:` or pass
+    ctx=... to a single call. Scripts that never create a context use the default one, which works directly on the
+    module-level labware.
+
+    :param emitter: Emitter receiving the G-code (default is a fresh GCodeEmitter)
+    :param dwell_model: 'settle' (default) scales the pause after each liquid plunger move to the volume and rate
+                        moved, and skips the pause after air-only moves; 'fixed' emits the former fixed pauses
+    :param motion_model: 'load' (default) picks the feedrate and acceleration of travel moves from what the tip
+                         holds (see MOTION_PROFILES); 'fixed' keeps the former F3000 travel and firmware acceleration
+    :param profiler: Optional instrumentation (e.g. gcode_profiler.ActionProfiler) notified around every call of the
+                     INSTRUMENTED_ACTIONS (default is None: no instrumentation)
+    :param tips: TipManager of the tip racks, to carry the tips left over from one protocol to the next (default is
+                 a fresh one with full racks)
+    """
+
+    def __init__(self, emitter=None, dwell_model='settle', motion_model='load', profiler=None, tips=None,
+                 _shared_labware=False):
+        self.emitter = emitter if emitter is not None else GCodeEmitter()
+        self.dwell_model = dwell_model
+        self.motion_model = motion_model
+        self.profiler = profiler
+        self.step = None  # Label of the current protocol step, see protocol_step()
+        self.last_settle = None  # (lines, index, milliseconds) of the last settle pause, for merging
+        self.accel = None  # Last acceleration set with M204, None until the protocol sets one
+        self.aspirated_volume = 0  # Liquid in the tip (μL)
+        self.deadpump_volume = 0  # Air aspirated before the liquid (μL)
+        self.air_gap_volume = 0  # Air aspirated after the liquid (μL)
+        self.preloads = {}  # Custom name -> {'module', 'well_location', 'volume'}
+        self.contents = {}  # (module name, well location) -> custom names of the reagents the well has received
+        self.tip_contents = set()  # Custom names of the reagents the mounted tip has held
+        self.tips = tips if tips is not None else TipManager()
+        self.position = {'X': None, 'Y': None, 'Z': None, 'V': None}  # Last commanded position, None while unknown
+        self.feedrate = None  # Modal feedrate of the moves, as last requested
+        self.modal = {'X': None, 'Y': None, 'Z': None, 'V': None, 'F': None}  # Words the machine last received, see G1
+        self.problems = []  # (check, line index, message) of the problems the actions worked around, see flag()
+        self._shared_labware = _shared_labware
+        self._labware = {}  # id() of a module-level rack or plate -> this context's instance
+        self._tokens = []
+
+    def labware(self, module):
+        """
+        This context's instance of a tube rack or plate; other modules are returned unchanged.
+
+        :param module: A module-level labware object (e.g. tube2) or an instance already owned by this context
+        """
+        if self._shared_labware or not isinstance(module, TubeRack):
+            return module
+        instance = self._labware.get(id(module))
+        if instance is None:
+            instance = module.copy()
+            self._labware[id(module)] = self._labware[id(instance)] = instance
+        return instance
+
+    def __enter__(self):
+        self._tokens.append(_active_context.set(self))
+        return self
+
+    def __exit__(self, *exc_info):
+        _active_context.reset(self._tokens.pop())
+
+
+_active_context = ContextVar('protocol_context', default=None)
+default_context = ProtocolContext(_shared_labware=True)
+
+
+def current_context():
+    """The context of the enclosing `with ProtocolContext()` block in this thread, or the default context."""
+    return _active_context.get() or default_context
+
+
+def with_context(function):
+    """Give an action function an optional ctx keyword that activates a ProtocolContext for the call."""
+    @wraps(function)
+    def wrapper(*args, ctx=None, **kwargs):
+        if ctx is None or ctx is _active_context.get():
+            return function(*args, **kwargs)
+        with ctx:
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# Action functions reported to ProtocolContext.profiler
+INSTRUMENTED_ACTIONS = ('new_tip', 'eject', 'aspirate_volume', 'dispense_volume', 'mix', 'heat', 'pipette_pellet',
+                        'pipette_mix')
+
+
+def instrumented(function):
+    """Report the calls of an action function to the profiler of the current context, if it has one."""
+    name = function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        profiler = current_context().profiler
+        if profiler is None:
+            return function(*args, **kwargs)
+        with profiler.action(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def protocol_step(label):
+    """
+    Start a new protocol step; instrumentation reports the commands that follow under this label.
+
+    :param label: Name of the step (e.g. 'Serial dilution')
+    """
+    ctx = current_context()
+    if ctx.profiler is not None:
+        ctx.profiler.sync()
+    ctx.step = label
+
+
+def emit(line):
+    current_context().emitter.lines.append(line)
+
+
+def log(message):
+    current_context().emitter.log(message)
+
+
+def flag(check, message):
+    """
+    Log a problem an action worked around (e.g. a volume it clamped) and keep it in the context for the dry-run
+    validator (see protocol_validator.py).
+
+    :param check: Kind of problem (e.g. 'well', 'mix_volume')
+    :param message: The log message
+    """
+    ctx = current_context()
+    ctx.emitter.log(message)
+    ctx.problems.append((check, len(ctx.emitter.lines), message))
+
+
+def get_emitter():
+    return current_context().emitter
+
+
+@contextmanager
+def use_emitter(new_emitter=None):
+    """
+    Temporarily route all generated G-code of the active context to another emitter (a fresh one by default).
+
+    :param new_emitter: The emitter to use inside the with-block
+    """
+    ctx = current_context()
+    previous = ctx.emitter
+    ctx.emitter = new_emitter if new_emitter is not None else GCodeEmitter()
+    try:
+        yield ctx.emitter
+    finally:
+        ctx.emitter = previous
+
+
+# Named preloads and position of the default context, kept under their former module-level names
+custom_preloads = default_context.preloads
+current_position = default_context.position
+
+# Labware classes:
+def row_label(row):
+    """
+    Letter(s) of a plate row: A-Z, then AA, AB, ... for plates with more than 26 rows (e.g. 1536-well plates).
+
+    :param row: 0-based row number
+    """
+    label = ''
+    row += 1
+    while row:
+        row, remainder = divmod(row - 1, 26)
+        label = chr(65 + remainder) + label
+    return label
+
+
+class Labware:
+    """
+    Base class of everything placed on the deck.
+
+    Attributes can also be read and written like dictionary keys (e.g. tube1['top']), so code written for the
+    former dictionary definitions keeps working.
+    """
+    __slots__ = ('name', 'top')
+
+    def __init__(self, name, top):
+        self.name = name
+        self.top = top
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def _slot_names(self):
+        return [name for cls in type(self).__mro__ for name in getattr(cls, '__slots__', ())]
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r})"
+
+
+class TubeRack(Labware):
+    """
+    Rack of tubes (or any labware with individually addressed wells) with a volume-to-height model.
+
+    :param name: Name of the module
+    :param X: X coordinates of the tubes
+    :param Y: Y coordinates of the tubes
+    :param Z0: Z height of the bottom of an empty tube
+    :param top: Safe Z-axis distance above the tubes
+    :param height_model: Function (labware, volume) -> Z height of the liquid surface
+    :param radius: Inner radius of a tube in mm, used for touch tip
+    :param dispense_offset: Dispense and blowout height above the liquid surface in mm (default is 1.5)
+    :param mix_blowout_offset: Blowout height above the mixed volume after mixing in mm (default is 2)
+    :param capacity: Working volume of a tube in μL, the range covered by the height lookup table
+    """
+    __slots__ = ('X', 'Y', 'Z0', 'height_model', 'radius', 'V', 'wells', 'Xf', 'Yf', 'Vf',
+                 'dispense_offset', 'mix_blowout_offset', 'capacity', '_height_table')
+
+    def __init__(self, name, X, Y, Z0, top, height_model, radius, dispense_offset=1.5, mix_blowout_offset=2,
+                 capacity=None):
+        super().__init__(name, top)
+        self.X = np.ascontiguousarray(X, dtype=float)
+        self.Y = np.ascontiguousarray(Y, dtype=float)
+        self.Z0 = Z0
+        self.height_model = height_model
+        self.radius = radius
+        self.dispense_offset = dispense_offset
+        self.mix_blowout_offset = mix_blowout_offset
+        self.capacity = capacity
+        self._height_table = None
+        self.wells = {name: index for index, name in enumerate(self.well_names())}
+        self.Xf = self.X.ravel()
+        self.Yf = self.Y.ravel()
+        self.V = np.zeros(self.X.shape)  # Preload condition, initially set to zero
+        self.Vf = self.V.ravel()
+
+    def well_names(self):
+        return [str(tube + 1) for tube in range(len(self.X))]
+
+    def height(self, volume):
+        """Z height of the liquid surface for a volume in μL."""
+        return self.height_model(self, volume)
+
+    def height_table(self):
+        """
+        Dense lookup table of the height model, built on first use and cached. It serves the vectorized evaluations
+        (heights(), liquid_heights(), volumes_at()); the G-code actions keep the exact scalar model.
+
+        :return: Tuple of arrays (volumes, heights)
+        """
+        if self._height_table is None:
+            self._height_table = build_height_table(self.height, self.capacity or HEIGHT_TABLE_DEFAULT_CAPACITY)
+        return self._height_table
+
+    def heights(self, volumes):
+        """
+        Vectorized height model: Z heights of the liquid surface for an array of volumes (e.g. plate.V).
+
+        Volumes beyond the table are evaluated with the exact model. The table only pays off for many volumes at
+        once; the actions evaluate one volume at a time with height(), which is faster than a lookup.
+
+        :param volumes: Scalar or array of volumes in μL
+        :return: Array of Z heights with the shape of volumes (a 0-d array for a scalar)
+        """
+        table_volumes, table_heights = self.height_table()
+        shape = np.shape(volumes)
+        volumes = np.atleast_1d(np.asarray(volumes, dtype=float))
+        heights = np.interp(volumes, table_volumes, table_heights)
+        outside = (volumes < table_volumes[0]) | (volumes > table_volumes[-1])
+        if np.any(outside):
+            heights[outside] = [self.height(volume) for volume in volumes[outside]]
+        return heights.reshape(shape)
+
+    def volumes_at(self, heights):
+        """
+        Inverse height model: the smallest volume whose liquid surface reaches each Z height, for liquid-level
+        following.
+
+        :param heights: Scalar or array of Z heights in mm
+        :return: Array of volumes in μL with the shape of heights (clipped to the table range)
+        """
+        table_volumes, table_heights = self.height_table()
+        # The models are not strictly monotonic around their branch points, so invert the running maximum
+        rising = np.maximum.accumulate(table_heights)
+        rising, first = np.unique(rising, return_index=True)
+        return np.interp(np.asarray(heights, dtype=float), rising, table_volumes[first])
+
+    def liquid_heights(self):
+        """Z heights of the liquid surface in every well, in one vectorized call."""
+        return self.heights(self.V)
+
+    def copy(self):
+        """
+        Another instance of the same labware with empty wells. The geometry arrays and well index are shared,
+        so instantiating labware many times is cheap.
+        """
+        clone = object.__new__(type(self))
+        for name in self._slot_names():
+            setattr(clone, name, getattr(self, name))
+        clone.V = np.zeros(self.X.shape)
+        clone.Vf = clone.V.ravel()
+        return clone
+
+
+class Plate(TubeRack):
+    """
+    Well plate laid out in rows (along X) and columns (along Y); wells are named 'A1', 'B12', ...
+
+    :param rows: Number of rows in the plate
+    :param cols: Number of columns in the plate
+    :param spacing: Spacing between wells
+    """
+    __slots__ = ('rows', 'cols', 'spacing')
+
+    def __init__(self, name, X, Y, Z0, top, height_model, radius, spacing, dispense_offset=1.5,
+                 mix_blowout_offset=2, capacity=None):
+        self.rows, self.cols = np.shape(X)
+        self.spacing = spacing
+        super().__init__(name, X, Y, Z0, top, height_model, radius, dispense_offset, mix_blowout_offset, capacity)
+
+    def well_names(self):
+        return [row_label(row) + str(col + 1) for row in range(self.rows) for col in range(self.cols)]
+
+
+class TipRack(Labware):
+    """
+    Rack of pipette tips.
+
+    :param name: Name of the tip rack
+    :param locs: Array of shape (n, 2) with the X/Y coordinates of the tips, in pick-up order
+    :param top: Safe Z-axis distance above the tips
+    :param rim: Z height where the pipette slows down to pick up a tip
+    :param bottom: Z height at which the tip is pressed on
+    :param spacing: Spacing between tips
+    :param next: Number of the next unused tip (1-based)
+    :param working_volume: Largest total plunger volume (liquid + dead pump + air gap) a tip may hold, in μL
+    """
+    __slots__ = ('locs', 'rim', 'bottom', 'spacing', 'next', 'working_volume')
+
+    def __init__(self, name, locs, top, rim, bottom, spacing, next=1, working_volume=None):
+        super().__init__(name, top)
+        self.locs = np.ascontiguousarray(locs, dtype=float)
+        self.rim = rim
+        self.bottom = bottom
+        self.spacing = spacing
+        self.next = next
+        self.working_volume = working_volume
+
+
+class Deck:
+    """
+    Everything on the deck: labware plus fixed stations (heater, tip ejector).
+
+    :param labware: List of tube racks, plates and tip racks
+    :param stations: List of station dictionaries with 'X', 'Y', 'top' and optionally 'width'/'depth' footprints
+    """
+    __slots__ = ('labware', 'stations')
+
+    def __init__(self, labware, stations):
+        self.labware = list(labware)
+        self.stations = list(stations)
+
+    def obstacles(self, clearance):
+        """
+        Collect the footprint and safe height of every labware and station on the deck.
+
+        :param clearance: Horizontal clearance added around every footprint (in mm)
+        :return: Array of shape (n, 5) with the columns Xmin, Xmax, Ymin, Ymax and the Z height to pass over it
+        """
+        obstacles = []
+        for module in self.labware:
+            if isinstance(module, TipRack):
+                x, y, margin = module.locs[:, 0], module.locs[:, 1], module.spacing / 2 + clearance
+            else:
+                x, y, margin = module.Xf, module.Yf, module.radius + clearance
+            obstacles.append((x.min() - margin, x.max() + margin, y.min() - margin, y.max() + margin, module.top))
+        for station in self.stations:
+            half_width = station.get('width', 0) / 2 + clearance
+            half_depth = station.get('depth', 0) / 2 + clearance
+            obstacles.append((station['X'] - half_width, station['X'] + half_width,
+                              station['Y'] - half_depth, station['Y'] + half_depth, station['top']))
+        return np.array(obstacles, dtype=float)
+
+
+# Height lookup tables:
+HEIGHT_TABLE_POINTS = 20001  # Grid points per table
+HEIGHT_TABLE_DEFAULT_CAPACITY = 1000  # Volume range (μL) for labware without a capacity
+HEIGHT_TABLE_TOLERANCE = 0.02  # Maximum deviation (mm) of a table from its height model
+
+
+def build_height_table(height, capacity, points=HEIGHT_TABLE_POINTS):
+    """
+    Sample a volume-to-height model on a dense grid.
+
+    The models are piecewise, so every jump between neighbouring grid points is located by bisection and stored as
+    two points, which keeps the linear interpolation exact on both sides of a branch point.
+
+    :param height: Scalar height model, volume -> Z height
+    :param capacity: Largest volume in the table in μL
+    :param points: Number of grid points (default is HEIGHT_TABLE_POINTS)
+    :return: Tuple of arrays (volumes, heights)
+    """
+    volumes = np.linspace(0, capacity, points)
+    heights = np.array([height(volume) for volume in volumes], dtype=float)
+    steps = np.abs(np.diff(heights))
+    typical = np.median(steps[steps > 0]) if np.any(steps > 0) else 0
+    jumps = np.flatnonzero(steps > max(10 * typical, 0.02))
+    if len(jumps) == 0:
+        return volumes, heights
+
+    extra_volumes, extra_heights = [], []
+    for i in jumps:
+        low, high = volumes[i], volumes[i + 1]
+        left = heights[i]
+        for _ in range(40):
+            middle = (low + high) / 2
+            if abs(height(middle) - left) < abs(height(middle) - heights[i + 1]):
+                low = middle
+            else:
+                high = middle
+        extra_volumes += [low, high]
+        extra_heights += [height(low), height(high)]
+    volumes = np.concatenate((volumes, extra_volumes))
+    heights = np.concatenate((heights, extra_heights))
+    order = np.argsort(volumes, kind='stable')
+    return volumes[order], heights[order]
+
+
+def check_height_tables(labware=None, tolerance=HEIGHT_TABLE_TOLERANCE, samples=5000):
+    """
+    Check that the height lookup tables reproduce the height models within a tolerance.
+
+    :param labware: List of tube racks/plates to check (default is every tube rack and plate on the deck)
+    :param tolerance: Maximum allowed deviation in mm (default is HEIGHT_TABLE_TOLERANCE)
+    :param samples: Number of random volumes checked per labware (default is 5000)
+    :return: Dictionary of labware name -> largest deviation in mm
+    """
+    labware = [module for module in deck.labware if isinstance(module, TubeRack)] if labware is None else labware
+    rng = np.random.default_rng(0)
+    deviations = {}
+    for module in labware:
+        table_volumes = module.height_table()[0]
+        volumes = rng.uniform(0, table_volumes[-1], samples)
+        exact = np.array([module.height(volume) for volume in volumes])
+        deviations[module.name] = float(np.max(np.abs(module.heights(volumes) - exact)))
+    failed = {name: deviation for name, deviation in deviations.items() if deviation > tolerance}
+    if failed:
+        raise ValueError(f"-Height tables deviate from their models by more than {tolerance} mm: {failed}")
+    return deviations
+
+
+def well_index(module, well):
+    """
+    Flat index of a tube/well location in O(1).
+
+    :param module: The module being used (e.g., tube1, plate_384_biorad)
+    :param well: The well location (e.g., '1', 'A1', 'b12')
+    :return: The flat index, or None if the module has no such well
+    """
+    index = module.wells.get(well)
+    if index is None:
+        index = module.wells.get(str(well).strip().upper())
+    return index
+
+
+def well_range(module):
+    """First and last valid well names of a module (e.g. ('A1', 'P24'))."""
+    names = list(module.wells)
+    return names[0], names[-1]
 
-# Globals
-current_aspirated_volume = 0
-current_deadpump_volume = 0
-current_air_gap_volume = 0
-custom_preloads = {}
 
 # Setting up deck positions:
 
 # Tube locations:
 
 # Generic Epindorf 5mL tubes:
-tube1 = {
-    'X': np.arange(130, 130 + 20.3 * 6, 20.3),
-    'Y': np.full(6, 40.5),
-    'Z0': 1.5,
-    'top': 60,  # safe Z-axis distance
-    'height': lambda v: round(
-        tube1['Z0'] if v <= 3 else
+tube1 = TubeRack(
+    name='Tube 1 (5.0mL)',
+    X=np.arange(130, 130 + 20.3 * 6, 20.3),
+    Y=np.full(6, 40.5),
+    Z0=1.5,
+    top=60,  # safe Z-axis distance
+    height_model=lambda tube, v: round(
+        tube.Z0 if v <= 3 else
         1.08 * (v ** 0.435) if v <= 950 else
         (6.65E-03 * v + 15.3), 2
     ),
-    'radius': 7.6,  # mm
-    'V': np.zeros(6),  # Preload condition, initially set to zero
-    'name': 'Tube 1 (5.0mL)'
-}
+    radius=7.6,  # mm
+    capacity=5000  # μL
+)
 
 # Generic 1.5mL tubes:
-tube2 = {
-    'X': [129, 149.3, 169.6, 189.9, 210.2, 230.5, 230.5, 230.5, 230.5, 230.5, 230.5, 230.5],
-    'Y': [61.6, 61.6, 61.6, 61.6, 61.6, 61.6, 81.9, 102.2, 122.5, 142.8, 163.1, 183.4],
-    'Z0': 2.9,
-    'top': 40,
-    'height': lambda v: round(
-        tube2['Z0'] if v <= 3 else
+tube2 = TubeRack(
+    name='Tube 2 (1.5mL)',
+    X=[129, 149.3, 169.6, 189.9, 210.2, 230.5, 230.5, 230.5, 230.5, 230.5, 230.5, 230.5],
+    Y=[61.6, 61.6, 61.6, 61.6, 61.6, 61.6, 81.9, 102.2, 122.5, 142.8, 163.1, 183.4],
+    Z0=2.9,
+    top=40,
+    height_model=lambda tube, v: round(
+        tube.Z0 if v <= 3 else
         0.75 * (v ** 0.507) if v <= 410 else
         (0.0164 * v + 9.56), 2
     ),
-    'radius': 4,  # mm
-    'V': np.zeros(12),  # Preload condition, initially set to zero
-    'name': 'Tube 2 (1.5mL)'
-}
+    radius=4,  # mm
+    capacity=1500  # μL
+)
 
 # Generic 0.2mL tubes: (with rim!)
-tube3 = {
-    'X': np.concatenate((np.full(12, 112.4), np.full(12, 130.4))),
-    'Y': np.concatenate((np.arange(114.6, 222.6, 9), np.arange(110.1, 218.1, 9))),
-    'Z0': 5.2,
-    'top': 25.2,
-    'height': lambda v: round(
-        tube3['Z0'] if v <= 3 else
+tube3 = TubeRack(
+    name='Tube 3 (0.2mL)',
+    X=np.concatenate((np.full(12, 112.4), np.full(12, 130.4))),
+    Y=np.concatenate((np.arange(114.6, 222.6, 9), np.arange(110.1, 218.1, 9))),
+    Z0=5.2,
+    top=25.2,
+    height_model=lambda tube, v: round(
+        tube.Z0 if v <= 3 else
         5.8 + 0.193 * v + -1.28E-03 * (v ** 2) if v <= 62 else
         (0.0484 * v + 9.7), 2
     ),
-    'radius': 2.0,  # mm
-    'V': np.zeros(24),  # Preload condition, initially set to zero
-    'name': 'Tube 3 (0.2mL)'
-}
+    radius=2.0,  # mm
+    capacity=200  # μL
+)
 
 # Generic 0.2mL tubes: (without rim!)
-tube3_rimless = {
-    'X': np.concatenate((np.full(12, 112.4), np.full(12, 130.4))),
-    'Y': np.concatenate((np.arange(114.6, 222.6, 9), np.arange(110.1, 218.1, 9))),
-    'Z0': 2.8,
-    'top': 22.2,
-    'height': lambda v: round(
-        tube3_rimless['Z0'] if v <= 3 else
+tube3_rimless = TubeRack(
+    name='Tube 3 rimless (0.2mL)',
+    X=np.concatenate((np.full(12, 112.4), np.full(12, 130.4))),
+    Y=np.concatenate((np.arange(114.6, 222.6, 9), np.arange(110.1, 218.1, 9))),
+    Z0=2.8,
+    top=22.2,
+    height_model=lambda tube, v: round(
+        tube.Z0 if v <= 3 else
         3.1 + 0.193 * v + -1.28E-03 * (v ** 2) if v <= 62 else
         (0.0484 * v + 7.3), 2
     ),
-    'radius': 2.0,  # mm
-    'V': np.zeros(24),  # Preload condition, initially set to zero
-    'name': 'Tube 3 rimless (0.2mL)'
-}
+    radius=2.0,  # mm
+    capacity=200  # μL
+)
 
 # E1 clip tips: (200uL yellow rack, Thermofisher, catalog no: 94420318)
 tiprows = 12  # Number of rows
@@ -88,13 +744,16 @@ tipX, tipY = np.meshgrid(
     np.arange(tipYorig, tipYorig + tiprows * tipspacing, tipspacing)
 )
 
-E1_yellow_tips = {
-    'locs': np.column_stack((tipX.ravel(), tipY.ravel())),
-    'top': 65,
-    'rim': 10,
-    'bottom': 3.0,
-    'next': 1
-}
+E1_yellow_tips = TipRack(
+    name='E1 yellow tips (200uL)',
+    locs=np.column_stack((tipX.ravel(), tipY.ravel())),
+    top=65,
+    rim=10,
+    bottom=3.0,
+    spacing=tipspacing,
+    next=1,
+    working_volume=110  # Largest plunger volume used by the validated protocols, well below the 200uL tip volume
+)
 
 pipette_heater = {
     'X': 231,
@@ -103,10 +762,19 @@ pipette_heater = {
     'bottom': 26
 }
 
+eject_station = {
+    'X': 62.5,
+    'Y': 48,  # Y position of the ejector slot
+    'approach_Y': 75,  # Y position in front of the ejector
+    'top': 100,  # safe Z-axis distance to pass over the ejector
+    'width': 30,  # footprint of the ejector (in mm)
+    'depth': 40
+}
+
 
 # Well plate locations:
 def well_creator(rows, cols, spacing, Z0, top, well1_diff_X, well1_diff_Y,
-                 height, well_radius, name):  # preload should either be a single zero or a matrix
+                 height, well_radius, name, dispense_offset=1.5, mix_blowout_offset=2, capacity=None):
     """
         Create a well plate configuration with volume height correlation.
 
@@ -117,174 +785,396 @@ def well_creator(rows, cols, spacing, Z0, top, well1_diff_X, well1_diff_Y,
         :param top: Top height of the wells
         :param well1_diff_X: X offset for the first well from bottom left corner of the plate slot
         :param well1_diff_Y: Y offset for the first well from bottom left corner of the plate slot
-        :param height: Function to calculate height based on volume
+        :param height: Function (plate, volume) to calculate height based on volume
         :param name: Name of the custom plate
-        :return: Dictionary representing the well plate
-    """
-    well = {
-        'X': np.zeros((rows, cols)),
-        'Y': np.zeros((rows, cols)),
-        'Z0': Z0,
-        'top': top,
-        'height': height,
-        'V': np.zeros((rows, cols)),  # Preload condition, initially set to zero
-        'radius': well_radius,
-        'name': name
-    }
-    for i in range(rows):
-        for j in range(cols):
-            well['X'][i, j] = 136.2 + well1_diff_X + i * spacing
-            well['Y'][i, j] = 86 + well1_diff_Y + j * spacing
-    return well
+        :param dispense_offset: Dispense and blowout height above the liquid surface in mm (default is 1.5)
+        :param mix_blowout_offset: Blowout height above the mixed volume after mixing in mm (default is 2)
+        :param capacity: Working volume of a well in μL
+        :return: Plate representing the well plate
+    """
+    # Rows run along X and columns along Y
+    X = 136.2 + well1_diff_X + np.arange(rows)[:, None] * spacing
+    Y = 86 + well1_diff_Y + np.arange(cols)[None, :] * spacing
+    X, Y = np.broadcast_arrays(X, Y)
+    return Plate(name=name, X=X, Y=Y, Z0=Z0, top=top, height_model=height, radius=well_radius, spacing=spacing,
+                 dispense_offset=dispense_offset, mix_blowout_offset=mix_blowout_offset, capacity=capacity)
 
 
 plate_384_biorad = well_creator(rows=16, cols=24, spacing=4.5, Z0=1.05, top=11.4, well1_diff_X=8.84,
-                                well1_diff_Y=12.28, height=lambda v: 0.202 * v + 1.05, well_radius=1.2,
-                                name='384-well plate (BioRad)')
+                                well1_diff_Y=12.28, height=lambda plate, v: 0.202 * v + 1.05, well_radius=1.2,
+                                name='384-well plate (BioRad)', dispense_offset=0.5, mix_blowout_offset=1,
+                                capacity=40)
 
 plate_96_biorad = well_creator(rows=8, cols=12, spacing=9.0, Z0=2.8, top=18.2, well1_diff_X=11.11, well1_diff_Y=14.25,
-                               height=lambda v: round(tube3_rimless['Z0'] if v <= 5 else
-                                                      3.1 + 0.193 * v + -1.28E-03 * (v ** 2)
-                                                      if v <= 62 else (0.0484 * v + 7.3), 2), well_radius=2.4,
-                               name='96-well plate (BioRad)')
+                               height=lambda plate, v: round(plate.Z0 if v <= 5 else
+                                                             3.1 + 0.193 * v + -1.28E-03 * (v ** 2)
+                                                             if v <= 62 else (0.0484 * v + 7.3), 2), well_radius=2.4,
+                               name='96-well plate (BioRad)', capacity=200)
 
 
-# Sequence of functions:
-def start():
-    print('M92 X80 Y80 Z400 V165\n')  # set the steps per unit (X, Y, Z: mm; V: uL)
-    print('M203 X6000 Y1000 Z30 V20\n')  # set maximum feedrate unit per second (X, Y, Z: mm/s; V: uL/s)
-    print('G1 Z50\n')
-    print('G1 Y50\n')
-    print('G28 X V\n')
-    print('G28 Y\n')
-    print('G1 Y100\n')
-    print('G28 Z\n')
-    print('G1 V0\n')
-    print('G1 Z65\n')
+# Deck obstacles used by the travel planner:
+DECK_CLEARANCE = 5  # Horizontal clearance around every labware footprint (in mm)
 
+deck = Deck(labware=[tube1, tube2, tube3, tube3_rimless, plate_384_biorad, plate_96_biorad, E1_yellow_tips],
+            stations=[pipette_heater, eject_station])
+deck_obstacles = deck.obstacles(DECK_CLEARANCE)
 
-def G1(x=None, y=None, z=None, p=None, feedrate=None, accel=None):
-    gcode = 'G1'
-    if accel is not None:
-        print(f'M204 S{accel}\n')
 
-    if x is not None:
-        if isinstance(x, np.ndarray):
-            gcode += f' X{np.round(x, 3)}'
-        else:
-            gcode += f' X{round(x, 3)}'
+# Machine limits programmed at the start of every protocol:
+STEPS_PER_UNIT = {'X': 80, 'Y': 80, 'Z': 400, 'V': 165}  # steps per unit (X, Y, Z: mm; V: uL)
+MAX_FEEDRATE = {'X': 6000, 'Y': 1000, 'Z': 30, 'V': 20}  # maximum feedrate unit per second (X, Y, Z: mm/s; V: uL/s)
 
-    if y is not None:
-        if isinstance(y, np.ndarray):
-            gcode += f' Y{np.round(y, 3)}'
-        else:
-            gcode += f' Y{round(y, 3)}'
+# Reach of the axes (X, Y, Z: mm; V: uL), from the corners of calibration() and the 200uL tip volume
+MACHINE_ENVELOPE = {'X': (0, 240), 'Y': (0, 240), 'Z': (0, 100), 'V': (0, 200)}
 
-    if z is not None:
-        if isinstance(z, np.ndarray):
-            gcode += f' Z{np.round(z, 3)}'
-        else:
-            gcode += f' Z{round(z, 3)}'
+# Travel motion profiles by what the tip holds (see pipette_load()): feedrate per axis in units/min (Z at its M203
+# limit) and acceleration in mm/s^2. Liquid keeps the former F3000 and a gentle acceleration so it does not slosh or
+# drip; air and empty tips only have to stay on the deck.
+TRAVEL_FEEDRATE = 3000  # Former fixed travel feedrate, kept by the 'fixed' motion model
+MOTION_PROFILES = {
+    'empty': {'X': 12000, 'Y': 12000, 'Z': 60 * MAX_FEEDRATE['Z'], 'accel': 3000},
+    'air': {'X': 9000, 'Y': 9000, 'Z': 60 * MAX_FEEDRATE['Z'], 'accel': 2000},
+    'liquid': {'X': 3000, 'Y': 3000, 'Z': 60 * MAX_FEEDRATE['Z'], 'accel': 1500},
+}
 
-    if p is not None:
-        if isinstance(p, np.ndarray):
-            gcode += f' V{np.round(p, 4)}'
-        else:
-            gcode += f' V{round(p, 4)}'
+# Settle pause after a liquid plunger move: the liquid lags the plunger by an amount that grows with the volume moved
+# and with the plunger speed, so the pause is SETTLE_MIN + SETTLE_PER_UL * volume, scaled by the square root of the
+# feedrate relative to SETTLE_REFERENCE_FEEDRATE (the fastest plunger move, a mix stroke) and capped at SETTLE_MAX.
+# Slower moves settle faster than a stroke at the reference rate: 95 uL at F2500 in 0.34 s, 100 uL aspirated at F500
+# in 0.18 s, a 30 uL pellet dispense at F100 in 0.07 s.
+SETTLE_MIN = 0.05  # seconds
+SETTLE_PER_UL = 0.003  # seconds per uL at SETTLE_REFERENCE_FEEDRATE
+SETTLE_REFERENCE_FEEDRATE = 2500
+SETTLE_MAX = 1.0  # seconds
 
-    if feedrate is not None:
-        gcode += f' F{feedrate}'
 
-    print(gcode + '\n')
+def settle_time(volume, feedrate):
+    """
+    Time for the liquid in the tip to catch up with the plunger after moving a volume.
 
+    :param volume: Volume moved in μL
+    :param feedrate: Plunger feedrate of the move
+    :return: Time in seconds, rounded to 10 ms
+    """
+    seconds = SETTLE_MIN + SETTLE_PER_UL * abs(volume) * (feedrate / SETTLE_REFERENCE_FEEDRATE) ** 0.5
+    return round(min(seconds, SETTLE_MAX), 2)
+
+
+def settle_pause(volume, feedrate, settle=None, fixed=None):
+    """
+    Pause after a liquid plunger move so the liquid can settle. A pause directly after another settle pause is merged
+    into it (the longer one wins), because both wait for the same liquid.
+
+    :param volume: Volume moved in μL
+    :param feedrate: Plunger feedrate of the move
+    :param settle: Override of the settle time in seconds (0 skips the pause)
+    :param fixed: The former fixed pause in seconds, emitted as-is when the context uses the 'fixed' dwell model
+    """
+    ctx = current_context()
+    if ctx.dwell_model == 'fixed':
+        if fixed:
+            emit(f'G4 P{round(fixed * 1000)}')
+        return
+    milliseconds = round(1000 * (settle_time(volume, feedrate) if settle is None else settle))
+    if milliseconds <= 0:
+        return
+    lines = ctx.emitter.lines
+    last = ctx.last_settle
+    if last is not None and last[0] is lines and last[1] == len(lines) - 1:
+        milliseconds = max(milliseconds, last[2])
+        lines[-1] = f'G4 P{milliseconds}'
+    else:
+        emit(f'G4 P{milliseconds}')
+    ctx.last_settle = (lines, len(lines) - 1, milliseconds)
 
-def G2(x=None, y=None, i=None, j=None, feedrate=None):
-    gcode = 'G2'
-    # Add X and Y coordinates (same as start point for a full circle). Add I and J offsets (from start point to center)
-    gcode += f" X{x:.3f} Y{y:.3f} I{-i:.3f} J{j:.3f}"
 
-    # Add feedrate if specified
+def air_pause(fixed):
+    """
+    The former fixed pause after an air-only plunger move (dead pump, air gap). Air does not need to settle, so the
+    pause is only emitted with the 'fixed' dwell model.
+
+    :param fixed: Pause in seconds
+    """
+    if current_context().dwell_model == 'fixed':
+        emit(f'G4 P{round(fixed * 1000)}')
+
+
+# Fixed-point formatting of G-code numbers: the value is scaled to an integer once and the digits after the point come
+# from a precomputed table with the trailing zeros already stripped (12.340 -> '12.34', 65.000 -> '65').
+AXIS_DECIMALS = {'X': 3, 'Y': 3, 'Z': 3, 'V': 4, 'F': 3}
+_SCALES = {decimals: 10 ** decimals for decimals in set(AXIS_DECIMALS.values())}
+_FRACTIONS = {decimals: [''] + ['.' + f'{n:0{decimals}d}'.rstrip('0') for n in range(1, scale)]
+              for decimals, scale in _SCALES.items()}
+
+
+def format_fixed(value, decimals=3):
+    """
+    Format a number for a G-code word, rounded to a number of decimals, without trailing zeros.
+
+    :param value: int, float, NumPy scalar or 0-d array
+    :param decimals: Number of decimals, one of AXIS_DECIMALS (default is 3)
+    :return: Text of the number (e.g. '65', '12.34', '-0.5')
+    """
+    scale = _SCALES[decimals]
+    scaled = round(float(value) * scale)
+    whole, fraction = divmod(abs(scaled), scale)
+    return f"{'-' if scaled < 0 else ''}{whole}{_FRACTIONS[decimals][fraction]}"
+
+
+def set_position(**axes):
+    """
+    Record where raw commands (homing, calibration moves) left the axes, e.g. set_position(X=0, Y=100).
+
+    :param axes: Axis -> position; None marks the axis as unknown, so the next move writes it again
+    """
+    ctx = current_context()
+    for axis, value in axes.items():
+        ctx.position[axis] = None if value is None else float(value)
+        ctx.modal[axis] = None if value is None else format_fixed(value, AXIS_DECIMALS[axis])
+
+
+def pipette_load(ctx=None):
+    """
+    What the tip is carrying, which decides the motion profile of travel moves.
+
+    :param ctx: The ProtocolContext (default is the active one)
+    :return: 'liquid' when there is liquid in the tip, 'air' when the plunger only holds air (dead pump, air gap),
+             otherwise 'empty'
+    """
+    ctx = ctx or current_context()
+    if round(ctx.aspirated_volume, 3) > 0:
+        return 'liquid'
+    if round(ctx.deadpump_volume + ctx.air_gap_volume, 3) > 0:
+        return 'air'
+    return 'empty'
+
+
+def set_feedrate(feedrate):
+    """Set the modal feedrate with a move-less G1 F line."""
+    ctx = current_context()
+    ctx.feedrate = feedrate
+    ctx.modal['F'] = format_fixed(feedrate)
+    emit(f"G1 F{ctx.modal['F']}")
+
+
+def set_acceleration(accel):
+    """Set the acceleration (M204) unless it is already at that value."""
+    ctx = current_context()
+    if ctx.accel != accel:
+        emit(f'M204 S{accel}')
+        ctx.accel = accel
+
+
+def travel_feedrate(*axes, load=None, fixed=TRAVEL_FEEDRATE):
+    """
+    Feedrate of a travel move along the given axes, from the motion profile of what the tip holds; also sets the
+    acceleration of that profile.
+
+    :param axes: Axes moved ('X', 'Y', 'Z'); the slowest of them sets the feedrate
+    :param load: Profile to use instead of pipette_load() (e.g. 'empty' while no tip is mounted)
+    :param fixed: The former feedrate of the move (None: no F word), returned as-is with the 'fixed' motion model
+    :return: Feedrate in units/min
+    """
+    ctx = current_context()
+    if ctx.motion_model == 'fixed':
+        return fixed
+    profile = MOTION_PROFILES[load or pipette_load(ctx)]
+    set_acceleration(profile['accel'])
+    return min(profile[axis] for axis in axes)
+
+
+# Sequence of functions:
+# Action functions accept an optional ctx=ProtocolContext(...) keyword (see with_context); the G1/G2 primitives
+# always write to the active context.
+@with_context
+def machine_limits():
+    emit('M92 ' + ' '.join(f'{axis}{value}' for axis, value in STEPS_PER_UNIT.items()))  # set the steps per unit
+    emit('M203 ' + ' '.join(f'{axis}{value}' for axis, value in MAX_FEEDRATE.items()))  # set maximum feedrate
+
+
+@with_context
+def start():
+    machine_limits()
+    emit('G1 Z50')
+    emit('G1 Y50')
+    emit('G28 X V')
+    emit('G28 Y')
+    emit('G1 Y100')
+    emit('G28 Z')
+    emit('G1 V0')
+    emit('G1 Z65')
+    set_position(X=0, Y=100, Z=65, V=0)
+
+
+def G1(x=None, y=None, z=None, p=None, feedrate=None, accel=None):
+    """
+    Linear move. Only the words that change the machine state are written: an axis that is already at the (rounded)
+    target and an F equal to the modal feedrate are left out. A move that changes nothing is not emitted; its
+    feedrate still applies to the following moves.
+
+    :param x: X target (mm)
+    :param y: Y target (mm)
+    :param z: Z target (mm)
+    :param p: Plunger target (μL)
+    :param feedrate: Feedrate (units/min), modal
+    :param accel: Acceleration (mm/s^2), see set_acceleration()
+    """
+    ctx = current_context()
+    if accel is not None:
+        set_acceleration(accel)
     if feedrate is not None:
-        gcode += f" F{feedrate}"
+        ctx.feedrate = feedrate
+    position, modal = ctx.position, ctx.modal
+    gcode = 'G1'
+    for axis, value in (('X', x), ('Y', y), ('Z', z), ('V', p)):
+        if value is not None:
+            position[axis] = value = float(value)
+            text = format_fixed(value, AXIS_DECIMALS[axis])
+            if text != modal[axis]:
+                modal[axis] = text
+                gcode += f' {axis}{text}'
+    if len(gcode) == 2:
+        return
+    if ctx.feedrate is not None:
+        text = format_fixed(ctx.feedrate)
+        if text != modal['F']:
+            modal['F'] = text
+            gcode += f' F{text}'
+    emit(gcode)
 
-    print(gcode + '\n')
 
+def G2(x=None, y=None, i=None, j=None, feedrate=None):
+    ctx = current_context()
+    if feedrate is not None:
+        ctx.feedrate = feedrate
+    x, y = format_fixed(x), format_fixed(y)
+    # Add X and Y coordinates (same as start point for a full circle). Add I and J offsets (from start point to center)
+    gcode = f"G2 X{x} Y{y} I{format_fixed(-i)} J{format_fixed(j)}"
 
-def G28(feedrate=3000):
-    print('M92 X80 Y80 Z400 V165\n')  # set the steps per unit (X, Y, Z: mm; V: uL)
-    print('M203 X6000 Y1000 Z30 V20\n')  # set maximum feedrate unit per second (X, Y, Z: mm/s; V: uL/s)
-    print(f'G1 F{feedrate}\n')
-    print('G1 Z100\n')
-    print('G1 Y100\n')
-    print('G28 X V\n')
-    print('G28 Y\n')
-    print('G1 Y100\n')
-    print('G28 Z\n')
-    print('G1 Z65 V0\n')
+    # Add feedrate if it is not the modal one
+    if ctx.feedrate is not None and format_fixed(ctx.feedrate) != ctx.modal['F']:
+        ctx.modal['F'] = format_fixed(ctx.feedrate)
+        gcode += f" F{ctx.modal['F']}"
+
+    emit(gcode)
+    set_position(X=x, Y=y)
 
 
+@with_context
+def G28(feedrate=3000):
+    machine_limits()
+    set_feedrate(feedrate)
+    emit('G1 Z100')
+    emit('G1 Y100')
+    emit('G28 X V')
+    emit('G28 Y')
+    emit('G1 Y100')
+    emit('G28 Z')
+    emit('G1 Z65 V0')
+    set_position(X=0, Y=100, Z=65, V=0)
+
+
+@with_context
 def homing_pos(feedrate=3000):
-    print(f'G1 F{feedrate}\n')
-    print('G1 Z100\n')
-    print('G1 Y100 X10\n')
+    set_feedrate(feedrate)
+    emit('G1 Z100')
+    emit('G1 Y100 X10')
+    set_position(X=10, Y=100, Z=100)
 
 
+@with_context
+@instrumented
 def new_tip(tips):
-    global next_tip
-    if 'next_tip' not in globals():
-        next_tip = tips['next']
-    G1(z=tips['top'], feedrate=3000)
-    G1(x=tips['locs'][next_tip - 1, 0], y=tips['locs'][next_tip - 1, 1])
-    G1(z=tips['rim'])
-    G1(z=tips['bottom'], feedrate=200)
-    G1(z=tips['top'], feedrate=3000)
-    next_tip += 1
-    print('-Added new tip\n')
+    """
+    Pick up the next tip of a tip rack, or of the other racks of its pool (see TipManager). When the pool is empty,
+    the operator is asked to put full racks in first (see swap_tip_racks()).
+
+    :param tips: The tip rack (e.g. E1_yellow_tips)
+    :raises ValueError: If the pool is empty and the context's TipManager does not swap racks
+    """
+    ctx = current_context()
+    taken = ctx.tips.take(tips)
+    if taken is None:
+        if not ctx.tips.swap:
+            message = f"-No tips left in {', '.join(rack.name for rack in ctx.tips.pool(tips))}."
+            flag('tips', message)
+            raise ValueError(message)
+        swap_tip_racks(tips)
+        taken = ctx.tips.take(tips)
+    rack, index = taken
+    ctx.tip_contents = set()
+    G1(z=rack.top, feedrate=travel_feedrate('Z', load='empty'))  # No tip mounted
+    G1(x=rack.locs[index, 0], y=rack.locs[index, 1], feedrate=travel_feedrate('X', 'Y', load='empty', fixed=None))
+    G1(z=rack.rim)
+    G1(z=rack.bottom, feedrate=200)
+    G1(z=rack.top, feedrate=travel_feedrate('Z', load='empty'))
+    log('-Added new tip')
+
+
+@with_context
+def swap_tip_racks(tips):
+    """
+    Raise the pipette clear of the deck and wait (M0) for the operator to replace the racks of a pool with full ones.
+
+    :param tips: A tip rack of the pool
+    """
+    ctx = current_context()
+    racks = ', '.join(rack.name for rack in ctx.tips.pool(tips))
+    G1(z=eject_station['top'], feedrate=travel_feedrate('Z', load='empty'))
+    emit(f'M0 Replace the empty tip racks ({racks}) with full ones! Press button to continue')
+    ctx.tips.refill(tips)
+    log(f'-Swapped tip racks: {racks}')
 
 
+@with_context
+@instrumented
 def eject():
-    G1(z=100, feedrate=3000)
-    G1(x=62.5, y=75)
+    G1(z=eject_station['top'], feedrate=travel_feedrate('Z'))
+    G1(x=eject_station['X'], y=eject_station['approach_Y'], feedrate=travel_feedrate('X', 'Y', fixed=None))
     G1(z=65)
-    G1(x=62.5, y=48)
+    # Into the ejector at the gentle profile
+    G1(x=eject_station['X'], y=eject_station['Y'], feedrate=travel_feedrate('X', 'Y', load='liquid', fixed=None))
     G1(z=75, feedrate=200)
     G1(z=70, feedrate=500)
-    G1(y=75, feedrate=3000)
-    print('Ejected tip\n')
+    G1(y=eject_station['approach_Y'], feedrate=travel_feedrate('Y', load='empty'))  # The tip is off
+    log('Ejected tip')
 
 ############ Calibration Functions ############
 
+@with_context
 def calibration():
-    print('M0 Make sure the stage is removed! Press button to continue')
+    set_position(X=None, Y=None, Z=None)  # Raw moves below are not tracked
+    emit('M0 Make sure the stage is removed! Press button to continue')
     positions = [
         (232, 13, 0),
         (232, 235, 0),
         (19, 235, 0),
         (19, 13, 0)
     ]
-    print(f'G1 Z10\n')
+    emit(f'G1 Z10')
     for _ in range(3):  # Repeat the sequence 3 times
         for x, y, z in positions:
             # Move to the position
-            print(f'G1 X{x} Y{y} Z10\n')
-            print(f'G4 P200\n')  # Pause for 200ms
-            print(f'G1 Z{z}\n')
+            emit(f'G1 X{x} Y{y} Z10')
+            emit(f'G4 P200')  # Pause for 200ms
+            emit(f'G1 Z{z}')
 
             # Pause and wait for user input
-            print('M0 Press button to continue\n')
+            emit('M0 Press button to continue')
 
-            print(f'G1 Z10\n')
+            emit(f'G1 Z10')
 
-    print(f'G1 Z100\n')
-    print(f'G1 Y100\n')
+    emit(f'G1 Z100')
+    emit(f'G1 Y100')
 
 
+@with_context
 def move_to_module_cal_test(module):
     """
     :param module: Name of the module 'e.g. Tube1'
     :return:
     """
-    if isinstance(module, dict) and 'X' in module and isinstance(module['X'], np.ndarray) and module['X'].ndim == 2:
+    if isinstance(module, Plate):
         # It's a plate (2D array of wells)
         first_move = True
         for row in list(range(0, 2)) + list(range(14, 16)):  # 4 rows (A to B and 23 to 24)
@@ -295,7 +1185,7 @@ def move_to_module_cal_test(module):
                     first_move = False
                 else:
                     move_to_well_location(module, well, safe_dist=False, direct=True)
-                print('M0 Press button to continue\n')
+                emit('M0 Press button to continue')
         first_move = True
         for row in list(range(0, 2)) + list(range(14, 16)):  # 4 rows (A to B and 23 to 24)
             for col in list(range(22, 24)):  # 2 columns (23 to 24)
@@ -305,23 +1195,24 @@ def move_to_module_cal_test(module):
                     first_move = False
                 else:
                     move_to_well_location(module, well, safe_dist=False, direct=True)
-                print('M0 Press button to continue\n')
-    elif isinstance(module, dict) and 'X' in module and isinstance(module['X'], (list, np.ndarray)):
+                emit('M0 Press button to continue')
+    elif isinstance(module, TubeRack):
         # It's a tube rack (1D array of tubes)
         G1(z=100)  # Move to a safe height first
-        for i in range(len(module['X'])):
-            G1(x=module['X'][i])
-            G1(y=module['Y'][i])
-            G1(z=module['top'])
-            print('M0 Press button to continue\n')
+        for i in range(len(module.X)):
+            G1(x=module.X[i])
+            G1(y=module.Y[i])
+            G1(z=module.top)
+            emit('M0 Press button to continue')
         # Pause and wait for user input
     else:
-        print("-Invalid module type")
+        log("-Invalid module type")
         return
 
     homing_pos()  # Return to home position after completing all wells/tubes
 
 
+@with_context
 def aspirate_iteratively_tube_bottom_cal(module, location, volume, initial_height='Z0', iterations=5, z_decrement=1,
                                          dead_vol=20, adj_z_increment=0.5):
     global tube1, tube2, tube3, tube3_rimless, plate_384_biorad
@@ -333,7 +1224,7 @@ def aspirate_iteratively_tube_bottom_cal(module, location, volume, initial_heigh
         # Aspirate dead volume
         G1(p=0)
         G1(p=dead_vol)
-        print('G4 P1000\n')  # Pause for 1000ms
+        emit('G4 P1000')  # Pause for 1000ms
         volume_adj = dead_vol + volume
 
         # Calculate the current Z position
@@ -347,7 +1238,7 @@ def aspirate_iteratively_tube_bottom_cal(module, location, volume, initial_heigh
 
         # Aspirate the specified volume
         G1(p=volume_adj, feedrate=100)  # Adjust feedrate as needed for aspiration
-        print('G4 P1000\n')  # Pause for 1000ms
+        emit('G4 P1000')  # Pause for 1000ms
 
         # Aspirate all remaining liquid by moving z height up
         adj_z = current_z + adj_z_increment
@@ -357,10 +1248,11 @@ def aspirate_iteratively_tube_bottom_cal(module, location, volume, initial_heigh
         G1(z=100, feedrate=3000)
 
         # Pause and dispense the full volume
-        print('M0 Press button to dispense\n')
+        emit('M0 Press button to dispense')
         G1(p=0)
 
 
+@with_context
 def height_cal(tube_type, tube_number, initial_z_height, iterations=5, z_decrement=1):
     tubes = {
         'tube1': tube1,
@@ -371,13 +1263,13 @@ def height_cal(tube_type, tube_number, initial_z_height, iterations=5, z_decreme
     }
 
     if tube_type not in tubes:
-        print(f"-Invalid tube type: {tube_type}. Please choose 'tube1', 'tube2', or 'tube3'.")
+        log(f"-Invalid tube type: {tube_type}. Please choose 'tube1', 'tube2', or 'tube3'.")
         return
 
     tube = tubes[tube_type]
 
-    if tube_number < 1 or tube_number > len(tube['X']):
-        print(f"-Invalid tube number for {tube_type}. Please choose a number between 1 and {len(tube['X'])}.")
+    if tube_number < 1 or tube_number > len(tube.X):
+        log(f"-Invalid tube number for {tube_type}. Please choose a number between 1 and {len(tube.X)}.")
         return
 
     # Adjust for 0-based indexing
@@ -387,11 +1279,11 @@ def height_cal(tube_type, tube_number, initial_z_height, iterations=5, z_decreme
     G1(z=100, feedrate=3000)
 
     # Move to the tube's X and Y coordinates
-    G1(x=tube['X'][index])
-    G1(y=tube['Y'][index])
+    G1(x=tube.X[index])
+    G1(y=tube.Y[index])
 
     # Move to the top of the tube
-    G1(z=tube['top'])
+    G1(z=tube.top)
 
     for i in range(iterations):
         # Calculate the current Z position
@@ -401,18 +1293,235 @@ def height_cal(tube_type, tube_number, initial_z_height, iterations=5, z_decreme
         G1(z=current_z, feedrate=1000)  # Slower feedrate for precision
 
         # Pause briefly
-        print('G4 P500\n')  # Pause for 500ms
+        emit('G4 P500')  # Pause for 500ms
 
         # Move to a safe height
-        safe_height = tube['top'] + 20
+        safe_height = tube.top + 20
         G1(z=safe_height, feedrate=3000)
 
         # Pause and dispense the full volume
-        print('M0 Press button to dispense\n')
+        emit('M0 Press button to dispense')
+
+
+############ Travel Planning Functions ############
+def path_is_clear(x0, y0, x1, y1, z, obstacles=None):
+    """
+    Check that a straight X/Y move at height z does not pass through any labware that is taller than z.
+
+    :param x0: Start X coordinate
+    :param y0: Start Y coordinate
+    :param x1: End X coordinate
+    :param y1: End Y coordinate
+    :param z: Z height of the pipette during the move
+    :param obstacles: Array of obstacles (default is deck_obstacles)
+    :return: True if the move is free of collisions
+    """
+    obstacles = deck_obstacles if obstacles is None else obstacles
+    blocking = obstacles[obstacles[:, 4] > z]
+    if len(blocking) == 0:
+        return True
+
+    # Liang-Barsky clipping of the segment against every blocking footprint at once
+    dx, dy = x1 - x0, y1 - y0
+    t_enter = np.zeros(len(blocking))
+    t_exit = np.ones(len(blocking))
+    for delta, origin, low, high in ((dx, x0, blocking[:, 0], blocking[:, 1]), (dy, y0, blocking[:, 2], blocking[:, 3])):
+        if delta == 0:
+            outside = (origin < low) | (origin > high)
+            t_exit = np.where(outside, -1.0, t_exit)
+        else:
+            t_low, t_high = (low - origin) / delta, (high - origin) / delta
+            t_enter = np.maximum(t_enter, np.minimum(t_low, t_high))
+            t_exit = np.minimum(t_exit, np.maximum(t_low, t_high))
+    return not np.any(t_enter <= t_exit)
+
+
+@with_context
+def travel_xy(x, y, feedrate=None):
+    """
+    Move the pipette to an X/Y position at its current height. A single combined X/Y move is used when the pipette
+    is above every labware on the straight path; otherwise the move falls back to moving X first, then Y.
+
+    :param x: Target X coordinate
+    :param y: Target Y coordinate
+    :param feedrate: Velocity of the motors (default is the travel profile of the tip contents, see travel_feedrate)
+    """
+    position = current_context().position
+    x0, y0, z = position['X'], position['Y'], position['Z']
+    if None not in (x0, y0, z) and path_is_clear(x0, y0, float(x), float(y), z):
+        G1(x=x, y=y, feedrate=feedrate or travel_feedrate('X', 'Y'))
+    else:
+        G1(x=x, feedrate=feedrate or travel_feedrate('X'))  # Move to the X coordinate
+        G1(y=y, feedrate=feedrate or travel_feedrate('Y'))  # Move to the Y coordinate
+
+
+def well_xy(module, well):
+    """
+    Look up the X/Y coordinates of a tube/well location.
+
+    :param module: The module being used (e.g.,tube1, tube2, plate_384_biorad)
+    :param well: The well location (e.g., '1', 'A1')
+    :return: Tuple (x, y)
+    """
+    index = well_index(module, well)
+    if index is None:
+        raise ValueError(f"-Invalid well location for {module.name}: {well}")
+    return float(module.Xf[index]), float(module.Yf[index])
+
+
+def travel_time_matrix(points, feedrate=3000, accel=None):
+    """
+    Estimated travel time between every pair of points for simultaneous X/Y moves, with the motion model of
+    MachineTimeEstimator: the path speed is the feedrate, scaled down until no axis exceeds its limit (M203 and the
+    step rate), and every move accelerates from rest and decelerates to rest. Below the axis limits (F3000 is far
+    below them) the time follows the Euclidean distance, plus the acceleration time that makes hops shorter than
+    feedrate^2 / accel cost more per mm.
+
+    :param points: Array of shape (n, 2) with X/Y coordinates
+    :param feedrate: Travel feedrate in mm/min (default is 3000)
+    :param accel: Acceleration in mm/s^2 (default is the acceleration the estimator assumes before an M204)
+    :return: Array of shape (n, n) with travel times in seconds
+    """
+    from gcode_time_estimator import MachineTimeEstimator  # The estimator imports this module
+
+    estimator = MachineTimeEstimator()
+    accel = accel or estimator.accel
+    points = np.asarray(points, dtype=float)
+    dx = np.abs(points[:, None, 0] - points[None, :, 0])
+    dy = np.abs(points[:, None, 1] - points[None, :, 1])
+    distance = np.hypot(dx, dy)
+    moving = distance > 0
+    speed = np.full(distance.shape, feedrate / 60)
+    for delta, axis in ((dx, 'X'), (dy, 'Y')):
+        # Scale down the path speed until the axis is within its own limit
+        axis_speed = np.divide(speed * delta, distance, out=np.zeros_like(distance), where=moving)
+        limit = estimator.axis_speed_limit(axis)
+        speed = np.where(axis_speed > limit, speed * limit / np.maximum(axis_speed, limit), speed)
+    cruise = distance / speed + speed / accel
+    triangle = 2 * np.sqrt(distance / accel)
+    return np.where(moving, np.where(distance >= speed * speed / accel, cruise, triangle), 0.0)
+
+
+def serpentine_order(points):
+    """
+    Order points in a serpentine (boustrophedon) pattern: one pass along X per row of equal Y, alternating direction
+    so Y is only stepped forward.
+
+    :param points: Array of shape (n, 2) with X/Y coordinates
+    :return: List of indices into points
+    """
+    points = np.asarray(points, dtype=float)
+    lanes = np.round(points[:, 1], 1)
+    order = []
+    for n, lane in enumerate(np.unique(lanes)):
+        members = np.flatnonzero(lanes == lane)
+        members = members[np.argsort(points[members, 0], kind='stable')]
+        order.extend(members[::-1] if n % 2 else members)
+    return [int(i) for i in order]
+
+
+def shortest_order(points, feedrate=3000, accel=None, start=0, max_passes=50):
+    """
+    Order points to minimise the estimated travel time of an open path (see travel_time_matrix), using a
+    nearest-neighbour tour improved by 2-opt segment reversals.
+
+    :param points: Array of shape (n, 2) with X/Y coordinates
+    :param feedrate: Travel feedrate in mm/min (default is 3000)
+    :param accel: Acceleration in mm/s^2, see travel_time_matrix
+    :param start: Index of the point the path has to start at (default is 0)
+    :param max_passes: Maximum number of 2-opt improvement passes (default is 50)
+    :return: List of indices into points
+    """
+    cost = travel_time_matrix(points, feedrate, accel)
+    n = len(cost)
+    if n < 3:
+        return list(range(n)) if start == 0 else [start] + [i for i in range(n) if i != start]
+
+    # Nearest-neighbour construction
+    visited = np.zeros(n, dtype=bool)
+    path = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, cost[path[-1]])
+        nxt = int(np.argmin(row))
+        path.append(nxt)
+        visited[nxt] = True
+    path = np.array(path)
+
+    # 2-opt: reverse path[i + 1:j + 1] whenever that shortens the path (the start point stays fixed)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n - 2):
+            a, b = path[i], path[i + 1]
+            c = path[i + 2:]
+            d = np.append(path[i + 3:], -1)
+            removed = cost[a, b] + np.where(d >= 0, cost[c, d], 0)
+            added = cost[a, c] + np.where(d >= 0, cost[b, d], 0)
+            gain = removed - added
+            j = int(np.argmax(gain))
+            if gain[j] > 1e-9:
+                path[i + 1:i + 3 + j] = path[i + 1:i + 3 + j][::-1]
+                improved = True
+        if not improved:
+            break
+    return [int(i) for i in path]
+
+
+def path_travel_time(points, order=None, feedrate=3000, accel=None):
+    """
+    Estimated travel time for visiting points in the given order.
+
+    :param points: Array of shape (n, 2) with X/Y coordinates
+    :param order: List of indices into points (default is the given order)
+    :param feedrate: Travel feedrate in mm/min (default is 3000)
+    :param accel: Acceleration in mm/s^2, see travel_time_matrix
+    :return: Travel time in seconds
+    """
+    points = np.asarray(points, dtype=float)
+    if order is not None:
+        points = points[list(order)]
+    if len(points) < 2:
+        return 0.0
+    cost = travel_time_matrix(points, feedrate, accel)
+    return float(np.trace(cost, offset=1))
+
+
+def order_well_locations(dispense_modules, well_locations, dispensed_volumes, order='shortest', feedrate=None,
+                         accel=None):
+    """
+    Reorder multi-dispense destinations to reduce travel time. The first destination stays first, so the route
+    still starts where the caller expects it to.
+
+    :param dispense_modules: A list of modules (one per well location)
+    :param well_locations: A list of well locations
+    :param dispensed_volumes: A list of volumes (one per well location)
+    :param order: 'given' (no change), 'serpentine' or 'shortest' (nearest neighbour + 2-opt)
+    :param feedrate: Travel feedrate in mm/min (default is the travel profile of the tip contents, see travel_feedrate)
+    :param accel: Acceleration in mm/s^2 (default is the travel profile of the tip contents)
+    :return: Tuple of reordered lists (dispense_modules, well_locations, dispensed_volumes)
+    """
+    if order == 'given' or len(well_locations) < 3:
+        return dispense_modules, well_locations, dispensed_volumes
+    ctx = current_context()
+    if ctx.motion_model != 'fixed':
+        profile = MOTION_PROFILES[pipette_load(ctx)]
+        feedrate = feedrate or min(profile['X'], profile['Y'])
+        accel = accel or profile['accel']
+    points = np.array([well_xy(module, well) for module, well in zip(dispense_modules, well_locations)])
+    if order == 'serpentine':
+        rest = serpentine_order(points[1:])
+        indices = [0] + [i + 1 for i in rest]
+    elif order == 'shortest':
+        indices = shortest_order(points, feedrate or TRAVEL_FEEDRATE, accel, start=0)
+    else:
+        raise ValueError("-Invalid order. Use 'given', 'serpentine' or 'shortest'.")
+    return ([dispense_modules[i] for i in indices], [well_locations[i] for i in indices],
+            [dispensed_volumes[i] for i in indices])
 
 
 ############ Action Functions ############
-def move_to_well_location(module, well, safe_dist=True, direct=True, feedrate=3000):
+@with_context
+def move_to_well_location(module, well, safe_dist=True, direct=True, feedrate=None):
     """
     Move the pipette to the well top of the tube/well location
 
@@ -420,66 +1529,31 @@ def move_to_well_location(module, well, safe_dist=True, direct=True, feedrate=30
     :param well: The well location (e.g., '1', '2', 'A1')
     :param safe_dist: Boolean to make the Z-axis height safe (Z100)
     :param direct: Boolean to move pipette tips directly to the well location
-    :param feedrate: Velocity of the motors when moving to the new well location (default is 3000)
+    :param feedrate: Velocity of the motors when moving to the new well location (default is the travel profile of
+                     the tip contents, see travel_feedrate)
     """
-    # Check if the input is for a plate well (e.g., 'A1') or a tube well (e.g., '1')
-    if isinstance(well, str) and len(well) >= 2 and well[0].isalpha() and well[1:].isdigit():
-        # Plate well input (e.g., 'A1')
-        row = well[0].upper()
-        col = int(well[1:])
-
-        # Convert row letter to number (A=0, B=1, etc.)
-        row_num = ord(row) - ord('A')
-
-        # Adjust column for 0-based indexing
-        col_num = col - 1
-
-        # Check if the input is within valid range
-        if row_num < 0 or row_num >= 16 or col_num < 0 or col_num >= 24:
-            print(f"-Invalid well position: {well}. Please choose a well between A1 and P24.")
-            return
+    # Look up the well (e.g., 'A1') or tube (e.g., '1') in the module's precomputed index
+    index = well_index(module, well)
+    if index is None:
+        first, last = well_range(module)
+        flag('well', f"-Invalid well location: {well}. Please choose a location between {first} and {last} "
+            f"for {module.name}.")
+        return
 
-        # Move to well location
-        if safe_dist:
-            G1(z=65, feedrate=feedrate)  # Move to a safe height first
+    # Move to well location
+    if safe_dist:
+        G1(z=65, feedrate=feedrate or travel_feedrate('Z'))  # Move to a safe height first
 
-        if direct:
-            G1(x=module['X'][row_num, col_num], y=module['Y'][row_num, col_num],
-               feedrate=feedrate)  # Move directly to the well location
-            G1(z=module['top'])
-        else:
-            G1(x=module['X'][row_num, col_num], feedrate=feedrate)  # Move to the well's X coordinate
-            G1(y=module['Y'][row_num, col_num], feedrate=feedrate)  # Move to the well's Y coordinate
-            G1(z=module['top'], feedrate=feedrate)  # Move down to the top of the well
-
-
-    elif isinstance(well, str) and well.isdigit():
-        # Tube well input (e.g., '1')
-        tube_number = int(well)
-
-        # Check if the tube number is within valid range
-        if tube_number < 1 or tube_number > len(module['X']):
-            print(f"-Invalid tube number: {well}. Please choose a number between 1 and {len(module['X'])}.")
-            return
-
-        # Adjust for 0-based indexing
-        index = tube_number - 1
-
-        # Move to well location
-        if safe_dist:
-            G1(z=65, feedrate=feedrate)  # Move to a safe height first
-        if direct:
-            G1(x=module['X'][index], y=module['Y'][index],
-               feedrate=feedrate)  # Move down to the top of the tube
-            G1(z=module['top'])
-        else:
-            G1(x=module['X'][index], feedrate=feedrate)  # Move to the tube's X coordinate
-            G1(y=module['Y'][index], feedrate=feedrate)  # Move to the tube's Y coordinate
-            G1(z=module['top'], feedrate=feedrate)  # Move down to the top of the tube
+    if direct:
+        # Move directly to the well location
+        G1(x=module.Xf[index], y=module.Yf[index], feedrate=feedrate or travel_feedrate('X', 'Y'))
+        G1(z=module.top)
     else:
-        print(f"-Invalid input format: {well}. Please use format like 'A1' for plate wells or '1' for tube wells.")
+        travel_xy(module.Xf[index], module.Yf[index], feedrate=feedrate)
+        G1(z=module.top, feedrate=feedrate or travel_feedrate('Z'))  # Move down to the top of the well
 
 
+@with_context
 def move_to_liquid_height(module, volume, feedrate=3000):
     """
     Move the pipette to the correct height based on the liquid volume in the specified well.
@@ -489,14 +1563,15 @@ def move_to_liquid_height(module, volume, feedrate=3000):
     :param feedrate: Velocity of the motors when moving to the new liquid height (default is 3000)
     """
     if 'height' in module:
-        z_height = module['height'](volume)
+        z_height = module.height(volume)
     else:
-        print(f"Error: No height correlation defined for module {module}")
+        log(f"Error: No height correlation defined for module {module}")
         return
     # Move to the calculated z-height
     G1(z=z_height, feedrate=feedrate)
 
 
+@with_context
 def preload_volume(module, well_location, volume, custom_name=None):
     """
     Preload a volume into a specific module and well location.
@@ -506,56 +1581,50 @@ def preload_volume(module, well_location, volume, custom_name=None):
     :param volume: Volume to preload in µL
     :param custom_name: Optional custom name for the preloaded volume
     """
-    if 'V' not in module:
-        raise ValueError(f"-Invalid module: {module}. Module must have a 'V' attribute.")
-
-    if isinstance(module['V'], np.ndarray):
-        if module['V'].ndim == 1:  # Tube rack
-            index = int(well_location) - 1
-            if index < 0 or index >= len(module['V']):
-                raise ValueError(f"-Invalid well location for tube rack: {well_location}")
-            module['V'][index] = volume
-        elif module['V'].ndim == 2:  # Plate
-            row = ord(well_location[0].upper()) - ord('A')
-            col = int(well_location[1:]) - 1
-            if row < 0 or row >= module['V'].shape[0] or col < 0 or col >= module['V'].shape[1]:
-                raise ValueError(f"-Invalid well location for plate: {well_location}")
-            module['V'][row, col] = volume
-    else:
-        raise ValueError(f"-Unexpected volume array structure for module")
+    if not isinstance(module, TubeRack):
+        raise ValueError(f"-Invalid module: {module}. Module must be a tube rack or plate.")
+
+    ctx = current_context()
+    module = ctx.labware(module)
+    index = well_index(module, well_location)
+    if index is None:
+        raise ValueError(f"-Invalid well location for {module.name}: {well_location}")
+    module.Vf[index] = volume
+    ctx.contents[(module.name, str(well_location))] = {custom_name} if custom_name and volume > 0 else set()
 
     if custom_name:
-        custom_preloads[custom_name] = {
+        ctx.preloads[custom_name] = {
             'module': module,
             'well_location': well_location,
             'volume': volume
         }
 
-    module_name = module.get('name', 'Unknown module')
-    print(f"-Preloaded {volume} µL in {module_name} at well location {well_location}")
+    module_name = module.name
+    log(f"-Preloaded {volume} µL in {module_name} at well location {well_location}")
     if custom_name:
-        print(f"-Custom name: {custom_name}\n")
+        log(f"-Custom name: {custom_name}")
 
 
+@with_context
 def dead_pump(deadpump_volume=10):
     """
     Aspirate air volume before aspirate liquid
 
     :param deadpump_volume: Volume of the deadpump (default is 10 cm3)
     """
-    global current_deadpump_volume
-
     # Set default deadpump volume
     G1(z=65, feedrate=3000)
     # Aspirate deadpump
     G1(p=0, feedrate=1000)
     G1(p=deadpump_volume, feedrate=1000)
-    current_deadpump_volume = deadpump_volume
+    current_context().deadpump_volume = deadpump_volume
 
 
+@with_context
+@instrumented
 def aspirate_volume(aspirated_volume, custom_name=None, aspiration_module=None, well_location=None,
                     aspiration_height='Z0', height_unit='uL', aspirate_feedrate=500, safe_dist=True, direct=False,
-                    deadpump=True, deadpump_vol=15, air_gap=False, air_gap_vol=5):
+                    deadpump=True, deadpump_vol=15, air_gap=False, air_gap_vol=5, settle=None):
     """
     Aspirate a specified volume from a well location or current position.
 
@@ -570,16 +1639,20 @@ def aspirate_volume(aspirated_volume, custom_name=None, aspiration_module=None,
     :param direct: Boolean to move pipette tips directly to the well location without intermediate steps (default is False).
     :param deadpump: Boolean to determine if deadpump should be used (default is True).
     :param deadpump_vol: Volume for the dead pump operation in μL (default is 15).
-    :param air_gap: Boolean to determine if an air gap should be added after aspiration (default is False).
+    :param air_gap: Boolean to determine if an air gap should be added after aspiration (default is False). It needs
+                    a module to rise to, so not at the current position.
     :param air_gap_vol: Volume of the air gap in μL (default is 5).
+    :param settle: Settle time in seconds after aspirating (default is None: scaled to the volume and feedrate).
     """
-    global current_aspirated_volume, current_deadpump_volume, current_air_gap_volume
+    ctx = current_context()
 
     # Check if a custom-named preloaded volume is being used
-    if custom_name and custom_name in custom_preloads:
-        preload = custom_preloads[custom_name]
+    if custom_name and custom_name in ctx.preloads:
+        preload = ctx.preloads[custom_name]
         aspiration_module = preload['module']
         well_location = preload['well_location']
+    elif aspiration_module is not None:
+        aspiration_module = ctx.labware(aspiration_module)
 
     # Set default deadpump volume
     deadpump_volume = deadpump_vol if deadpump else 0
@@ -591,49 +1664,42 @@ def aspirate_volume(aspirated_volume, custom_name=None, aspiration_module=None,
 
     # If no module or location is specified, aspirate at the current position
     if aspiration_module is None and well_location is None:
-        total_aspirated_volume = aspirated_volume + current_deadpump_volume
+        if air_gap:  # The air gap is drawn at the top of the module, which is unknown here
+            raise ValueError(f"-An air gap needs a module to rise to: no module, location or preload "
+                             f"{custom_name!r} given.")
+        total_aspirated_volume = aspirated_volume + ctx.deadpump_volume
         G1(p=total_aspirated_volume, feedrate=aspirate_feedrate)
-        if air_gap:
-            G1(z=aspiration_module['top'], feedrate=3000)  # Move up to create air gap
-            G1(p=air_gap_volume, feedrate=aspirate_feedrate)
-        print(f'G4 P500\n')  # Pause for 500ms
-        current_aspirated_volume += aspirated_volume
-        current_deadpump_volume = deadpump_volume
-        current_air_gap_volume = air_gap_volume
+        settle_pause(aspirated_volume, aspirate_feedrate, settle, fixed=0.5)
+        ctx.aspirated_volume += aspirated_volume
+        ctx.deadpump_volume = deadpump_volume
+        ctx.air_gap_volume = air_gap_volume
         return
 
     # Move to the well location
-    move_to_well_location(aspiration_module, well_location, safe_dist=safe_dist, direct=direct, feedrate=3000)
+    move_to_well_location(aspiration_module, well_location, safe_dist=safe_dist, direct=direct)
 
     # Get the current volume in the well
-    if isinstance(well_location, str) and well_location[0].isalpha():
-        # For plate wells (e.g., 'A1')
-        row = ord(well_location[0].upper()) - ord('A')
-        col = int(well_location[1:]) - 1
-        current_volume = aspiration_module['V'][row, col]
-    else:
-        # For tube wells (e.g., '1')
-        index = int(well_location) - 1
-        current_volume = aspiration_module['V'][index]
+    index = well_index(aspiration_module, well_location)
+    current_volume = aspiration_module.Vf[index]
 
     # Check if aspirated volume is higher than current volume
     if aspirated_volume > current_volume:
-        print(
-            f"-Note! Cannot aspirate {aspirated_volume} μL from {well_location}. Current volume is only {current_volume} μL.\n")
+        log(
+            f"-Note! Cannot aspirate {aspirated_volume} μL from {well_location}. Current volume is only {current_volume} μL.")
 
     # Calculate aspiration height
     if height_unit == 'mm':
-        adj_aspiration_height = aspiration_height if aspiration_height != 'Z0' else aspiration_module['Z0']
+        adj_aspiration_height = aspiration_height if aspiration_height != 'Z0' else aspiration_module.Z0
     elif height_unit == 'uL':
-        adj_aspiration_height = aspiration_module['height'](aspiration_height) if aspiration_height != 'Z0' else \
-            aspiration_module['Z0']
+        adj_aspiration_height = aspiration_module.height(aspiration_height) if aspiration_height != 'Z0' else \
+            aspiration_module.Z0
     else:
         raise ValueError("-Invalid height unit. Use 'uL' or 'mm'.")
 
     # Aspirate deadpump
     G1(p=0, feedrate=1000)
     G1(p=deadpump_volume, feedrate=500)
-    print(f'G4 P500\n')  # Pause for 500ms
+    air_pause(0.5)
 
     # Move to aspiration height
     G1(z=adj_aspiration_height, feedrate=3000)
@@ -641,53 +1707,52 @@ def aspirate_volume(aspirated_volume, custom_name=None, aspiration_module=None,
     # Aspirate the volume
     total_aspirated_volume = round(aspirated_volume + deadpump_volume, 3)
     G1(p=total_aspirated_volume, feedrate=aspirate_feedrate)
-    print(f'G4 P500\n')  # Pause for 500ms
+    settle_pause(aspirated_volume, aspirate_feedrate, settle, fixed=0.5)
 
-    # Update the volume in the well
-    if isinstance(well_location, str) and well_location[0].isalpha():
-        aspiration_module['V'][row, col] -= aspirated_volume
-        current_volume = aspiration_module['V'][row, col]
-    else:
-        aspiration_module['V'][index] -= aspirated_volume
-        current_volume = aspiration_module['V'][index]
+    # Update the volume in the well; the tip now holds what the well holds
+    aspiration_module.Vf[index] -= aspirated_volume
+    current_volume = aspiration_module.Vf[index]
+    ctx.tip_contents |= ctx.contents.get((aspiration_module.name, str(well_location)), set())
+    if custom_name:
+        ctx.tip_contents.add(custom_name)
 
-    # Update the custom_preloads dictionary if a custom name was used
-    if custom_name and custom_name in custom_preloads:
-        custom_preloads[custom_name]['volume'] = current_volume
+    # Update the named preload if a custom name was used
+    if custom_name and custom_name in ctx.preloads:
+        ctx.preloads[custom_name]['volume'] = current_volume
 
     # Move to a safe height if module is specified
     if aspiration_module is not None:
-        G1(z=aspiration_module['top'], feedrate=3000)
+        G1(z=aspiration_module.top, feedrate=3000)
 
     # Aspirate air gap if enabled
     if air_gap:
         total_aspirated_volume += air_gap_volume
         G1(p=total_aspirated_volume, feedrate=300)
-        print(f'G4 P100\n')  # Pause for 100ms
+        air_pause(0.1)
 
     # Update the current aspirated volume
-    current_aspirated_volume = aspirated_volume
-    current_deadpump_volume = deadpump_volume
-    current_air_gap_volume = air_gap_volume
+    ctx.aspirated_volume = aspirated_volume
+    ctx.deadpump_volume = deadpump_volume
+    ctx.air_gap_volume = air_gap_volume
 
-    # Update the current aspirated volume
-    current_aspirated_volume = aspirated_volume
-    current_deadpump_volume = deadpump_volume
-
-    module_name = aspiration_module.get('name')
+    module_name = aspiration_module.name
     if deadpump:
-        print(f'-Added {deadpump_volume} μL dead pump')
-    print(f'-Aspirated {aspirated_volume} μL from {module_name} location {well_location}')
+        log(f'-Added {deadpump_volume} μL dead pump')
+    log(f'-Aspirated {aspirated_volume} μL from {module_name} location {well_location}')
     if air_gap:
-        print(f'-Added {air_gap_volume} μL air gap')
+        log(f'-Added {air_gap_volume} μL air gap')
 
 
+@with_context
+@instrumented
 def dispense_volume(dispensed_volumes=None, custom_name=None, dispense_modules=None,
                     well_locations=None, safe_dist=True, direct=False, dispense_feedrate=500, blowout=None,
-                    touch_tip=False, dispense_height=None):
+                    touch_tip=False, dispense_height=None, order='given'):
     """
     Dispense specified volumes to a list of well locations across multiple modules, adjusting the height as needed.
     If no module or location is specified, dispense at the current position.
+    :param order: Order of visiting the well locations: 'given' (default), 'serpentine' or 'shortest' (minimises
+                  the estimated X/Y travel time, starting from the first given well location)
     :param dispense_height:
     :param touch_tip: Option to touch tip by the rim of the module to make sure all liquid is dispensed
     :param dispensed_volumes: A list of volumes to dispense in μL corresponding to each well location
@@ -699,7 +1764,7 @@ def dispense_volume(dispensed_volumes=None, custom_name=None, dispense_modules=N
     :param blowout: Blowing out remaining liquid at the tip of the pipette
     :param custom_name: Optional custom name for preloaded volume
     """
-    global current_aspirated_volume, current_deadpump_volume, current_air_gap_volume
+    ctx = current_context()
 
     # Convert single values to lists
     if not isinstance(dispensed_volumes, (list, tuple)):
@@ -708,22 +1773,36 @@ def dispense_volume(dispensed_volumes=None, custom_name=None, dispense_modules=N
         well_locations = [well_locations]
 
     # Check if a custom-named preloaded volume is being used
-    if custom_name and custom_name in custom_preloads:
-        preload = custom_preloads[custom_name]
+    if custom_name and custom_name in ctx.preloads:
+        preload = ctx.preloads[custom_name]
         dispense_modules = [preload['module']]
         well_locations = [[preload['well_location']]]
         current_volume = [[preload['volume']]]
 
     if not isinstance(dispense_modules, list):
         dispense_modules = [dispense_modules]
+    dispense_modules = [ctx.labware(module) if module is not None else None for module in dispense_modules]
     if not isinstance(well_locations, list):
         well_locations = [well_locations]
     if not isinstance(dispensed_volumes, list):
         dispensed_volumes = [dispensed_volumes]
 
+    # Reorder the destinations of a multi-dispense to reduce travel
+    if order != 'given' and not (custom_name and custom_name in ctx.preloads):
+        destinations = []
+        for module, locations, volumes in zip(dispense_modules, well_locations, dispensed_volumes):
+            if not isinstance(locations, list):
+                locations = [locations]
+            if not isinstance(volumes, list):
+                volumes = [volumes]
+            destinations.extend((module, location, volume) for location, volume in zip(locations, volumes))
+        if all(module is not None and location is not None for module, location, _ in destinations):
+            dispense_modules, well_locations, dispensed_volumes = order_well_locations(
+                *(list(column) for column in zip(*destinations)), order=order)
+
     first_move = safe_dist  # Flag to track the first move
 
-    total_volume = current_air_gap_volume + current_aspirated_volume + current_deadpump_volume
+    total_volume = ctx.air_gap_volume + ctx.aspirated_volume + ctx.deadpump_volume
 
     for module, locations, volumes in zip(dispense_modules, well_locations, dispensed_volumes):
         # Ensure locations and volumes are lists
@@ -734,22 +1813,22 @@ def dispense_volume(dispensed_volumes=None, custom_name=None, dispense_modules=N
 
         for well_location, dispensed_volume in zip(locations, volumes):
             # If no dispensed volume is specified, use the current aspirated volume
-            if dispensed_volume == current_aspirated_volume:
-                dispensed_volume = current_aspirated_volume
+            if dispensed_volume == ctx.aspirated_volume:
+                dispensed_volume = ctx.aspirated_volume
             elif dispensed_volume is None:
-                dispensed_volume = current_aspirated_volume
-            elif dispensed_volume > current_aspirated_volume:
-                print(
-                    f"Warning: Attempting to dispense {dispensed_volume} μL, but only {current_aspirated_volume} μL is available.")
-                dispensed_volume = current_aspirated_volume
+                dispensed_volume = ctx.aspirated_volume
+            elif dispensed_volume > ctx.aspirated_volume:
+                flag('dispense', f"Warning: Attempting to dispense {dispensed_volume} μL, but only "
+                                 f"{ctx.aspirated_volume} μL is available.")
+                dispensed_volume = ctx.aspirated_volume
 
             if module is None or well_location is None:
                 # Dispense air gap first if present
-                if current_air_gap_volume > 0:
-                    volume_to_dispense = total_volume - current_air_gap_volume
+                if ctx.air_gap_volume > 0:
+                    volume_to_dispense = total_volume - ctx.air_gap_volume
                     G1(p=volume_to_dispense, feedrate=dispense_feedrate)
-                    total_volume -= current_air_gap_volume
-                    current_air_gap_volume = 0
+                    total_volume -= ctx.air_gap_volume
+                    ctx.air_gap_volume = 0
                 # Dispense the volume
                 volume_to_dispense = total_volume - dispensed_volume
                 G1(p=volume_to_dispense, feedrate=dispense_feedrate)
@@ -763,87 +1842,61 @@ def dispense_volume(dispensed_volumes=None, custom_name=None, dispense_modules=N
                     move_to_well_location(module, well_location, safe_dist=first_move, direct=True)
 
                 # Get the current volume in the well
-                if isinstance(well_location, str) and well_location[0].isalpha():
-                    # For plate wells (e.g., 'A1')
-                    row = ord(well_location[0].upper()) - ord('A')
-                    col = int(well_location[1:]) - 1
-                    current_volume = module['V'][row, col]
-                else:
-                    # For tube wells (e.g., '1')
-                    index = int(well_location) - 1
-                    current_volume = module['V'][index]
+                index = well_index(module, well_location)
+                current_volume = module.Vf[index]
 
                 # Calculate the dispensing height
                 if dispense_height is None:
-                    if isinstance(module, dict) and module.get('name') == '384-well plate (BioRad)':
-                        # For 384-well plate, set dispensing height 0.5 mm above liquid surface
-                        if current_volume > 0:
-                            dispensing_height = module['height'](current_volume) + 0.5
-                        else:
-                            dispensing_height = module['Z0'] + 1
+                    # Dispense just above the liquid surface (0.5 mm for 384-well plates, 1.5 mm otherwise)
+                    if current_volume > 0:
+                        dispensing_height = module.height(current_volume) + module.dispense_offset
                     else:
-                        # For other modules, keep the existing logic
-                        if current_volume > 0:
-                            dispensing_height = module['height'](current_volume) + 1.5  # 1.5mm above the liquid surface
-                        else:
-                            dispensing_height = module['Z0'] + 1  # 1mm above the Z0 of the empty well
+                        dispensing_height = module.Z0 + 1  # 1mm above the Z0 of the empty well
                 else:
-                    dispensing_height = module['height'](dispense_height)
+                    dispensing_height = module.height(dispense_height)
                 # Move to the initial dispensing height
                 G1(z=dispensing_height, feedrate=3000)
 
                 # Dispense air gap first if present
-                if current_air_gap_volume > 0:
-                    volume_to_dispense = total_volume - current_air_gap_volume
+                if ctx.air_gap_volume > 0:
+                    volume_to_dispense = total_volume - ctx.air_gap_volume
                     G1(p=volume_to_dispense, feedrate=dispense_feedrate)
-                    total_volume -= current_air_gap_volume
-                    current_air_gap_volume = 0
+                    total_volume -= ctx.air_gap_volume
+                    ctx.air_gap_volume = 0
                 # Dispense the volume
                 volume_to_dispense = total_volume - dispensed_volume
                 G1(p=volume_to_dispense, feedrate=dispense_feedrate)
                 total_volume -= dispensed_volume
 
-                # Update the volume in the well
-                if isinstance(well_location, str) and well_location[0].isalpha():
-                    module['V'][row, col] += dispensed_volume
-                    current_volume = module['V'][row, col]
-                else:
-                    module['V'][index] += dispensed_volume
-                    current_volume = module['V'][index]
+                # Update the volume and reagents in the well
+                module.Vf[index] += dispensed_volume
+                current_volume = module.Vf[index]
+                ctx.contents.setdefault((module.name, str(well_location)), set()).update(ctx.tip_contents)
 
-                if custom_name and custom_name in custom_preloads:
-                    custom_preloads[custom_name]['volume'] = current_volume
+                if custom_name and custom_name in ctx.preloads:
+                    ctx.preloads[custom_name]['volume'] = current_volume
 
             # Update the current aspirated volume
-            current_aspirated_volume -= dispensed_volume
+            ctx.aspirated_volume -= dispensed_volume
 
             # Perform blowout with the deadpump volume if specified
-            if blowout and current_deadpump_volume > 0:
-                if isinstance(module, dict) and module.get('name') == '384-well plate (BioRad)':
-                    # For 384-well plate, set dispensing height 1 mm above liquid surface
-                    if current_volume > 0:
-                        blowout_height = module['height'](current_volume) + 0.5
-                    else:
-                        blowout_height = module['Z0'] + 1
+            if blowout and ctx.deadpump_volume > 0:
+                # Blow out at the dispensing offset above the liquid surface
+                if current_volume > 0:
+                    blowout_height = module.height(current_volume) + module.dispense_offset
                 else:
-                    # For other modules, keep the existing logic
-                    if current_volume > 0:
-                        blowout_height = module['height'](current_volume) + 1.5  # 1.5mm above the liquid surface
-                    else:
-                        blowout_height = module['Z0'] + 1  # 1mm above the Z0 of the empty well
+                    blowout_height = module.Z0 + 1  # 1mm above the Z0 of the empty well
                 G1(z=blowout_height, feedrate=3000)
                 G1(p=0, feedrate=1000)  # Dispense the remaining liquid
-                current_deadpump_volume = 0
+                ctx.deadpump_volume = 0
 
             if touch_tip:
                 # Perform touch tip by moving in a circular path around the inner radius of the module
-                x_start = module['X'][row, col] if isinstance(well_location, str) and well_location[0].isalpha() else \
-                    module['X'][index]
-                radius = module['radius']
+                x_start = module.Xf[index]
+                radius = module.radius
                 x_start -= radius
-                y_start = module['Y'][row, col] if isinstance(well_location, str) and well_location[0].isalpha() else \
-                    module['Y'][index]
-                touch_tip_height = module['top'] - 2  # 2mm below the top
+                y_start = module.Yf[index]
+                touch_tip_height = module.top - 2  # 2mm below the top
 
                 # Move to specified Z height
                 G1(z=touch_tip_height, feedrate=3000)
@@ -856,14 +1909,16 @@ def dispense_volume(dispensed_volumes=None, custom_name=None, dispense_modules=N
 
             # Move to a safe height if module is specified
             if module is not None:
-                G1(z=module['top'], feedrate=3000)
-                module_name = module['name']
-                print(f'-Dispensed {dispensed_volume} μL to {module_name} location {well_location}')
+                G1(z=module.top, feedrate=3000)
+                module_name = module.name
+                log(f'-Dispensed {dispensed_volume} μL to {module_name} location {well_location}')
 
 
+@with_context
+@instrumented
 def mix(num_cycles, mix_volume=None, custom_name=None, module=None, well_location=None, mix_height=None, deadpump=True,
         blowout=True,
-        aspirate_feedrate=2500, dispense_feedrate=2500, safe_dist=True, direct=False, deadpump_vol=10):
+        aspirate_feedrate=2500, dispense_feedrate=2500, safe_dist=True, direct=False, deadpump_vol=10, settle=None):
     """
     Perform mixing operation in a specified plate well or tube.
 
@@ -880,12 +1935,13 @@ def mix(num_cycles, mix_volume=None, custom_name=None, module=None, well_locatio
     :param safe_dist: Boolean to make the Z-axis height safe before moving to the well location (default is True).
     :param direct: Boolean to move pipette tips directly to the well location without intermediate steps (default is False).
     :param deadpump_vol: Volume for the dead pump operation in μL (default is 10).
+    :param settle: Settle time in seconds after each plunger stroke (default is None: scaled to the volume and feedrate).
     """
-    global custom_preloads
+    preloads = current_context().preloads
 
     # Check if a custom-named preloaded volume is being used
-    if custom_name and custom_name in custom_preloads:
-        preload = custom_preloads[custom_name]
+    if custom_name and custom_name in preloads:
+        preload = preloads[custom_name]
         module = preload['module']
         well_location = preload['well_location']
         well_vol = preload['volume']
@@ -908,9 +1964,12 @@ def mix(num_cycles, mix_volume=None, custom_name=None, module=None, well_locatio
 
     # Calculate mixing height
     if mix_height is None:
-        adj_mix_height = module['Z0'] + 0.5  # 0.5 mm above bottom of the well/tube
+        adj_mix_height = module.Z0 + 0.5  # 0.5 mm above bottom of the well/tube
     else:
-        adj_mix_height = module['height'](mix_height)
+        adj_mix_height = module.height(mix_height)
+
+    if mix_volume > 95:
+        flag('mix_volume', f"-Mix volume {mix_volume} μL is more than a 95 μL stroke; mixing 95 μL instead.")
 
     # Perform mixing cycles
     for i in range(num_cycles):
@@ -923,34 +1982,30 @@ def mix(num_cycles, mix_volume=None, custom_name=None, module=None, well_locatio
             adj_mix_volume = mix_volume
         adj_mix_volume += deadpump_volume
         G1(p=adj_mix_volume, feedrate=aspirate_feedrate)
-        lag = 1
-        print(f'G4 P{lag * 1000}\n')  # G4 P<duration in milliseconds>
         adj_mix_volume -= deadpump_volume
+        settle_pause(adj_mix_volume, aspirate_feedrate, settle, fixed=1)
         dispense_height = well_vol - adj_mix_volume
-        adj_dispense_height = module['height'](dispense_height)
+        adj_dispense_height = module.height(dispense_height)
         G1(z=adj_dispense_height, feedrate=3000)
         # Dispense
         G1(p=deadpump_volume, feedrate=dispense_feedrate)
-        lag = 1
-        print(f'G4 P{lag * 1000}\n')  # G4 P<duration in milliseconds>
+        settle_pause(adj_mix_volume, dispense_feedrate, settle, fixed=1)
 
     if blowout and deadpump_volume > 0:
-        if isinstance(module, dict) and module.get('name') == '384-well plate (BioRad)':
-            # For 384-well plate, set dispensing height 1 mm above liquid surface
-            blowout_height = module['height'](mix_volume) + 1
-        else:
-            # For tubes, set dispensing height 2 mm above liquid surface
-            blowout_height = module['height'](mix_volume) + 2
+        # Blow out above the liquid surface (1 mm for 384-well plates, 2 mm otherwise)
+        blowout_height = module.height(mix_volume) + module.mix_blowout_offset
         G1(z=blowout_height, feedrate=3000)
         G1(p=0, feedrate=1000)  # Dispense the remaining liquid
     # Move to a safe height
-    G1(z=module['top'], feedrate=3000)
+    G1(z=module.top, feedrate=3000)
 
     adj_mix_volume -= deadpump_volume
-    module_name = module.get('name')
-    print(f"-Mixed {adj_mix_volume} μL in {module_name} location {well_location} for {num_cycles} cycles")
+    module_name = module.name
+    log(f"-Mixed {adj_mix_volume} μL in {module_name} location {well_location} for {num_cycles} cycles")
 
 
+@with_context
+@instrumented
 def heat(temperature, duration, height_adj=0, safe_dist=True, direct=False):
     """
     Heats pipette tips to a specified temperature and incubates for a given duration.
@@ -968,26 +2023,27 @@ def heat(temperature, duration, height_adj=0, safe_dist=True, direct=False):
     if direct:
         G1(x=pipette_heater['X'], y=pipette_heater['Y'], z=pipette_heater['top'], feedrate=3000)
     else:
-        G1(x=pipette_heater['X'], feedrate=3000)  # Move to the heater's X coordinate
-        G1(y=pipette_heater['Y'])  # Move to the heater's Y coordinate
+        travel_xy(pipette_heater['X'], pipette_heater['Y'])
         G1(z=pipette_heater['top'])  # Move down to the top of the heater
 
     # Heat to the specified temperature and wait until it reaches the temperature
-    print(f'M190 S{temperature}\n')
+    emit(f'M190 S{temperature}')
 
     # Pipette heating location
     G1(z=pipette_heater['bottom'] + height_adj)
 
     # Incubate for the specified duration
-    print(f'G4 P{duration * 1000}\n')  # G4 P<duration in milliseconds>
+    emit(f'G4 P{duration * 1000}')  # G4 P<duration in milliseconds>
 
     # Set the temperature to room temperature (assuming room temperature is 25°C)
-    print('M140 S22\n')
+    emit('M140 S22')
 
     # Move to a safe height after heating
     G1(z=65, feedrate=3000)
 
 
+@with_context
+@instrumented
 def pipette_pellet(feedrate=100, pellet_duration=60,  # Duration in seconds
                    custom_name=None, module=None, location=None, safe_dist=True, direct=False, touch_tip=False,
                    pellet_height='Z0',  # 12.2 suggested pellet height
@@ -1017,8 +2073,9 @@ def pipette_pellet(feedrate=100, pellet_duration=60,  # Duration in seconds
     """
 
     # Check if a custom-named preloaded volume is being used
-    if custom_name and custom_name in custom_preloads:
-        preload = custom_preloads[custom_name]
+    preloads = current_context().preloads
+    if custom_name and custom_name in preloads:
+        preload = preloads[custom_name]
         module = preload['module']
         location = preload['well_location']
 
@@ -1035,32 +2092,31 @@ def pipette_pellet(feedrate=100, pellet_duration=60,  # Duration in seconds
         G1(z=65, feedrate=3000)  # Move to a safe height first
         if action == 'aspirate' and deadpump:
             dead_pump()
-    x_coord = module['X'][int(location) - 1]
-    y_coord = module['Y'][int(location) - 1]
+    x_coord = module.X[int(location) - 1]
+    y_coord = module.Y[int(location) - 1]
     if direct:
         G1(x=x_coord, y=y_coord, feedrate=3000)
     else:
-        G1(x=x_coord, feedrate=3000)
-        G1(y=y_coord)
+        travel_xy(x_coord, y_coord)
 
     # Move to the Z location of 35.2
     G1(z=35.2, feedrate=3000)
 
     # Move to the bottom of the well
     if pellet_height == 'Z0':
-        pellet_height = module['Z0'] + 2
+        pellet_height = module.Z0 + 2
     G1(z=pellet_height, feedrate=feedrate)
 
     # Pellet beads for specified duration
-    print(f'G4 P{pellet_duration * 1000}\n')  # G4 P<duration in milliseconds>
+    emit(f'G4 P{pellet_duration * 1000}')  # G4 P<duration in milliseconds>
 
     if double_pellet:
         G1(z=double_pellet_height, feedrate=3000)
         # Pellet beads for specified duration
-        print(f'G4 P{double_pellet_duration * 1000}\n')  # G4 P<duration in milliseconds>
+        emit(f'G4 P{double_pellet_duration * 1000}')  # G4 P<duration in milliseconds>
 
     if action == 'aspirate':
-        G1(z=module['Z0'], feedrate=3000)
+        G1(z=module.Z0, feedrate=3000)
         aspirate_volume(volume, aspirate_feedrate=action_feedrate)
         G1(z=12.2, feedrate=100)
 
@@ -1068,20 +2124,20 @@ def pipette_pellet(feedrate=100, pellet_duration=60,  # Duration in seconds
         if double_pellet:
             G1(p=initial_dispense_vol, feedrate=500)
             G1(p=10, feedrate=50)
-            G1(z=module['top'] - 5)
+            G1(z=module.top - 5)
             G1(p=0, feedrate=1000)
         else:
             G1(p=initial_dispense_vol, feedrate=50)
             G1(p=10, feedrate=500)
-            G1(z=module['top'] - 5)
+            G1(z=module.top - 5)
             G1(p=0, feedrate=1000)
         if touch_tip:
             # Perform touch tip by moving in a circular path around the inner radius of the module
-            x_start = module['X'][int(location) - 1]
-            radius = module['radius']
+            x_start = module.X[int(location) - 1]
+            radius = module.radius
             x_start -= radius
-            y_start = module['Y'][int(location) - 1]
-            touch_tip_height = module['top'] - 2  # 2mm below the top
+            y_start = module.Y[int(location) - 1]
+            touch_tip_height = module.top - 2  # 2mm below the top
 
             # Move to specified Z height
             G1(z=touch_tip_height, feedrate=3000)
@@ -1092,12 +2148,14 @@ def pipette_pellet(feedrate=100, pellet_duration=60,  # Duration in seconds
             x_center = x_start + radius
             G1(x=x_center, feedrate=3000)
 
-    G1(z=module['top'], feedrate=3000)
+    G1(z=module.top, feedrate=3000)
 
-    print(f"-Pipette pelletted module {module['name']} at location {location} with feedrate {feedrate}.")
+    log(f"-Pipette pelletted module {module.name} at location {location} with feedrate {feedrate}.")
 
 
-def pipette_mix(num_cycles, lower_limit=50, upper_limit=100, mix_feedrate=1000):
+@with_context
+@instrumented
+def pipette_mix(num_cycles, lower_limit=50, upper_limit=100, mix_feedrate=1000, settle=None):
     """
     Perform a mixing operation inside of the pipette (to dislodge beads) between specified limits for a given number of cycles.
 
@@ -1105,15 +2163,183 @@ def pipette_mix(num_cycles, lower_limit=50, upper_limit=100, mix_feedrate=1000):
     :param lower_limit: The lower limit of the pipette movement during mixing (default is 50).
     :param upper_limit: The upper limit of the pipette movement during mixing (default is 100).
     :param mix_feedrate: The speed at which the pipette should move during mixing (default is 1000).
+    :param settle: Settle time in seconds after each stroke (default is None: scaled to the volume and feedrate).
     """
 
     for i in range(num_cycles):
         G1(p=lower_limit, feedrate=mix_feedrate)
-        print(f'G4 P500\n')  # lag
+        settle_pause(upper_limit - lower_limit, mix_feedrate, settle, fixed=0.5)
         G1(p=upper_limit, feedrate=mix_feedrate)
-        print(f'G4 P500\n')  # lag
+        settle_pause(upper_limit - lower_limit, mix_feedrate, settle, fixed=0.5)
+
+
+############ Transfer Planning Functions ############
+
+def resolve_destination(destination, destination_module=None):
+    """
+    Resolve a transfer destination to (module, well_location, custom_name).
+
+    :param destination: A custom name from preload_volume(), a (module, well_location) tuple, or a well location on
+                        destination_module
+    :param destination_module: Module used for destinations given as a plain well location
+    """
+    if isinstance(destination, tuple):
+        module, well_location = destination
+        return module, well_location, None
+    preloads = current_context().preloads
+    if destination in preloads:
+        preload = preloads[destination]
+        return preload['module'], preload['well_location'], destination
+    if destination_module is None:
+        raise ValueError(f"-Unknown transfer destination {destination!r}: not a custom name and no module given.")
+    return destination_module, destination, None
+
+
+def aspiration_capacity(tips=E1_yellow_tips, working_volume=None, excess_vol=0, deadpump=True, deadpump_vol=15,
+                        air_gap=False, air_gap_vol=5):
+    """
+    Volume one aspiration can dispense: the tip working volume less the excess, the dead pump and the air gap.
+
+    :param tips: Tip rack in use, provides the working volume (default is E1_yellow_tips)
+    :param working_volume: Override of the tip working volume in μL
+    :param excess_vol: Extra volume aspirated on top of each batch and not dispensed (default is 0)
+    :param deadpump: Boolean to determine if deadpump is used (default is True)
+    :param deadpump_vol: Volume of the dead pump in μL (default is 15)
+    :param air_gap: Boolean to determine if an air gap is added after aspiration (default is False)
+    :param air_gap_vol: Volume of the air gap in μL (default is 5)
+    :return: Volume in μL
+    """
+    if working_volume is None:
+        working_volume = tips.working_volume
+    capacity = working_volume - excess_vol - (deadpump_vol if deadpump else 0) - (air_gap_vol if air_gap else 0)
+    if capacity <= 0:
+        raise ValueError(f"-Tip working volume of {working_volume} μL leaves no room for liquid.")
+    return capacity
+
+
+@with_context
+def plan_transfers(transfers, tips=E1_yellow_tips, working_volume=None, destination_module=None, excess_vol=0,
+                   deadpump=True, deadpump_vol=15, air_gap=False, air_gap_vol=5):
+    """
+    Pack a list of transfers into as few aspirations as possible.
+
+    Transfers are grouped by source and packed first-fit decreasing, so that every aspiration (dispensed volumes +
+    excess + dead pump + air gap) fits in the working volume of the tip. A transfer larger than a single aspiration
+    is split into equal parts. Within an aspiration the dispenses keep the order in which they were given.
+
+    :param transfers: List of (source, destination, volume) tuples; source is a custom name from preload_volume(),
+                      destination is a custom name, a (module, well_location) tuple or a well location on
+                      destination_module
+    :param tips: Tip rack in use, provides the working volume (default is E1_yellow_tips)
+    :param working_volume: Override of the tip working volume in μL
+    :param destination_module: Module used for destinations given as a plain well location
+    :param excess_vol: Extra volume aspirated on top of each batch and not dispensed (default is 0)
+    :param deadpump: Boolean to determine if deadpump is used (default is True)
+    :param deadpump_vol: Volume of the dead pump in μL (default is 15)
+    :param air_gap: Boolean to determine if an air gap is added after aspiration (default is False)
+    :param air_gap_vol: Volume of the air gap in μL (default is 5)
+    :return: List of batches, each a dictionary with the 'source', the aspirated 'volume' (including the excess) and
+             the 'dispenses' as a list of (module, well_location, volume, custom_name) tuples
+    """
+    capacity = aspiration_capacity(tips, working_volume, excess_vol, deadpump, deadpump_vol, air_gap, air_gap_vol)
+
+    # Group the transfers by source, keeping the sources in order of first use
+    groups = {}
+    for n, (source, destination, volume) in enumerate(transfers):
+        if source not in current_context().preloads:
+            raise ValueError(f"-Unknown transfer source {source!r}: use preload_volume() to name it first.")
+        if volume <= 0:
+            continue
+        module, well_location, custom_name = resolve_destination(destination, destination_module)
+        parts = int(np.ceil(round(volume / capacity, 9)))
+        groups.setdefault(source, []).extend(
+            (n, module, well_location, volume / parts if parts > 1 else volume, custom_name) for _ in range(parts))
+
+    plan = []
+    for source, dispenses in groups.items():
+        # First-fit decreasing bin packing
+        batches = []
+        for dispense in sorted(dispenses, key=lambda d: (-d[3], d[0])):
+            for batch in batches:
+                if batch['free'] >= dispense[3] - 1e-9:
+                    batch['dispenses'].append(dispense)
+                    batch['free'] -= dispense[3]
+                    break
+            else:
+                batches.append({'free': capacity - dispense[3], 'dispenses': [dispense]})
+        batches.sort(key=lambda batch: min(d[0] for d in batch['dispenses']))
+        for batch in batches:
+            dispenses = [d[1:] for d in sorted(batch['dispenses'], key=lambda d: d[0])]
+            plan.append({
+                'source': source,
+                'volume': round(sum(d[2] for d in dispenses) + excess_vol, 3),
+                'dispenses': dispenses,
+            })
+    return plan
+
+
+@with_context
+def run_transfers(transfers, tips=E1_yellow_tips, working_volume=None, destination_module=None, excess_vol=0,
+                  deadpump=True, deadpump_vol=15, air_gap=False, air_gap_vol=5, aspirate_feedrate=500,
+                  dispense_feedrate=500, direct=False, blowout=None, touch_tip=False, order='given'):
+    """
+    Plan a list of transfers with plan_transfers() and pipette them with aspirate_volume() and dispense_volume().
+    The tip is not changed: call new_tip() before and eject() after.
+
+    :param transfers: List of (source, destination, volume) tuples, see plan_transfers()
+    :param tips: Tip rack in use, provides the working volume (default is E1_yellow_tips)
+    :param working_volume: Override of the tip working volume in μL
+    :param destination_module: Module used for destinations given as a plain well location
+    :param excess_vol: Extra volume aspirated on top of each batch and not dispensed (default is 0)
+    :param deadpump: Boolean to determine if deadpump is used (default is True)
+    :param deadpump_vol: Volume of the dead pump in μL (default is 15)
+    :param air_gap: Boolean to determine if an air gap is added after aspiration (default is False)
+    :param air_gap_vol: Volume of the air gap in μL (default is 5)
+    :param aspirate_feedrate: Velocity of aspiration (default is 500)
+    :param dispense_feedrate: Velocity of dispense (default is 500)
+    :param direct: Boolean to move directly to the first destination of each batch (default is False)
+    :param blowout: Blow out after dispensing; True, False/None, or 'last' to blow out only on the last batch of
+                    each source
+    :param touch_tip: Touch tip after dispensing; True, False, or 'last' to touch tip only on the last batch of each
+                      source
+    :param order: Order of visiting the destinations of a batch: 'given' (default), 'serpentine' or 'shortest'
+    :return: The plan that was executed, see plan_transfers()
+    """
+    plan = plan_transfers(transfers, tips=tips, working_volume=working_volume, destination_module=destination_module,
+                          excess_vol=excess_vol, deadpump=deadpump, deadpump_vol=deadpump_vol, air_gap=air_gap,
+                          air_gap_vol=air_gap_vol)
+
+    for n, batch in enumerate(plan):
+        source = batch['source']
+        next_source = plan[n + 1]['source'] if n + 1 < len(plan) else None
+        last = next_source != source
+
+        aspirate_volume(batch['volume'], custom_name=source, aspirate_feedrate=aspirate_feedrate, deadpump=deadpump,
+                        deadpump_vol=deadpump_vol, air_gap=air_gap, air_gap_vol=air_gap_vol)
+
+        options = dict(direct=direct, dispense_feedrate=dispense_feedrate,
+                       blowout=last if blowout == 'last' else blowout,
+                       touch_tip=last if touch_tip == 'last' else touch_tip)
+        dispenses = batch['dispenses']
+        if len(dispenses) == 1 and dispenses[0][3] is not None:
+            dispense_volume(dispenses[0][2], custom_name=dispenses[0][3], **options)
+        else:
+            modules, well_locations, volumes, names = (list(column) for column in zip(*dispenses))
+            dispense_volume(volumes, dispense_modules=modules, well_locations=well_locations, order=order, **options)
+            # Keep the named preloads in step with the wells they point to
+            for module, well_location, _, name in dispenses:
+                if name is not None:
+                    preload = current_context().preloads[name]
+                    preload['volume'] = preload['module'].Vf[well_index(module, well_location)]
+
+        # Return the excess to its source before the tip moves on to another liquid
+        if excess_vol and next_source is not None and next_source != source:
+            dispense_volume(custom_name=source, direct=True)
+
+    return plan
 
 
+@with_context
 def end():
     G1(z=65, feedrate=3000)
     G1(x=10)
@@ -0,0 +1,275 @@
+"""
+Peephole optimizer for generated PALH G-code.
+
+Tracks the machine position and the modal feedrate while walking the stream and removes commands that do nothing:
+    - moves to the position the machine is already at (e.g. back-to-back "G1 Z65 F3000" lines)
+    - axis words that repeat the current position of that axis
+    - F words that repeat the current modal feedrate
+    - M204 lines that repeat the current acceleration
+Back-to-back G4 dwells are merged into one G4 with the summed duration.
+Consecutive single-axis moves on the same axis are collapsed into one when they keep the same direction and
+feedrate, so the machine does not stop in between. Moves that reverse direction are always kept: they may be
+deliberate (pushing on a tip, the ejector stroke).
+
+Usage:
+    python gcode_optimizer.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode -o optimized.gcode --report
+"""
+import argparse
+
+from gcode_time_estimator import AXES, estimate_runtime, parse_line
+
+SYNC_COMMANDS = ('G2', 'G3', 'G4', 'G28', 'M0', 'M1', 'M140', 'M190')  # commands the optimizer never removes
+
+
+def _split_words(line):
+    """Split a G-code line into its command and the list of (letter, text) words, keeping the original formatting."""
+    tokens = line.split()
+    return tokens[0].upper(), [(token[0].upper(), token[1:]) for token in tokens[1:]]
+
+
+def _join_words(command, words):
+    return ' '.join([command] + [letter + text for letter, text in words])
+
+
+class _Move:
+    """A single-axis move that is still open to being collapsed with the next one."""
+
+    __slots__ = ('index', 'axis', 'start', 'target', 'feedrate', 'emitted_feedrate')
+
+    def __init__(self, index, axis, start, target, feedrate, emitted_feedrate):
+        self.index = index
+        self.axis = axis
+        self.start = start
+        self.target = target
+        self.feedrate = feedrate
+        self.emitted_feedrate = emitted_feedrate
+
+
+class PeepholeOptimizer:
+    """
+    Remove redundant and no-op moves from a G-code stream.
+
+    :param collapse: Collapse consecutive same-direction moves on the same axis (default is True)
+    """
+
+    def __init__(self, collapse=True):
+        self.collapse = collapse
+        self.position = {axis: None for axis in AXES}  # None until the axis is homed or moved to an absolute value
+        self.feedrate = None  # Modal feedrate the machine should be using
+        self.emitted_feedrate = None  # Feedrate the machine is actually using (F words are emitted lazily)
+        self.accel = None
+        self.output = []
+        self._open_move = None
+        self._dwell = None  # (output index, milliseconds) of the last G4 with a duration
+
+    def _move(self, command, words):
+        feed_text = None
+        targets = []
+        for letter, text in words:
+            if letter == 'F':
+                feed_text = text
+            elif letter in self.position:
+                targets.append((letter, text, float(text)))
+        if feed_text is not None:
+            self.feedrate = float(feed_text)
+
+        kept = [(axis, text, value) for axis, text, value in targets if self.position[axis] != value]
+        if not kept:
+            return  # Nothing moves; a feedrate change is carried over to the next move
+
+        # Collapse with the previous single-axis move if it goes the same way at the same feedrate
+        previous = self._open_move
+        if (self.collapse and previous is not None and len(kept) == 1 and kept[0][0] == previous.axis
+                and self.output and len(self.output) - 1 == previous.index and self.feedrate == previous.feedrate):
+            axis, text, value = kept[0]
+            if (previous.target - previous.start) * (value - previous.target) > 0:
+                self.output.pop()
+                self.emitted_feedrate = previous.emitted_feedrate
+                self.position[axis] = previous.start
+
+        start = {axis: self.position[axis] for axis, _, _ in kept}
+        emitted_before = self.emitted_feedrate
+        line_words = [(axis, text) for axis, text, _ in kept]
+        if self.feedrate is not None and self.feedrate != self.emitted_feedrate:
+            line_words.append(('F', _format_feedrate(self.feedrate, feed_text)))
+            self.emitted_feedrate = self.feedrate
+        for axis, _, value in kept:
+            self.position[axis] = value
+        self.output.append(_join_words(command, line_words))
+
+        if len(kept) == 1 and kept[0][0] in start and start[kept[0][0]] is not None:
+            axis = kept[0][0]
+            self._open_move = _Move(len(self.output) - 1, axis, start[axis], self.position[axis], self.feedrate,
+                                    emitted_before)
+        else:
+            self._open_move = None
+
+    def feed(self, line):
+        """
+        Process one line of G-code.
+
+        :param line: The G-code line
+        """
+        stripped = line.strip()
+        command, parsed = parse_line(stripped)
+        if command is None:
+            return
+        if command in ('G0', 'G1'):
+            self._move(command, _split_words(stripped.split(';', 1)[0])[1])
+            return
+
+        self._open_move = None
+        if command == 'M204':
+            accel = parsed.get('S') or parsed.get('T') or parsed.get('P')
+            if accel is not None and accel == self.accel:
+                return
+            self.accel = accel
+        elif command in ('G2', 'G3'):
+            if parsed.get('F'):
+                self.feedrate = self.emitted_feedrate = parsed['F']
+            elif self.feedrate != self.emitted_feedrate:
+                # The arc would otherwise run at a stale feedrate
+                stripped = f'{stripped} F{_format_feedrate(self.feedrate)}'
+                self.emitted_feedrate = self.feedrate
+            for axis in ('X', 'Y'):
+                if parsed.get(axis) is not None:
+                    self.position[axis] = parsed[axis]
+        elif command == 'G28':
+            for axis in [axis for axis in AXES if axis in parsed] or AXES:
+                self.position[axis] = 0.0
+        elif command == 'G4':
+            milliseconds = _dwell_milliseconds(parsed)
+            if milliseconds is not None:
+                if self._dwell is not None and self._dwell[0] == len(self.output) - 1:
+                    milliseconds += self._dwell[1]
+                    self.output[-1] = f'G4 P{_format_feedrate(milliseconds)}'
+                    self._dwell = (len(self.output) - 1, milliseconds)
+                    return
+                self._dwell = (len(self.output), milliseconds)
+        self.output.append(stripped)
+
+    def feed_lines(self, lines):
+        for line in lines:
+            self.feed(line)
+        return self.output
+
+
+def _format_feedrate(value, text=None):
+    if text is not None:
+        return text
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+
+def _dwell_milliseconds(words):
+    """Duration of a parsed G4 in milliseconds (P is milliseconds, S seconds), or None without a duration."""
+    if words.get('P') is not None:
+        return words['P']
+    if words.get('S') is not None:
+        return words['S'] * 1000
+    return None
+
+
+def replay_positions(lines):
+    """
+    Replay a G-code stream and record where the machine is at every synchronisation point (dwells, pauses, heater
+    commands, arcs and homing, which the optimizer never removes) and at the end of the stream. Back-to-back dwells
+count as one synchronisation point, because the optimizer merges them.
+
+    :param lines: Iterable of G-code lines
+    :return: Tuple (sync_points, final_position); sync_points is a list of (command, position) tuples
+    """
+    position = {axis: None for axis in AXES}
+    sync_points = []
+    dwell = False  # Whether the last command that did something was a G4 with a duration
+    for line in lines:
+        command, words = parse_line(line)
+        if command is None:
+            continue
+        if command in ('G0', 'G1'):
+            moved = {axis: words[axis] for axis in AXES if words.get(axis) is not None and position[axis] != words[axis]}
+            position.update(moved)
+            dwell = dwell and not moved
+            continue
+        is_dwell = command == 'G4' and _dwell_milliseconds(words) is not None
+        merged = dwell and is_dwell
+        dwell = is_dwell
+        if merged:
+            continue
+        if command in ('G2', 'G3'):
+            for axis in AXES:
+                if words.get(axis) is not None:
+                    position[axis] = words[axis]
+        elif command == 'G28':
+            for axis in [axis for axis in AXES if axis in words] or AXES:
+                position[axis] = 0.0
+        if command in SYNC_COMMANDS:
+            sync_points.append((command, dict(position)))
+    return sync_points, position
+
+
+def verify_equivalent(original, optimized):
+    """
+    Check that an optimized stream leaves the machine in the same place as the original, both at every
+    synchronisation point and at the end.
+
+    :param original: List of original G-code lines
+    :param optimized: List of optimized G-code lines
+    :return: List of mismatch descriptions (empty if the streams are equivalent)
+    """
+    original_sync, original_final = replay_positions(original)
+    optimized_sync, optimized_final = replay_positions(optimized)
+    mismatches = []
+    if len(original_sync) != len(optimized_sync):
+        mismatches.append(f'{len(original_sync)} synchronisation points before, {len(optimized_sync)} after')
+    for n, (before, after) in enumerate(zip(original_sync, optimized_sync)):
+        if before != after:
+            mismatches.append(f'Synchronisation point {n} ({before[0]}): {before[1]} != {after[1]}')
+    if original_final != optimized_final:
+        mismatches.append(f'Final position: {original_final} != {optimized_final}')
+    return mismatches
+
+
+def optimize(lines, report=False, collapse=True):
+    """
+    Run the peephole pass over a G-code stream.
+
+    :param lines: Iterable of G-code lines
+    :param report: Also return a report of the lines and estimated seconds removed (default is False)
+    :param collapse: Collapse consecutive same-direction moves on the same axis (default is True)
+    :return: List of optimized lines, or tuple (lines, report) if report is True
+    """
+    lines = [line.rstrip('\n') for line in lines if line.strip()]
+    optimized = PeepholeOptimizer(collapse=collapse).feed_lines(lines)
+    if not report:
+        return optimized
+    before = estimate_runtime(lines)['total']
+    after = estimate_runtime(optimized)['total']
+    return optimized, {
+        'lines_before': len(lines),
+        'lines_after': len(optimized),
+        'lines_removed': len(lines) - len(optimized),
+        'seconds_before': before,
+        'seconds_after': after,
+        'seconds_removed': before - after,
+        'mismatches': verify_equivalent(lines, optimized),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove redundant and no-op moves from PALH G-code.')
+    parser.add_argument('input', help='G-code file to optimize')
+    parser.add_argument('-o', '--output', help='Where to write the optimized G-code (default: print the report only)')
+    parser.add_argument('--report', action='store_true', help='Print the lines and estimated seconds removed')
+    parser.add_argument('--no-collapse', action='store_true', help='Only drop no-op moves and repeated words')
+    args = parser.parse_args()
+
+    with open(args.input) as f:
+        optimized, summary = optimize(f, report=True, collapse=not args.no_collapse)
+    if summary['mismatches']:
+        raise SystemExit('Optimized G-code is not equivalent:\n' + '\n'.join(summary['mismatches']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.writelines(line + '\n' for line in optimized)
+    if args.report or not args.output:
+        print(f"{args.input}: {summary['lines_removed']} of {summary['lines_before']} lines removed, "
+              f"{summary['seconds_removed']:.1f} s of {summary['seconds_before']:.1f} s estimated machine time saved")
@@ -0,0 +1,239 @@
+"""
+Per-action profiler for protocol generation.
+
+An ActionProfiler attached to a ProtocolContext (ProtocolContext(profiler=ActionProfiler())) is notified around every
+call of the instrumented action functions (new_tip, eject, aspirate_volume, dispense_volume, mix, heat,
+pipette_pellet, pipette_mix). For each call it records:
+    - the wall-clock time spent generating it
+    - the G-code lines and bytes it emitted
+    - the estimated machine seconds of those lines (motion model of gcode_time_estimator)
+Commands emitted outside the instrumented actions are charged to the enclosing protocol step (see protocol_step()).
+
+The profile can be exported as JSON, or as collapsed stacks ("protocol;step;action value" lines) for flamegraph
+tools such as flamegraph.pl or speedscope, weighted by machine time, wall time, lines or bytes.
+
+Usage:
+    python gcode_profiler.py YWHAZ_qPCR_protocol.py
+    python gcode_profiler.py YWHAZ_qPCR_protocol.py --json profile.json --collapsed profile.folded --metric wall
+"""
+import argparse
+import json
+import os
+import time
+from contextlib import contextmanager, redirect_stdout
+
+from compile_protocols import ENTRY_POINT, load_protocol
+from gcode_generator_v1_2 import ProtocolContext, current_context
+from gcode_time_estimator import MachineTimeEstimator
+
+METRICS = ('wall_seconds', 'lines', 'bytes', 'machine_seconds')
+# Collapsed stacks need integer weights: machine and wall time are exported in milliseconds and microseconds
+COLLAPSED_SCALE = {'machine_seconds': 1e3, 'wall_seconds': 1e6, 'lines': 1, 'bytes': 1}
+
+
+class _Frame:
+    """An action call that is still running; costs are charged to it while it is the innermost frame."""
+
+    __slots__ = ('name', 'stack', 'own', 'children')
+
+    def __init__(self, name, stack):
+        self.name = name
+        self.stack = stack
+        self.own = [0.0, 0, 0, 0.0]  # Same order as METRICS
+        self.children = [0.0, 0, 0, 0.0]
+
+
+class ActionProfiler:
+    """
+    Record the cost of every instrumented action call of a protocol.
+
+    :param root: Name of the root frame, usually the protocol name (default is 'protocol')
+    :param kwargs: Motion model parameters passed to MachineTimeEstimator
+    """
+
+    def __init__(self, root='protocol', **kwargs):
+        self.root = root
+        self.machine = MachineTimeEstimator(**kwargs)
+        self.calls = []  # One dictionary per finished action call, in order of completion
+        self.stacks = {}  # Stack tuple -> costs charged directly to it (same order as METRICS)
+        self.step_costs = {}  # Step label (None before the first step) -> costs, in protocol order
+        self._frames = []
+        self._lines = None
+        self._fed = 0
+        self._wall = time.perf_counter()
+
+    def _stack(self, ctx):
+        if self._frames:
+            return self._frames[-1].stack
+        return (self.root, ctx.step.replace(';', ',')) if ctx.step else (self.root,)
+
+    def sync(self):
+        """Charge the lines emitted and the time spent since the last sync to the innermost frame."""
+        wall = time.perf_counter() - self._wall
+        ctx = current_context()
+        lines = ctx.emitter.lines
+        if lines is not self._lines or len(lines) < self._fed:  # New emitter, or the emitter was cleared
+            self._lines, self._fed = lines, 0
+        new = lines[self._fed:]
+        self._fed = len(lines)
+        clock = self.machine.clock
+        for line in new:
+            self.machine.feed(line)
+        cost = (wall, len(new), sum(len(line) + 1 for line in new), self.machine.clock - clock)
+
+        charged = [self.stacks.setdefault(self._stack(ctx), [0.0, 0, 0, 0.0]),
+                   self.step_costs.setdefault(ctx.step, [0.0, 0, 0, 0.0])]
+        if self._frames:
+            charged.append(self._frames[-1].own)
+        for totals in charged:
+            for n, value in enumerate(cost):
+                totals[n] += value
+        self._wall = time.perf_counter()  # The profiler's own overhead is not charged to anything
+
+    @contextmanager
+    def action(self, name):
+        """Instrument one action call; used by gcode_generator_v1_2.instrumented."""
+        self.sync()
+        ctx = current_context()
+        frame = _Frame(name, self._stack(ctx) + (name,))
+        self._frames.append(frame)
+        try:
+            yield
+        finally:
+            self.sync()
+            self._frames.pop()
+            inclusive = [own + children for own, children in zip(frame.own, frame.children)]
+            if self._frames:
+                parent = self._frames[-1].children
+                for n, value in enumerate(inclusive):
+                    parent[n] += value
+            call = {'action': name, 'step': ctx.step, 'stack': list(frame.stack)}
+            call.update(zip(METRICS, inclusive))
+            self.calls.append(call)
+
+    def summary(self):
+        """
+        Cost per action function, most machine time first.
+
+        :return: List of dictionaries with the action, number of calls and the summed metrics of its calls
+        """
+        actions = {}
+        for call in self.calls:
+            if call['action'] in call['stack'][:-1]:
+                continue  # Nested in a call of the same action, already included in that one
+            totals = actions.setdefault(call['action'], dict({'action': call['action'], 'calls': 0},
+                                                             **{metric: 0 for metric in METRICS}))
+            totals['calls'] += 1
+            for metric in METRICS:
+                totals[metric] += call[metric]
+        return sorted(actions.values(), key=lambda totals: -totals['machine_seconds'])
+
+    def steps(self):
+        """
+        Cost per protocol step (including its actions), in protocol order.
+
+        :return: List of dictionaries with the step label (None before the first step) and the summed metrics
+        """
+        return [dict({'step': label}, **dict(zip(METRICS, costs))) for label, costs in self.step_costs.items()
+                if costs[1] or label is not None]  # Leave out the empty stretch before the first step
+
+    def totals(self):
+        totals = dict.fromkeys(METRICS, 0)
+        for costs in self.stacks.values():
+            for metric, value in zip(METRICS, costs):
+                totals[metric] += value
+        return totals
+
+    def report(self):
+        """
+        The whole profile.
+
+        :return: Dictionary with the protocol name, totals, per-step and per-action summaries and every call
+        """
+        return {
+            'protocol': self.root,
+            'totals': self.totals(),
+            'steps': self.steps(),
+            'actions': self.summary(),
+            'calls': self.calls,
+        }
+
+    def to_json(self, file):
+        json.dump(self.report(), file, indent=2)
+
+    def collapsed(self, metric='machine_seconds'):
+        """
+        Collapsed-stack profile for flamegraph tools.
+
+        :param metric: One of METRICS (default is 'machine_seconds'); times are exported as integer ms (machine) or
+                       us (wall)
+        :return: List of 'frame;frame;frame value' lines
+        """
+        index = METRICS.index(metric)
+        rows = []
+        for stack, costs in self.stacks.items():
+            value = round(costs[index] * COLLAPSED_SCALE[metric])
+            if value > 0:
+                rows.append(f"{';'.join(stack)} {value}")
+        return rows
+
+
+def profile_protocol(path, dwell_model='settle', **kwargs):
+    """
+    Generate a protocol script with instrumentation.
+
+    :param path: Path of the protocol script
+    :param dwell_model: Dwell model of the context, see ProtocolContext (default is 'settle')
+    :param kwargs: Motion model parameters passed to MachineTimeEstimator
+    :return: The ActionProfiler
+    """
+    module = load_protocol(path)
+    profiler = ActionProfiler(root=os.path.splitext(os.path.basename(path))[0], **kwargs)
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), \
+            ProtocolContext(dwell_model=dwell_model, profiler=profiler):
+        profiler.sync()  # Start the clock here, not at import
+        getattr(module, ENTRY_POINT)(os.devnull)
+        profiler.sync()
+    return profiler
+
+
+def format_profile(profiler, top=None):
+    totals = profiler.totals()
+    machine = totals['machine_seconds'] or 1
+    rows = [f"{profiler.root}: {totals['machine_seconds']:.1f} s machine time, {totals['lines']} lines, "
+            f"{totals['bytes']} bytes, {1e3 * totals['wall_seconds']:.1f} ms to generate", '']
+    width = max([len('Step')] + [len(str(step['step'])) for step in profiler.steps()])
+    rows.append(f"{'Step':<{width}}  {'Machine s':>9}  {'Share':>6}  {'Lines':>6}  {'Wall ms':>8}")
+    for step in profiler.steps():
+        rows.append(f"{str(step['step']):<{width}}  {step['machine_seconds']:>9.1f}  "
+                    f"{100 * step['machine_seconds'] / machine:>5.1f}%  {step['lines']:>6}  "
+                    f"{1e3 * step['wall_seconds']:>8.2f}")
+    rows.append('')
+    rows.append(f"{'Action':<16}  {'Calls':>5}  {'Machine s':>9}  {'Share':>6}  {'Lines':>6}  {'Bytes':>7}  {'Wall ms':>8}")
+    for action in profiler.summary()[:top]:
+        rows.append(f"{action['action']:<16}  {action['calls']:>5}  {action['machine_seconds']:>9.1f}  "
+                    f"{100 * action['machine_seconds'] / machine:>5.1f}%  {action['lines']:>6}  {action['bytes']:>7}  "
+                    f"{1e3 * action['wall_seconds']:>8.2f}")
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile the action calls of a protocol script.')
+    parser.add_argument('script', help='Protocol script to profile')
+    parser.add_argument('--json', help='Write the profile (with every call) to this JSON file')
+    parser.add_argument('--collapsed', help='Write a collapsed-stack profile to this file')
+    parser.add_argument('--metric', choices=['machine', 'wall', 'lines', 'bytes'], default='machine',
+                        help='Weight of the collapsed stacks (default: machine)')
+    parser.add_argument('--dwell-model', choices=['settle', 'fixed'], default='settle')
+    parser.add_argument('--top', type=int, help='Only list the most expensive actions')
+    args = parser.parse_args()
+
+    profiler = profile_protocol(args.script, dwell_model=args.dwell_model)
+    print(format_profile(profiler, top=args.top))
+    if args.json:
+        with open(args.json, 'w') as f:
+            profiler.to_json(f)
+    if args.collapsed:
+        metric = {'machine': 'machine_seconds', 'wall': 'wall_seconds'}.get(args.metric, args.metric)
+        with open(args.collapsed, 'w') as f:
+            f.writelines(row + '\n' for row in profiler.collapsed(metric))
@@ -0,0 +1,429 @@
+"""
+Headless G-code sender for the PALH.
+
+Streams a generated protocol to the Marlin board over a serial port, without Printrun. Every line is sent with a
+line number and checksum, and up to max_in_flight lines are kept unacknowledged so Marlin's command buffer never runs
+dry between two moves. The sender follows Marlin's replies:
+    ok          - one line was accepted, the next one can be sent
+    busy        - the firmware is alive but still working (long moves, M190, M0); it does not count as a stall
+    Resend: N   - line N was corrupted; the sender rewinds and sends it again, with everything after it
+At the end it reports the throughput in lines per second and the stalls: periods of stall_timeout seconds or more
+without any reply while lines were in flight.
+
+If the firmware lists the COMPACT_GCODE capability in its M115 reply, commands are sent as compact binary packets
+(see gcode_binary.py) instead of ASCII lines, with the same line numbers, checksums and replies. Both .gcode and
+compact .pgcb files can be sent.
+
+FakePrinter is a pty-backed stand-in for the board that speaks the same protocol (with optional injected checksum
+errors and busy messages), so the sender can be exercised on a Linux box without hardware.
+
+Usage:
+    python gcode_sender.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode --port /dev/ttyUSB0 --baud 115200
+    python gcode_sender.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode --fake --error-every 500
+    python gcode_sender.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode --fake --text
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import re
+import termios
+import time
+import tty
+
+from gcode_binary import PACKET_START, pack, read_lines, unpack_payload
+
+DEFAULT_BAUD = 115200
+DEFAULT_IN_FLIGHT = 4  # Marlin's default BUFSIZE
+STALL_TIMEOUT = 10.0  # Seconds without a reply (and lines in flight) that count as a stall
+
+RESEND_PATTERN = re.compile(r'(?:resend|rs)\s*:?\s*N?(\d+)', re.IGNORECASE)
+COMPACT_CAPABILITY = 'Cap:COMPACT_GCODE:1'
+
+
+def checksum(text):
+    """XOR checksum of a line, as computed by Marlin."""
+    value = 0
+    for byte in text.encode('ascii'):
+        value ^= byte
+    return value
+
+
+def frame(number, command):
+    """Line number and checksum framing: 'N12 G1 X10*93'."""
+    text = f'N{number} {command}'
+    return f'{text}*{checksum(text)}'
+
+
+def strip_command(line):
+    """Drop comments and surrounding whitespace; returns an empty string for lines without a command."""
+    return line.split(';', 1)[0].strip()
+
+
+def configure_serial(fd, baud=DEFAULT_BAUD):
+    """
+    Put a serial (or pty) file descriptor in raw, non-blocking mode at the given baud rate.
+
+    :param fd: Open file descriptor of the port
+    :param baud: Baud rate; must be one of the standard termios rates (e.g. 115200)
+    """
+    speed = getattr(termios, f'B{baud}', None)
+    if speed is None:
+        raise ValueError(f'-Unsupported baud rate {baud}; use a standard rate such as 115200.')
+    tty.setraw(fd)
+    attributes = termios.tcgetattr(fd)
+    attributes[4] = attributes[5] = speed
+    attributes[2] |= termios.CLOCAL | termios.CREAD
+    termios.tcsetattr(fd, termios.TCSANOW, attributes)
+    os.set_blocking(fd, False)
+
+
+async def open_serial(port, baud=DEFAULT_BAUD):
+    """
+    Open a serial port as an asyncio stream pair.
+
+    :param port: Device path (e.g. /dev/ttyUSB0, or the slave side of a pty)
+    :param baud: Baud rate (default is DEFAULT_BAUD)
+    :return: Tuple (reader, writer)
+    """
+    fd = os.open(port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    configure_serial(fd, baud)
+    return await _open_fd(fd)
+
+
+class _PortWriter(asyncio.StreamWriter):
+    # Closing the writer also closes the read side of the port
+    def __init__(self, transport, protocol, reader, loop, read_transport):
+        super().__init__(transport, protocol, reader, loop)
+        self._read_transport = read_transport
+
+    def close(self):
+        self._read_transport.close()
+        super().close()
+
+
+async def _open_fd(fd):
+    # Separate descriptors for the read and write transports, so each transport closes its own
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    read_transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                     os.fdopen(fd, 'rb', buffering=0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                        os.fdopen(os.dup(fd), 'wb', buffering=0))
+    return reader, _PortWriter(transport, protocol, reader, loop, read_transport)
+
+
+class GCodeSender:
+    """
+    Stream G-code lines to a Marlin board with ok-based flow control.
+
+    :param reader: asyncio StreamReader of the port
+    :param writer: asyncio StreamWriter of the port
+    :param max_in_flight: Maximum number of unacknowledged lines (default is DEFAULT_IN_FLIGHT)
+    :param stall_timeout: Seconds without a reply that count as a stall (default is STALL_TIMEOUT)
+    :param progress: Optional callable receiving (lines_acknowledged, total_lines)
+    :param compact: Send compact binary packets: None (default) when the firmware supports them, True to require
+                    them, False to always send ASCII
+    """
+
+    def __init__(self, reader, writer, max_in_flight=DEFAULT_IN_FLIGHT, stall_timeout=STALL_TIMEOUT, progress=None,
+                 compact=None):
+        self.reader = reader
+        self.writer = writer
+        self.max_in_flight = max_in_flight
+        self.stall_timeout = stall_timeout
+        self.progress = progress
+        self.compact = compact
+        self.messages = []  # Non-protocol replies from the firmware (echo:, errors, ...)
+
+    async def _supports_compact(self, stats):
+        # Ask for the firmware capabilities; the reply ends with ok
+        self.writer.write(b'M115\n')
+        supported = False
+        while True:
+            reply = await self._read_reply(stats)
+            if reply.lower().startswith('ok'):
+                return supported
+            if reply.startswith(COMPACT_CAPABILITY):
+                supported = True
+
+    async def send_lines(self, lines):
+        """
+        Stream lines to the board and wait until every one of them is acknowledged.
+
+        :param lines: Iterable of G-code lines; comments and blank lines are skipped
+        :return: Statistics dictionary: lines, seconds, lines_per_second, resends, busy, stalls, stall_seconds,
+                 bytes (sent, including resends and framing) and compact (whether packets were used)
+        """
+        commands = [command for command in map(strip_command, lines) if command]
+        total = len(commands)
+        stats = {'lines': total, 'resends': 0, 'busy': 0, 'stalls': 0, 'stall_seconds': 0.0, 'bytes': 0}
+        start = time.perf_counter()
+
+        compact = self.compact is not False and await self._supports_compact(stats)
+        if self.compact and not compact:
+            raise ConnectionError('-The firmware does not support compact G-code packets.')
+        stats['compact'] = compact
+
+        # Reset the line numbering of the firmware; line n is commands[n - 1]
+        self.writer.write(b'M110 N0\n')
+        while not (await self._read_reply(stats)).lower().startswith('ok'):
+            pass
+
+        next_line = 1
+        in_flight = 0
+        stale = 0  # Lines still in flight from before a resend; their own resend requests are ignored
+        while next_line <= total or in_flight:
+            while in_flight < self.max_in_flight and next_line <= total:
+                if compact:
+                    data = pack(next_line, commands[next_line - 1])
+                else:
+                    data = (frame(next_line, commands[next_line - 1]) + '\n').encode('ascii')
+                self.writer.write(data)
+                stats['bytes'] += len(data)
+                next_line += 1
+                in_flight += 1
+            await self.writer.drain()
+
+            reply = await self._read_reply(stats)
+            lowered = reply.lower()
+            if lowered.startswith('ok'):
+                in_flight = max(in_flight - 1, 0)
+                stale = max(stale - 1, 0)
+                if self.progress:
+                    self.progress(next_line - 1 - in_flight, total)
+            elif 'busy' in lowered:
+                stats['busy'] += 1
+            elif RESEND_PATTERN.search(reply):
+                if not stale:
+                    # Send everything again from the requested line on; the replies for the lines already in
+                    # flight are still on their way (each of them is answered with an error and an ok)
+                    stats['resends'] += 1
+                    stale = in_flight
+                    next_line = int(RESEND_PATTERN.search(reply).group(1))
+            else:
+                self.messages.append(reply)
+
+        seconds = time.perf_counter() - start
+        stats['seconds'] = seconds
+        stats['lines_per_second'] = stats['lines'] / seconds if seconds else 0.0
+        return stats
+
+    async def _read_reply(self, stats):
+        # Next non-empty line from the board; waiting stall_timeout or longer counts as a stall
+        stalled_since = None
+        while True:
+            try:
+                raw = await asyncio.wait_for(self.reader.readline(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                if stalled_since is None:
+                    stalled_since = time.perf_counter() - self.stall_timeout
+                    stats['stalls'] += 1
+                continue
+            if stalled_since is not None:
+                stats['stall_seconds'] += time.perf_counter() - stalled_since
+                stalled_since = None
+            if not raw:
+                raise ConnectionError('-Serial port closed by the board.')
+            reply = raw.decode('ascii', errors='replace').strip()
+            if reply:
+                return reply
+
+
+class FakePrinter:
+    """
+    Stand-in for the PALH board on the master side of a pty. It checks line numbers and checksums like Marlin, keeps
+    a command buffer of buffer_size commands, and only answers "ok" once a command fits in that buffer.
+
+    :param execute: Optional callable receiving each accepted command and returning the seconds it takes to run
+                    (default is instant)
+    :param buffer_size: Size of the command buffer (default is DEFAULT_IN_FLIGHT)
+    :param error_every: Corrupt every n-th received line to exercise resends (default is None, never)
+    :param busy_interval: Seconds between "busy" messages while a command is blocking the buffer (default is 2)
+    :param compact: Advertise and accept compact binary packets (default is False)
+    """
+
+    def __init__(self, execute=None, buffer_size=DEFAULT_IN_FLIGHT, error_every=None, busy_interval=2.0,
+                 compact=False):
+        self.execute = execute
+        self.buffer_size = buffer_size
+        self.error_every = error_every
+        self.busy_interval = busy_interval
+        self.compact = compact
+        self.received = []  # Accepted commands, in order
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self._last_line = 0
+        self._count = 0
+        self._corrupted = set()
+        self._queue = None
+
+    async def serve(self):
+        """Answer the sender until the port is closed (cancel the task to stop)."""
+        reader, writer = await _open_fd(self.master)
+        self.master = None  # Owned by the transports from now on
+        self._queue = queue = asyncio.Queue(self.buffer_size)
+        worker = asyncio.create_task(self._run(queue))
+        try:
+            while True:
+                try:
+                    first = await reader.readexactly(1)
+                    if first[0] == PACKET_START and self.compact:
+                        length = (await reader.readexactly(1))[0]
+                        packet = await reader.readexactly(length + 1)
+                        replies = await self._receive_packet(packet[:-1], packet[-1], queue, writer)
+                    else:
+                        line = (first + await reader.readline()).decode('ascii', errors='replace').strip()
+                        replies = await self._receive(line, queue, writer)
+                except asyncio.IncompleteReadError:
+                    break
+                for reply in replies:
+                    writer.write((reply + '\n').encode('ascii'))
+                await writer.drain()
+        finally:
+            worker.cancel()
+            writer.close()
+
+    async def _receive(self, line, queue, writer):
+        if not line:
+            return []
+        match = re.fullmatch(r'N(\d+) (.*)\*(\d+)', line)
+        if match is None:
+            return await self._accept(None, line, True, queue, writer)  # Unnumbered commands are accepted as is
+        number, command, received_checksum = int(match.group(1)), match.group(2), int(match.group(3))
+        return await self._accept(number, command, checksum(f'N{number} {command}') == received_checksum, queue,
+                                  writer)
+
+    async def _receive_packet(self, payload, check, queue, writer):
+        try:
+            unpacked = unpack_payload(payload, check)
+        except (IndexError, UnicodeDecodeError):
+            unpacked = None
+        if unpacked is None:
+            return await self._accept(None, None, False, queue, writer)
+        return await self._accept(*unpacked, True, queue, writer)
+
+    async def _accept(self, number, command, valid, queue, writer):
+        self._count += 1
+        if number is not None or not valid:
+            # Injected errors hit a line at most once, so the resent copy always gets through
+            corrupted = self.error_every and self._count % self.error_every == 0 and number not in self._corrupted
+            if corrupted:
+                self._corrupted.add(number)
+            if corrupted or not valid:
+                return [f'Error:checksum mismatch, Last Line: {self._last_line}', f'Resend: {self._last_line + 1}',
+                        'ok']
+            if number != self._last_line + 1:
+                return [f'Error:Line Number is not Last Line Number+1, Last Line: {self._last_line}',
+                        f'Resend: {self._last_line + 1}', 'ok']
+            self._last_line = number
+        if command.upper().startswith('M110'):
+            found = re.search(r'N(\d+)', command)
+            self._last_line = int(found.group(1)) if found else 0
+            return ['ok']
+        if command.upper().split()[0] == 'M115':
+            return (['FIRMWARE_NAME:PALH FakePrinter'] + ([COMPACT_CAPABILITY] if self.compact else [])
+                    + ['ok'])
+
+        # Hold the ok until the command fits in the buffer, telling the host we are busy meanwhile
+        while True:
+            try:
+                await asyncio.wait_for(queue.put(command), self.busy_interval)
+                break
+            except asyncio.TimeoutError:
+                writer.write(b'echo:busy: processing\n')
+        self.received.append(command)
+        return ['ok']
+
+    async def _run(self, queue):
+        while True:
+            command = await queue.get()
+            seconds = self.execute(command) if self.execute else 0
+            if seconds:
+                await asyncio.sleep(seconds)
+            queue.task_done()
+
+    async def wait_idle(self):
+        """Wait until every accepted command has been executed."""
+        if self._queue is not None:
+            await self._queue.join()
+
+    def close(self):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+
+async def stream_file(filename, port, baud=DEFAULT_BAUD, **kwargs):
+    """
+    Stream a .gcode file to a board.
+
+    :param filename: Path of the .gcode (or compact .pgcb) file
+    :param port: Serial port of the board
+    :param baud: Baud rate (default is DEFAULT_BAUD)
+    :param kwargs: Options passed to GCodeSender
+    :return: Statistics dictionary, see GCodeSender.send_lines()
+    """
+    reader, writer = await open_serial(port, baud)
+    try:
+        return await GCodeSender(reader, writer, **kwargs).send_lines(read_lines(filename))
+    finally:
+        writer.close()
+
+
+async def stream_to_fake(filename, printer=None, **kwargs):
+    """
+    Stream a .gcode file to a FakePrinter on a local pty.
+
+    :param filename: Path of the .gcode file
+    :param printer: The FakePrinter (default is an instant one)
+    :param kwargs: Options passed to GCodeSender
+    :return: Tuple (statistics, printer)
+    """
+    printer = printer or FakePrinter()
+    server = asyncio.create_task(printer.serve())
+    try:
+        stats = await stream_file(filename, printer.port, **kwargs)
+        await printer.wait_idle()
+    finally:
+        server.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await server
+        printer.close()
+    return stats, printer
+
+
+def format_stats(stats):
+    return (f"{stats['lines']} lines in {stats['seconds']:.2f} s ({stats['lines_per_second']:.0f} lines/s), "
+            f"{stats['bytes']} bytes {'compact' if stats['compact'] else 'ASCII'}, "
+            f"{stats['resends']} resends, {stats['busy']} busy, {stats['stalls']} stalls "
+            f"({stats['stall_seconds']:.1f} s)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Stream a G-code protocol to the PALH over a serial port.')
+    parser.add_argument('input', help='G-code file to send')
+    parser.add_argument('--port', help='Serial port of the board (e.g. /dev/ttyUSB0)')
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD, help='Baud rate')
+    parser.add_argument('--in-flight', type=int, default=DEFAULT_IN_FLIGHT, help='Maximum unacknowledged lines')
+    parser.add_argument('--fake', action='store_true', help='Send to a local pty-backed fake printer instead')
+    parser.add_argument('--error-every', type=int, help='With --fake: corrupt every n-th line to test resends')
+    parser.add_argument('--text', action='store_true', help='Always send ASCII, even if the firmware supports '
+                                                             'compact packets')
+    args = parser.parse_args()
+
+    compact = False if args.text else None
+    if args.fake:
+        fake = FakePrinter(error_every=args.error_every, buffer_size=args.in_flight, compact=True)
+        stats, fake = asyncio.run(stream_to_fake(args.input, fake, max_in_flight=args.in_flight, compact=compact))
+        expected = [command for command in map(strip_command, read_lines(args.input)) if command]
+        status = 'all lines received in order' if fake.received == expected else 'RECEIVED LINES DIFFER'
+        print(f'{format_stats(stats)}; {status}')
+    elif args.port:
+        print(format_stats(asyncio.run(stream_file(args.input, args.port, args.baud, max_in_flight=args.in_flight,
+                                                   compact=compact))))
+    else:
+        parser.error('give --port or --fake')
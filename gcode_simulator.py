@@ -0,0 +1,177 @@
+"""
+Virtual PALH firmware.
+
+Executes the G-code dialect the generator emits (G1 with X/Y/Z/V, G2 arcs, G4, G28, M0, M92, M140, M190, M203, M204)
+on a simulated machine: axis positions and plunger volume are tracked, and a simulated clock advances with the
+motion model of gcode_time_estimator (programmed feedrates, M203 limits, M204 acceleration, heater warm-up).
+
+Two modes:
+    as fast as possible (speed=None) - commands complete instantly, the simulated clock still advances
+    wall-clock scaled (speed=s)      - every command takes its simulated time divided by s (speed=1 is real time)
+
+The simulator can also be put behind the sender's pty-backed FakePrinter, so a protocol can be streamed end to end
+through gcode_sender.py without an instrument.
+
+Usage:
+    python gcode_simulator.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode
+    python gcode_simulator.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode --send --speed 100
+"""
+import argparse
+import asyncio
+import time
+
+from gcode_time_estimator import AXES, MachineTimeEstimator, format_duration, parse_line
+
+SUPPORTED_COMMANDS = ('G0', 'G1', 'G2', 'G3', 'G4', 'G28', 'M0', 'M1', 'M92', 'M110', 'M140', 'M190', 'M203',
+                      'M204')
+
+
+class PALHSimulator:
+    """
+    Simulated PALH: executes G-code lines and keeps the machine state.
+
+    :param speed: Wall-clock speed-up factor; None runs as fast as possible (default), 1 is real time
+    :param pause_seconds: Simulated time an operator takes to press the button after M0/M1 (default is 0)
+    :param kwargs: Motion model parameters passed to MachineTimeEstimator
+    """
+
+    def __init__(self, speed=None, pause_seconds=0.0, **kwargs):
+        self.speed = speed
+        self.pause_seconds = pause_seconds
+        self.machine = MachineTimeEstimator(**kwargs)
+        self.homed = {axis: False for axis in AXES}
+        self.commands = 0
+        self.warnings = []  # (line number, message) for unknown commands and moves on axes that were never homed
+
+    @property
+    def clock(self):
+        """Simulated time since power-up, in seconds."""
+        return self.machine.clock
+
+    @property
+    def position(self):
+        return dict(self.machine.position)
+
+    @property
+    def plunger_volume(self):
+        """Volume drawn into the plunger (the V axis), in μL."""
+        return self.machine.position['V']
+
+    @property
+    def temperature(self):
+        self.machine._update_temperature()
+        return self.machine.temperature
+
+    def execute(self, line):
+        """
+        Execute one G-code line.
+
+        :param line: The G-code line
+        :return: Wall-clock seconds the command should take in the current mode (0 when running as fast as possible)
+        """
+        command, words = parse_line(line)
+        if command is None:
+            return 0.0
+        self.commands += 1
+        if command not in SUPPORTED_COMMANDS:
+            self.warnings.append((self.commands, f'Unknown command: {line.strip()}'))
+            return 0.0
+        if command in ('G0', 'G1', 'G2', 'G3'):
+            for axis in AXES:
+                if words.get(axis) is not None and not self.homed[axis]:
+                    self.warnings.append((self.commands, f'{axis} moved before homing: {line.strip()}'))
+                    self.homed[axis] = True  # Report each axis once
+        elif command == 'G28':
+            for axis in [axis for axis in AXES if axis in words] or AXES:
+                self.homed[axis] = True
+
+        start = self.machine.clock
+        self.machine.feed(line)
+        if command in ('M0', 'M1'):
+            self.machine.clock += self.pause_seconds
+        seconds = self.machine.clock - start
+        return seconds / self.speed if self.speed else 0.0
+
+    def run(self, lines):
+        """
+        Execute a whole stream, sleeping in between commands when running wall-clock scaled.
+
+        :param lines: Iterable of G-code lines
+        :return: Report dictionary, see report()
+        """
+        for line in lines:
+            seconds = self.execute(line)
+            if seconds:
+                time.sleep(seconds)
+        return self.report()
+
+    async def run_async(self, lines):
+        """Like run(), but yields to the event loop instead of blocking."""
+        for line in lines:
+            seconds = self.execute(line)
+            if seconds:
+                await asyncio.sleep(seconds)
+        return self.report()
+
+    def report(self):
+        """
+        State of the machine.
+
+        :return: Dictionary with the simulated clock, per-category times, position, plunger volume, temperature,
+                 the number of commands and the warnings
+        """
+        machine = self.machine.report()
+        return {
+            'clock': self.clock,
+            'breakdown': machine['breakdown'],
+            'pauses': machine['pauses'],
+            'position': self.position,
+            'plunger_volume': self.plunger_volume,
+            'temperature': self.temperature,
+            'commands': self.commands,
+            'warnings': list(self.warnings),
+        }
+
+
+def format_report(report):
+    position = ' '.join(f'{axis}{value:g}' for axis, value in report['position'].items())
+    rows = [f"Simulated time: {format_duration(report['clock'])} ({report['clock']:.1f} s, "
+            f"{report['commands']} commands, {report['pauses']} pauses)",
+            f"Final position: {position}, plunger {report['plunger_volume']:g} uL, heater {report['temperature']:.1f} C"]
+    rows.extend(f'  line {number}: {message}' for number, message in report['warnings'])
+    return '\n'.join(rows)
+
+
+async def send_to_simulator(filename, simulator, **kwargs):
+    """
+    Stream a .gcode file through the sender to a simulator behind a pty.
+
+    :param filename: Path of the .gcode file
+    :param simulator: The PALHSimulator
+    :param kwargs: Options passed to GCodeSender
+    :return: Sender statistics, see GCodeSender.send_lines()
+    """
+    from gcode_sender import FakePrinter, stream_to_fake
+
+    printer = FakePrinter(execute=simulator.execute, buffer_size=kwargs.get('max_in_flight', 4), compact=True)
+    stats, _ = await stream_to_fake(filename, printer, **kwargs)
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a G-code protocol on a simulated PALH.')
+    parser.add_argument('input', help='G-code file to run')
+    parser.add_argument('--speed', type=float, help='Wall-clock speed-up (1 = real time; default: as fast as possible)')
+    parser.add_argument('--send', action='store_true', help='Stream the file through gcode_sender over a local pty')
+    args = parser.parse_args()
+
+    simulator = PALHSimulator(speed=args.speed)
+    wall = time.perf_counter()
+    if args.send:
+        from gcode_sender import format_stats
+        print(format_stats(asyncio.run(send_to_simulator(args.input, simulator))))
+    else:
+        with open(args.input) as f:
+            simulator.run(f)
+    print(format_report(simulator.report()))
+    print(f'Wall-clock time: {time.perf_counter() - wall:.2f} s')
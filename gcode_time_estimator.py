@@ -0,0 +1,294 @@
+"""
+Machine-time estimator for PALH protocols.
+
+Replays a G-code stream with a trapezoidal motion model and returns the estimated runtime of the protocol on the
+PALH, broken down by action. The feedrate limits (M203), steps per unit (M92) and acceleration (M204) are taken from
+the stream itself, so the estimate follows whatever start()/G28() programmed.
+
+Usage:
+    python gcode_time_estimator.py Gcodes_protocol_library/YWHAZ_qPCR_protocol.gcode
+"""
+import math
+import sys
+
+from gcode_generator_v1_2 import MAX_FEEDRATE, STEPS_PER_UNIT
+
+AXES = ('X', 'Y', 'Z', 'V')
+CATEGORIES = ('travel', 'z', 'plunger', 'dwell', 'heating', 'homing')
+
+DEFAULT_ACCEL = 3000  # Marlin default print/travel acceleration (mm/s^2) until an M204 is seen
+DEFAULT_FEEDRATE = 3000  # Modal feedrate (units/min) assumed before the first F word
+HOMING_FEEDRATE = {'X': 50, 'Y': 50, 'Z': 10, 'V': 10}  # Homing speed per axis (units/s)
+MAX_STEP_RATE = 40000  # Maximum step frequency of the controller (steps/s), caps each axis through M92
+AMBIENT_TEMPERATURE = 22  # Celsius
+HEATING_RATE = 0.5  # Heater warm-up rate (Celsius/s)
+COOLING_RATE = 0.1  # Passive cool-down rate once the heater is switched off (Celsius/s)
+
+
+def parse_line(line):
+    """
+    Split a G-code line into its command and a dictionary of numeric words.
+
+    Comments, line numbers (N) and checksums (*) are ignored. Free text after M0/M1 is dropped.
+
+    :param line: A single G-code line
+    :return: Tuple (command, words), e.g. ('G1', {'Z': 65.0, 'F': 3000.0}); command is None for blank lines
+    """
+    line = line.split(';', 1)[0].split('*', 1)[0].strip()
+    if not line:
+        return None, {}
+    tokens = line.split()
+    if tokens[0][0] in 'Nn':
+        tokens = tokens[1:]
+        if not tokens:
+            return None, {}
+    command = tokens[0].upper()
+    words = {}
+    if command in ('M0', 'M1', 'M117'):
+        return command, words
+    for token in tokens[1:]:
+        letter = token[0].upper()
+        try:
+            words[letter] = float(token[1:]) if len(token) > 1 else None
+        except ValueError:
+            continue
+    return command, words
+
+
+def trapezoid_time(distance, speed, accel):
+    """
+    Time to travel a distance from rest to rest with a trapezoidal velocity profile.
+
+    :param distance: Length of the move
+    :param speed: Nominal (cruise) speed
+    :param accel: Acceleration and deceleration
+    :return: Time in seconds
+    """
+    if distance <= 0 or speed <= 0:
+        return 0.0
+    if accel <= 0:
+        return distance / speed
+    if distance >= speed * speed / accel:
+        # Accelerate to the cruise speed, cruise, then decelerate
+        return distance / speed + speed / accel
+    # Triangle profile: the move is too short to reach the cruise speed
+    return 2 * math.sqrt(distance / accel)
+
+
+class MachineTimeEstimator:
+    """
+    Replay G-code line by line and accumulate the estimated machine time per action.
+
+    :param accel: Acceleration used until the stream sets one with M204 (default is DEFAULT_ACCEL)
+    :param heating_rate: Heater warm-up rate in Celsius/s used for M190 (default is HEATING_RATE)
+    :param cooling_rate: Passive cool-down rate in Celsius/s after M140 lowers the target (default is COOLING_RATE)
+    """
+
+    def __init__(self, accel=DEFAULT_ACCEL, heating_rate=HEATING_RATE, cooling_rate=COOLING_RATE):
+        self.position = {axis: 0.0 for axis in AXES}
+        self.feedrate = DEFAULT_FEEDRATE
+        self.accel = accel
+        self.max_feedrate = dict(MAX_FEEDRATE)
+        self.steps_per_unit = dict(STEPS_PER_UNIT)
+        self.heating_rate = heating_rate
+        self.cooling_rate = cooling_rate
+        self.temperature = AMBIENT_TEMPERATURE
+        self.target_temperature = AMBIENT_TEMPERATURE
+        self.clock = 0.0
+        self._temperature_clock = 0.0
+        self.totals = {category: 0.0 for category in CATEGORIES}
+        self.counts = {category: 0 for category in CATEGORIES}
+        self.lines = 0
+        self.pauses = 0  # M0 prompts; they wait for the operator and are not counted as machine time
+
+    def axis_speed_limit(self, axis):
+        """Maximum speed of one axis (units/s) from M203 and the step rate implied by M92."""
+        limit = self.max_feedrate.get(axis, math.inf)
+        steps = self.steps_per_unit.get(axis)
+        if steps:
+            limit = min(limit, MAX_STEP_RATE / steps)
+        return limit
+
+    def move_time(self, deltas, feedrate):
+        """
+        Time for a linear move with the given per-axis displacements.
+
+        :param deltas: Dictionary of axis displacements
+        :param feedrate: Requested feedrate in units/min
+        :return: Time in seconds
+        """
+        distance = math.sqrt(sum(d * d for d in deltas.values()))
+        if distance == 0:
+            return 0.0
+        speed = feedrate / 60
+        for axis, delta in deltas.items():
+            if delta:
+                # Scale down the path speed until every axis is within its own limit
+                axis_speed = speed * abs(delta) / distance
+                limit = self.axis_speed_limit(axis)
+                if axis_speed > limit:
+                    speed *= limit / axis_speed
+        return trapezoid_time(distance, speed, self.accel)
+
+    def _quantize(self, axis, value):
+        steps = self.steps_per_unit.get(axis)
+        return round(value * steps) / steps if steps else value
+
+    def _update_temperature(self):
+        # Move the heater temperature towards its target for the machine time elapsed since the last update
+        elapsed = self.clock - self._temperature_clock
+        self._temperature_clock = self.clock
+        if self.temperature < self.target_temperature:
+            self.temperature = min(self.target_temperature, self.temperature + self.heating_rate * elapsed)
+        elif self.temperature > self.target_temperature:
+            self.temperature = max(self.target_temperature, self.temperature - self.cooling_rate * elapsed)
+
+    def _add(self, category, seconds):
+        self.totals[category] += seconds
+        self.counts[category] += 1
+        self.clock += seconds
+        return category, seconds
+
+    def feed(self, line):
+        """
+        Replay a single G-code line.
+
+        :param line: The G-code line
+        :return: Tuple (category, seconds) for the line; category is None for lines that take no machine time
+        """
+        command, words = parse_line(line)
+        if command is None:
+            return None, 0.0
+        self.lines += 1
+
+        if command in ('G0', 'G1'):
+            if words.get('F'):
+                self.feedrate = words['F']
+            deltas = {}
+            for axis in AXES:
+                if words.get(axis) is not None:
+                    target = self._quantize(axis, words[axis])
+                    deltas[axis] = target - self.position[axis]
+                    self.position[axis] = target
+            seconds = self.move_time(deltas, self.feedrate)
+            if deltas.get('X') or deltas.get('Y'):
+                return self._add('travel', seconds)
+            if deltas.get('Z'):
+                return self._add('z', seconds)
+            if deltas.get('V'):
+                return self._add('plunger', seconds)
+            return None, 0.0
+
+        if command in ('G2', 'G3'):
+            if words.get('F'):
+                self.feedrate = words['F']
+            x0, y0 = self.position['X'], self.position['Y']
+            x1 = words['X'] if words.get('X') is not None else x0
+            y1 = words['Y'] if words.get('Y') is not None else y0
+            cx, cy = x0 + (words.get('I') or 0.0), y0 + (words.get('J') or 0.0)
+            radius = math.hypot(x0 - cx, y0 - cy)
+            start = math.atan2(y0 - cy, x0 - cx)
+            end = math.atan2(y1 - cy, x1 - cx)
+            sweep = (start - end) if command == 'G2' else (end - start)
+            sweep %= 2 * math.pi
+            if sweep == 0:
+                sweep = 2 * math.pi  # Same start and end point: full circle
+            length = radius * sweep
+            self.position['X'], self.position['Y'] = x1, y1
+            speed = min(self.feedrate / 60, self.axis_speed_limit('X'), self.axis_speed_limit('Y'))
+            return self._add('travel', trapezoid_time(length, speed, self.accel))
+
+        if command == 'G4':
+            seconds = (words.get('P') or 0) / 1000 + (words.get('S') or 0)
+            return self._add('dwell', seconds)
+
+        if command == 'G28':
+            axes = [axis for axis in AXES if axis in words] or list(AXES)
+            seconds = 0.0
+            for axis in axes:
+                speed = min(HOMING_FEEDRATE[axis], self.axis_speed_limit(axis))
+                seconds = max(seconds, abs(self.position[axis]) / speed)
+                self.position[axis] = 0.0
+            return self._add('homing', seconds)
+
+        if command == 'M92':
+            self.steps_per_unit.update({axis: value for axis, value in words.items() if axis in AXES and value})
+        elif command == 'M203':
+            self.max_feedrate.update({axis: value for axis, value in words.items() if axis in AXES and value})
+        elif command == 'M204':
+            accel = words.get('S') or words.get('T') or words.get('P')
+            if accel:
+                self.accel = accel
+        elif command in ('M140', 'M190'):
+            self._update_temperature()
+            if words.get('S') is not None:
+                self.target_temperature = words['S']
+            if command == 'M190' and self.temperature < self.target_temperature:
+                seconds = (self.target_temperature - self.temperature) / self.heating_rate
+                self.temperature = self.target_temperature
+                self._temperature_clock = self.clock + seconds
+                return self._add('heating', seconds)
+        elif command in ('M0', 'M1'):
+            self.pauses += 1
+        return None, 0.0
+
+    def feed_lines(self, lines):
+        for line in lines:
+            self.feed(line)
+        return self
+
+    def report(self):
+        """
+        Summary of the replayed stream.
+
+        :return: Dictionary with the total runtime in seconds, the per-category breakdown and line counts
+        """
+        return {
+            'total': sum(self.totals.values()),
+            'breakdown': dict(self.totals),
+            'counts': dict(self.counts),
+            'lines': self.lines,
+            'pauses': self.pauses,
+        }
+
+
+def estimate_runtime(lines, **kwargs):
+    """
+    Estimate the runtime of a G-code stream.
+
+    :param lines: Iterable of G-code lines (e.g. an open .gcode file or get_emitter().lines)
+    :param kwargs: Model parameters passed to MachineTimeEstimator
+    :return: Report dictionary, see MachineTimeEstimator.report()
+    """
+    return MachineTimeEstimator(**kwargs).feed_lines(lines).report()
+
+
+def estimate_file(filename, **kwargs):
+    with open(filename) as f:
+        return estimate_runtime(f, **kwargs)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f'{hours:d}:{minutes:02d}:{seconds:05.2f}'
+
+
+def format_report(report):
+    rows = [f"Total runtime: {format_duration(report['total'])} ({report['total']:.1f} s, {report['lines']} lines)"]
+    for category in CATEGORIES:
+        seconds = report['breakdown'][category]
+        share = 100 * seconds / report['total'] if report['total'] else 0
+        rows.append(f"  {category:<8} {seconds:10.1f} s {share:5.1f}%  ({report['counts'][category]} commands)")
+    if report['pauses']:
+        rows.append(f"  + {report['pauses']} operator pause(s) (M0) not included")
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    for filename in sys.argv[1:]:
+        print(filename)
+        print(format_report(estimate_file(filename)))
@@ -1,128 +1,158 @@
 from gcode_generator_v1_2 import *  # Import all functions from gcode_generator_v1_1
-from io import StringIO
-import sys
+from step_cache import cached_step
+from step_scheduler import Step, schedule
+
+# One sample: role -> (labware, position, volume in μL). Each role is preloaded under its own name; batch_protocol.py
+# runs several samples in one program, with positions allocated per sample.
+SAMPLE_LAYOUT = {
+    'waste1': (tube3_rimless, '13', 0),
+    'waste2': (tube3_rimless, '14', 0),
+    'waste3': (tube3_rimless, '15', 0),
+    'waste4': (tube3_rimless, '16', 0),
+    'waste5': (tube3_rimless, '17', 0),
+    'Elution_final': (tube3_rimless, '24', 0),
+    'Sample': (plate_96_biorad, 'B1', 100),
+    'LB1': (plate_96_biorad, 'B2', 100),  # Proteinase K (5uL) and Lysis buffer mixed (95ul)
+    'EB6': (plate_96_biorad, 'B3', 50),
+    'Premix': (tube2, '1', 0),
+    'BB2+MB': (tube2, '2', 360),  # Binding buffer (350uL) and magnetic beads (10uL) mixed
+    'WB3': (tube2, '3', 200),
+    'WB4': (tube2, '4', 200),
+}
+
+LYSIS_INCUBATION = (8 * 60, None)  # seconds between the end of the lysis mix and binding (minimum, maximum)
+
+
+def generate_and_save_gcode(filename=f"{__file__[:-3]}.gcode"):
+    get_emitter().clear()
 
+    # Load samples
+    for role, (module, well_location, volume) in SAMPLE_LAYOUT.items():
+        preload_volume(module, well_location, volume, role)
 
-class GCodePrinter:
-    def __init__(self, filename):
-        self.terminal = sys.stdout
-        self.gcode_file = open(filename, 'w')
-        self.gcode_buffer = StringIO()
+    # 1. Start the system by homing!
+    G28()
 
-    def write(self, message):
-        if message.strip().startswith('G'):
-            self.gcode_buffer.write(message)
-            self.gcode_file.write(message)
-        if message.strip().startswith('M'):
-            self.gcode_buffer.write(message)
-            self.gcode_file.write(message)
-        self.terminal.write(message)
+    # Your code from here
+    process_sample({role: role for role in SAMPLE_LAYOUT})
 
-    def flush(self):
-        self.terminal.flush()
-        self.gcode_file.flush()
+    end()
 
+    # Save the buffered G-code
+    get_emitter().to_file(filename)
 
-def generate_and_save_gcode():
-    gcode_printer = GCodePrinter(f"{__file__[:-3]}.gcode")
-    sys.stdout = gcode_printer
+    print(f"G-code has been saved to {filename}")
 
-    # Load samples
-    preload_volume(tube3_rimless, '13', 0, 'waste1')
-    preload_volume(tube3_rimless, '14', 0, 'waste2')
-    preload_volume(tube3_rimless, '15', 0, 'waste3')
-    preload_volume(tube3_rimless, '16', 0, 'waste4')
-    preload_volume(tube3_rimless, '17', 0, 'waste5')
-    preload_volume(tube3_rimless, '24', 0, 'Elution_final')
-    preload_volume(plate_96_biorad, 'B1', 100, 'Sample')
-    preload_volume(plate_96_biorad, 'B2', 100, 'LB1') #Proteinase K (5uL) and Lysis buffer mixed (95ul)
-    preload_volume(plate_96_biorad, 'B3', 50, 'EB6')
-    preload_volume(tube2, '1', 0, 'Premix')
-    preload_volume(tube2, '2', 360, 'BB2+MB') #Binding buffer (350uL) and magnetic beads (10uL) mixed
-    preload_volume(tube2, '3', 200, 'WB3')
-    preload_volume(tube2, '4', 200, 'WB4')
 
-    # 1. Start the system by homing!
-    G28()
+def sample_steps(names, volumes=None):
+    """
+    Steps of one sample for the step scheduler: the lysis incubation can be filled with other work (e.g. another
+    sample's lysis); from binding on, the sample keeps its tip until the elution.
 
-    # Your code from here
+    :param names: Role in SAMPLE_LAYOUT -> custom name the sample's tube/well is preloaded under
+    :param volumes: Role -> starting volume in μL (not used: the steps move fixed volumes)
+    :return: List of Steps
+    """
+    lysis_step = Step('lysis', lambda: lysis(names))
+    return [lysis_step, Step('extraction', lambda: extraction(names), after={lysis_step: LYSIS_INCUBATION})]
+
+
+def process_sample(names, volumes=None):
+    """
+    Extract one sample.
+
+    :param names: Role in SAMPLE_LAYOUT -> custom name the sample's tube/well is preloaded under
+    :param volumes: Role -> starting volume in μL (not used: the steps move fixed volumes)
+    """
+    schedule(sample_steps(names, volumes))
+
+
+def extraction(names):
+    binding(names)
+    pellet_beads(names)
+    wash(names['WB3'], names['waste4'], feedrate=40)
+    wash(names['WB4'], names['waste5'], feedrate=50)
+    heat_beads()
+    elute(names)
+
+
+# Protocol steps: each step's G-code is cached (see step_cache.py), so editing one step only regenerates that step
+# and the steps after it whose starting state changed
+@cached_step
+def lysis(names):
     # Premix samples and lysis
     new_tip(E1_yellow_tips)
-    aspirate_volume(100, custom_name='Sample', air_gap=True, deadpump_vol=5)
-    dispense_volume(custom_name='Premix', blowout=True, touch_tip=True, direct=True)
+    aspirate_volume(100, custom_name=names['Sample'], air_gap=True, deadpump_vol=5)
+    dispense_volume(custom_name=names['Premix'], blowout=True, touch_tip=True, direct=True)
     eject()
     new_tip(E1_yellow_tips)
-    aspirate_volume(100, custom_name='LB1', air_gap=True, deadpump_vol=5)
-    dispense_volume(custom_name='Premix', blowout=True, touch_tip=True, direct=True)
+    aspirate_volume(100, custom_name=names['LB1'], air_gap=True, deadpump_vol=5)
+    dispense_volume(custom_name=names['Premix'], blowout=True, touch_tip=True, direct=True)
 
-    mix(20, mix_volume=100, custom_name='Premix', aspirate_feedrate=2500, dispense_feedrate=2500)
+    mix(20, mix_volume=100, custom_name=names['Premix'], aspirate_feedrate=2500, dispense_feedrate=2500)
     eject()
-    incubation_duration = 8 * 60
-    print(f'G4 P{incubation_duration * 1000}\n')
 
+
+@cached_step
+def binding(names):
     new_tip(E1_yellow_tips)
     for i in range(3):
-        aspirate_volume(100, custom_name='BB2+MB', air_gap=False, deadpump_vol=5)
-        dispense_volume(custom_name='Premix', blowout=True, touch_tip=True, direct=True)
-    aspirate_volume(60, custom_name='BB2+MB', air_gap=False, deadpump_vol=5)
-    dispense_volume(custom_name='Premix', blowout=True, touch_tip=True, direct=True)
+        aspirate_volume(100, custom_name=names['BB2+MB'], air_gap=False, deadpump_vol=5)
+        dispense_volume(custom_name=names['Premix'], blowout=True, touch_tip=True, direct=True)
+    aspirate_volume(60, custom_name=names['BB2+MB'], air_gap=False, deadpump_vol=5)
+    dispense_volume(custom_name=names['Premix'], blowout=True, touch_tip=True, direct=True)
 
-    mix(15, mix_volume=100, custom_name='Premix', aspirate_feedrate=2500, dispense_feedrate=2500)
+    mix(15, mix_volume=100, custom_name=names['Premix'], aspirate_feedrate=2500, dispense_feedrate=2500)
     incubation_duration = 4 * 60
-    print(f'G4 P{incubation_duration * 1000}\n')
-    mix(15, mix_volume=100, custom_name='Premix', aspirate_feedrate=2500, dispense_feedrate=2500)
+    emit(f'G4 P{incubation_duration * 1000}')
+    mix(15, mix_volume=100, custom_name=names['Premix'], aspirate_feedrate=2500, dispense_feedrate=2500)
+
 
+@cached_step
+def pellet_beads(names):
     # Pellet magnetic beads
-    waste_containers = ['waste1', 'waste2']
+    waste_containers = [names['waste1'], names['waste2']]
     for j in waste_containers:
         for i in range(2):
-            aspirate_volume(100, custom_name='Premix', air_gap=False, deadpump_vol=5)
+            aspirate_volume(100, custom_name=names['Premix'], air_gap=False, deadpump_vol=5)
             pipette_pellet(feedrate=50, pellet_duration=10, pellet_height=12.2, custom_name=j, action='dispense',
                            direct=True, touch_tip=True)
 
-    aspirate_volume(100, custom_name='Premix', air_gap=False, deadpump_vol=5)
-    pipette_pellet(feedrate=40, pellet_duration=10, pellet_height=12.2, custom_name='waste3', action='dispense',
+    aspirate_volume(100, custom_name=names['Premix'], air_gap=False, deadpump_vol=5)
+    pipette_pellet(feedrate=40, pellet_duration=10, pellet_height=12.2, custom_name=names['waste3'], action='dispense',
                    direct=True, touch_tip=True)
-    aspirate_volume(80, custom_name='Premix', air_gap=False, deadpump_vol=10)
-    pipette_pellet(feedrate=40, pellet_duration=10, pellet_height=12.2, custom_name='waste3', action='dispense',
+    aspirate_volume(80, custom_name=names['Premix'], air_gap=False, deadpump_vol=10)
+    pipette_pellet(feedrate=40, pellet_duration=10, pellet_height=12.2, custom_name=names['waste3'], action='dispense',
                    double_pellet=True, double_pellet_height=30, double_pellet_duration=30,
                    direct=True, touch_tip=True)
 
-    # Wash magnetic beads (WB3)
-    mix(20, mix_volume=100, custom_name='WB3', aspirate_feedrate=2500, dispense_feedrate=2500)
-    for i in range(2):
-        aspirate_volume(100, custom_name='WB3', air_gap=False, deadpump_vol=5)
-        pipette_pellet(feedrate=40, pellet_duration=5, pellet_height=12.2, custom_name='waste4', action='dispense',
-                       double_pellet=True, double_pellet_height=30, double_pellet_duration=30,
-                       direct=True)
 
-    # Wash magnetic beads (WB4)
-    mix(20, mix_volume=100, custom_name='WB4', aspirate_feedrate=2500, dispense_feedrate=2500)
+@cached_step
+def wash(reagent, waste, feedrate):
+    # Wash magnetic beads
+    mix(20, mix_volume=100, custom_name=reagent, aspirate_feedrate=2500, dispense_feedrate=2500)
     for i in range(2):
-        aspirate_volume(100, custom_name='WB4', air_gap=False, deadpump_vol=5)
-        pipette_pellet(feedrate=50, pellet_duration=5, pellet_height=12.2, custom_name='waste5', action='dispense',
+        aspirate_volume(100, custom_name=reagent, air_gap=False, deadpump_vol=5)
+        pipette_pellet(feedrate=feedrate, pellet_duration=5, pellet_height=12.2, custom_name=waste, action='dispense',
                        double_pellet=True, double_pellet_height=30, double_pellet_duration=30,
                        direct=True)
 
+
+@cached_step
+def heat_beads():
     # Heat up pipette beads
     heat(temperature=65, duration=4*60, height_adj=+3, direct=True)
 
+
+@cached_step
+def elute(names):
     # Elute DNA (EB6)
-    mix(50, mix_volume=90, custom_name='EB6', aspirate_feedrate=2500, dispense_feedrate=2500)
-    aspirate_volume(50, custom_name='EB6', air_gap=True, air_gap_vol=50, deadpump_vol=10)
-    pipette_pellet(feedrate=50, pellet_duration=2 * 60, pellet_height=12.2, custom_name='Elution_final', action='dispense',
-                   direct=True, touch_tip=True)
+    mix(50, mix_volume=90, custom_name=names['EB6'], aspirate_feedrate=2500, dispense_feedrate=2500)
+    aspirate_volume(50, custom_name=names['EB6'], air_gap=True, air_gap_vol=50, deadpump_vol=10)
+    pipette_pellet(feedrate=50, pellet_duration=2 * 60, pellet_height=12.2, custom_name=names['Elution_final'],
+                   action='dispense', direct=True, touch_tip=True)
     eject()
 
-    end()
-
-    # Reset stdout
-    sys.stdout = sys.__stdout__
-
-    print(f"G-code has been saved to {__file__[:-3]}.gcode")
-    # print("G-code commands:")
-    # print(gcode_printer.gcode_buffer.getvalue())
-
 
 if __name__ == "__main__":
     generate_and_save_gcode()
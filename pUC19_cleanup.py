@@ -1,69 +1,71 @@
 from gcode_generator_v1_2 import *  # Import all functions from gcode_generator_v1_1
-from io import StringIO
-import sys
 
+# One sample: role -> (labware, position, volume in μL). Each role is preloaded under its own name; batch_protocol.py
+# runs several samples in one program, with positions allocated per sample.
+SAMPLE_LAYOUT = {
+    'Sample': (plate_96_biorad, 'A1', 50),
+    'RB': (plate_96_biorad, 'A2', 33),  # Resuspension buffer
+    'Waste': (tube3_rimless, '13', 0),
+    'Wash1': (tube3_rimless, '14', 100),
+    'Wash2': (tube3_rimless, '15', 100),
+    'Wash3': (tube3_rimless, '16', 100),
+    'Eluted_DNA': (tube3_rimless, '17', 0),
+    'AmpureXP': (tube2, '1', 400),
+}
 
-class GCodePrinter:
-    def __init__(self, filename):
-        self.terminal = sys.stdout
-        self.gcode_file = open(filename, 'w')
-        self.gcode_buffer = StringIO()
 
-    def write(self, message):
-        if message.strip().startswith('G'):
-            self.gcode_buffer.write(message)
-            self.gcode_file.write(message)
-        if message.strip().startswith('M'):
-            self.gcode_buffer.write(message)
-            self.gcode_file.write(message)
-        self.terminal.write(message)
-
-    def flush(self):
-        self.terminal.flush()
-        self.gcode_file.flush()
-
-
-def generate_and_save_gcode():
-    gcode_printer = GCodePrinter(f"{__file__[:-3]}.gcode")
-    sys.stdout = gcode_printer
+def generate_and_save_gcode(filename=f"{__file__[:-3]}.gcode"):
+    get_emitter().clear()
 
     # Reagent loading
-    sample_vol = 50
-    preload_volume(plate_96_biorad, 'A1', sample_vol, 'Sample')
-    preload_volume(plate_96_biorad, 'A2', 33, 'RB') #Resuspension buffer
-    preload_volume(tube3_rimless, '13', 0, 'Waste')
-    preload_volume(tube3_rimless, '14', 100, 'Wash1')
-    preload_volume(tube3_rimless, '15', 100, 'Wash2')
-    preload_volume(tube3_rimless, '16', 100, 'Wash3')
-    preload_volume(tube3_rimless, '17', 0, 'Eluted_DNA')
-    preload_volume(tube2, '1', 400, 'AmpureXP')
+    for role, (module, well_location, volume) in SAMPLE_LAYOUT.items():
+        preload_volume(module, well_location, volume, role)
 
     # 1. Start the system by homing!
     # start()
     G28()
 
     # Your code from here
+    process_sample({role: role for role in SAMPLE_LAYOUT},
+                   {role: volume for role, (_, _, volume) in SAMPLE_LAYOUT.items()})
+
+    end()
+
+    # Save the buffered G-code
+    get_emitter().to_file(filename)
+
+    print(f"G-code has been saved to {filename}")
+
+
+def process_sample(names, volumes):
+    """
+    Clean up one sample.
+
+    :param names: Role in SAMPLE_LAYOUT -> custom name the sample's tube/well is preloaded under
+    :param volumes: Role -> starting volume in μL (the sample volume sets the supernatant volume)
+    """
     new_tip(E1_yellow_tips)
 
     # Mix magnetic beads and Sample
+    sample_vol = volumes['Sample']
     ampureXP_vol = 60
-    aspirate_volume(ampureXP_vol, custom_name='AmpureXP', air_gap=True)
-    dispense_volume(custom_name='Sample', blowout=True, touch_tip=True, direct=True)
-    mix(15, mix_volume=100, custom_name='Sample', direct=False)
+    aspirate_volume(ampureXP_vol, custom_name=names['AmpureXP'], air_gap=True)
+    dispense_volume(custom_name=names['Sample'], blowout=True, touch_tip=True, direct=True)
+    mix(15, mix_volume=100, custom_name=names['Sample'], direct=False)
     incubation_duration = 30
-    print(f'G4 P{incubation_duration * 1000}\n')  # G4 P<duration in milliseconds>
-    mix(15, mix_volume=100, custom_name='Sample', direct=False)
+    emit(f'G4 P{incubation_duration * 1000}')  # G4 P<duration in milliseconds>
+    mix(15, mix_volume=100, custom_name=names['Sample'], direct=False)
 
     # Remove supernatant
     iterations = 2
     total_vol = ampureXP_vol + sample_vol + 5
     for _ in range(iterations):
-        aspirate_volume(total_vol/iterations, custom_name='Sample', air_gap=True, deadpump_vol=5)
-        pipette_pellet(feedrate=10, pellet_duration=80, pellet_height=12.2, custom_name='Waste',
+        aspirate_volume(total_vol/iterations, custom_name=names['Sample'], air_gap=True, deadpump_vol=5)
+        pipette_pellet(feedrate=10, pellet_duration=80, pellet_height=12.2, custom_name=names['Waste'],
                        action='dispense', direct=True, touch_tip=True)
 
     # IPA washing steps
-    ipa_list = ['Wash1', 'Wash2', 'Wash3']
+    ipa_list = [names['Wash1'], names['Wash2'], names['Wash3']]
     for ipa in ipa_list:
         pipette_pellet(feedrate=1000, pellet_duration=5, pellet_height=12.2, custom_name=ipa,
                        action='aspirate', action_feedrate=500, volume=100, direct=True)
@@ -73,23 +75,14 @@ def generate_and_save_gcode():
     # Heat up pipette beads
     heat(temperature=45, duration=30, direct=True)
 
-    aspirate_volume(33, custom_name='RB', air_gap=True, air_gap_vol=40, deadpump_vol=25)
+    aspirate_volume(33, custom_name=names['RB'], air_gap=True, air_gap_vol=40, deadpump_vol=25)
     pipette_mix(20, lower_limit=60, upper_limit=100, mix_feedrate=2500)
     incubation_duration = 60
-    print(f'G4 P{incubation_duration * 1000}\n')  # G4 P<duration in milliseconds>
-    pipette_pellet(feedrate=30, pellet_duration=60, pellet_height=12.2, custom_name='Eluted_DNA',
+    emit(f'G4 P{incubation_duration * 1000}')  # G4 P<duration in milliseconds>
+    pipette_pellet(feedrate=30, pellet_duration=60, pellet_height=12.2, custom_name=names['Eluted_DNA'],
                    action='dispense', direct=True, touch_tip=True)
     eject()
 
-    end()
-
-    # Reset stdout
-    sys.stdout = sys.__stdout__
-
-    print(f"G-code has been saved to {__file__[:-3]}.gcode")
-    # print("G-code commands:")
-    # print(gcode_printer.gcode_buffer.getvalue())
-
 
 if __name__ == "__main__":
     generate_and_save_gcode()
@@ -0,0 +1,83 @@
+"""
+Several protocols as one unattended job.
+
+The protocol scripts are generated one after the other into one program. They share one TipManager, so each protocol
+goes on with the tips the previous ones left, and a rack swap prompt (M0) is emitted only when every tip rack is
+empty. Between two protocols an M0 prompt asks the operator to load the deck for the next one; well volumes and
+preloads start afresh for every protocol.
+
+The tips left at the end can be saved to a file and loaded by the next job (or by protocol_validator.py), so a
+partly used rack is not thrown away between programs.
+
+Usage:
+    python protocol_chain.py YWHAZ_qPCR_protocol.py YWHAZ_qPCR_protocol.py -o job.gcode
+    python protocol_chain.py pUC19_amplification.py pUC19_cleanup.py --tip-state tips.json
+"""
+import argparse
+import os
+from contextlib import redirect_stdout
+
+from compile_protocols import ENTRY_POINT, load_protocol
+from gcode_generator_v1_2 import GCodeEmitter, ProtocolContext, TipManager
+from gcode_time_estimator import estimate_runtime
+
+
+def chain(paths, tips=None):
+    """
+    Generate protocol scripts into one program.
+
+    :param paths: Paths of the protocol scripts, in running order (a script may appear more than once)
+    :param tips: TipManager the job starts with (default is full tip racks); it is updated with the tips used
+    :return: Tuple (GCodeEmitter with the whole job, list of dictionaries per protocol with its name, lines, tips
+             taken and rack swaps)
+    """
+    tips = tips if tips is not None else TipManager()
+    job = GCodeEmitter()
+    parts = []
+    for n, path in enumerate(paths):
+        name = os.path.splitext(os.path.basename(path))[0]
+        module = load_protocol(path)
+        taken, swaps = sum(tips.taken.values()), tips.swaps
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), ProtocolContext(tips=tips) as ctx:
+            getattr(module, ENTRY_POINT)(os.devnull)
+        if n:
+            job.emit(f'M0 Load the deck for {name}! Press button to continue')
+        job.lines.extend(ctx.emitter.lines)
+        job.messages.extend(ctx.emitter.messages)
+        parts.append({'protocol': name, 'lines': len(ctx.emitter.lines), 'tips': sum(tips.taken.values()) - taken,
+                      'rack_swaps': tips.swaps - swaps})
+    return job, parts
+
+
+def format_chain(parts):
+    width = max([len('Protocol')] + [len(part['protocol']) for part in parts])
+    rows = [f"{'Protocol':<{width}}  {'Lines':>6}  {'Tips':>5}  {'Swaps':>5}"]
+    for part in parts:
+        rows.append(f"{part['protocol']:<{width}}  {part['lines']:>6}  {part['tips']:>5}  {part['rack_swaps']:>5}")
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate several protocol scripts as one program that shares the tip '
+                                                 'racks.')
+    parser.add_argument('scripts', nargs='+', help='Protocol scripts, in running order')
+    parser.add_argument('-o', '--output', default='job.gcode', help='Where to write the G-code (default: job.gcode)')
+    parser.add_argument('--tip-state', help='Start from the tips left in this file, and write the tips left at the '
+                                            'end back to it')
+    parser.add_argument('--no-swap', action='store_true', help='Fail instead of prompting for full tip racks')
+    args = parser.parse_args()
+
+    tips = TipManager(swap=not args.no_swap)
+    if args.tip_state and os.path.exists(args.tip_state):
+        tips.load(args.tip_state)
+    try:
+        job, parts = chain(args.scripts, tips)
+    except ValueError as error:
+        parser.exit(1, f'{error}\n')
+    job.to_file(args.output)
+    if args.tip_state:
+        tips.save(args.tip_state)
+    print(format_chain(parts))
+    left = sum(int(occupied.sum()) for occupied in tips.occupied.values())
+    print(f"{len(job.lines)} lines, {estimate_runtime(job.lines)['total'] / 60:.1f} min estimated, {left} tips left; "
+          f"written to {args.output}")
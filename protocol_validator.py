@@ -0,0 +1,270 @@
+"""
+Strict dry run of a protocol before it goes to the instrument.
+
+The protocol is generated in a fresh context (a shadow of the deck: its own well volumes, tip pointers and pipette
+contents) with a DryRun recorder attached in place of a profiler. The recorder snapshots the volumes of every rack
+and plate around each instrumented action call; afterwards the whole run is checked in a few vectorized passes:
+    negative_volume - a well drained below empty (aspirating more than it holds)
+    overflow        - a well filled over the capacity of its labware
+    tip_overfill    - the plunger drawn beyond the working volume of the mounted tip
+    envelope        - a commanded X/Y/Z/V position outside MACHINE_ENVELOPE
+    tips            - the tip racks running out (with a TipManager that does not swap racks)
+plus the problems the action functions worked around while generating (see flag()): an invalid well location (the
+move is skipped) and a dispense larger than the tip contents. An exception raised by the protocol ends the run and is
+reported as well. A mix volume clamped to one 95 μL stroke (the protocols mix 100 μL on purpose) is only a warning.
+
+Each error is a dictionary with the check, the message, the G-code line (1-based, None when no line applies) and
+the action call, its number among the action calls of the run and the protocol step it belongs to.
+
+Usage:
+    python protocol_validator.py YWHAZ_qPCR_protocol.py pUC19_cleanup.py
+    python protocol_validator.py magnetic_extraction_w_heater.py --json errors.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager, redirect_stdout
+
+import numpy as np
+
+from compile_protocols import ENTRY_POINT, load_protocol
+from gcode_generator_v1_2 import MACHINE_ENVELOPE, ProtocolContext, TipManager, TubeRack, current_context, deck
+from gcode_time_estimator import parse_line
+
+VOLUME_TOLERANCE = 1e-6  # μL of rounding allowed on well and plunger volumes
+AXES = tuple(MACHINE_ENVELOPE)
+WARNING_CHECKS = ('mix_volume',)  # Problems reported as warnings; the others are errors
+
+
+class DryRun:
+    """
+    Recorder for a dry run; attach it as the profiler of a ProtocolContext (ProtocolContext(profiler=DryRun())).
+    """
+
+    def __init__(self):
+        self.calls = []  # One dictionary per action call, in order of start: action name and step
+        self.failed = None  # Index in calls of the innermost action an exception was raised in
+        self._frames = []  # Indices in calls of the running actions
+        self._racks = None
+        self._bounds = []  # Line count at every sync
+        self._labels = []  # (call index or -1, step) the lines before each sync belong to
+        self._volumes = []  # Volumes of every well after each sync
+        self._mounts = []  # [first line, end line, tip rack] of every tip mounted
+        self._problems = []  # Errors from the problems flagged by the actions, see flag()
+
+    def _label(self, ctx):
+        return self._frames[-1] if self._frames else -1, ctx.step
+
+    def sync(self):
+        """Close the stretch of G-code since the last sync and snapshot the deck."""
+        ctx = current_context()
+        if self._racks is None:
+            self._racks = [ctx.labware(module) for module in deck.labware if isinstance(module, TubeRack)]
+        label = self._label(ctx)
+        for check, line, message in ctx.problems[len(self._problems):]:
+            self._problems.append(dict({'check': check, 'message': message},
+                                       **self._located(*label, line=line or None)))
+        self._bounds.append(len(ctx.emitter.lines))
+        self._labels.append(label)
+        self._volumes.append(np.concatenate([rack.Vf for rack in self._racks]))
+
+    @contextmanager
+    def action(self, name):
+        """Record one action call; used by gcode_generator_v1_2.instrumented."""
+        self.sync()
+        ctx = current_context()
+        self.calls.append({'action': name, 'step': ctx.step})
+        self._frames.append(len(self.calls) - 1)
+        try:
+            yield
+        except Exception:
+            if self.failed is None:
+                self.failed = self._frames[-1]
+            raise
+        finally:
+            self.sync()
+            self._frames.pop()
+        lines = len(ctx.emitter.lines)
+        if name == 'new_tip':
+            self._mounts.append([lines, None, ctx.tips.last])
+        elif name == 'eject' and self._mounts and self._mounts[-1][1] is None:
+            self._mounts[-1][1] = lines
+
+    def _where(self, line):
+        """Error fields locating a line index: the line number and the action call it belongs to."""
+        segment = int(np.searchsorted(self._bounds, line, side='right'))
+        call, step = self._labels[segment] if segment < len(self._labels) else (-1, None)
+        return self._located(call, step, line + 1)
+
+    def _located(self, call, step, line=None):
+        if call < 0:
+            return {'line': line, 'action': None, 'call': None, 'step': step}
+        return {'line': line, 'action': self.calls[call]['action'], 'call': call + 1, 'step': step}
+
+    def _volume_errors(self):
+        if not self._volumes:
+            return []
+        volumes = np.vstack(self._volumes)
+        names = [(rack, well) for rack in self._racks for well in rack.well_names()]
+        capacity = np.concatenate([np.full(len(rack.Vf), np.inf if rack.capacity is None else rack.capacity)
+                                   for rack in self._racks])
+        errors = []
+        for check, bad in (('negative_volume', volumes < -VOLUME_TOLERANCE),
+                           ('overflow', volumes > capacity + VOLUME_TOLERANCE)):
+            wells = np.flatnonzero(bad.any(axis=0))
+            first = bad[:, wells].argmax(axis=0)
+            for well, sync in zip(wells, first):
+                rack, location = names[well]
+                volume = round(float(volumes[sync, well]), 3)
+                if check == 'overflow':
+                    message = f'-{rack.name} location {location} holds {volume} μL, over its {rack.capacity} μL.'
+                else:
+                    message = f'-{rack.name} location {location} is drained to {volume} μL.'
+                errors.append(dict({'check': check, 'message': message},
+                                   **self._located(*self._labels[sync], line=self._bounds[sync] or None)))
+        return errors
+
+    def _line_errors(self, lines):
+        """Envelope and tip volume of every commanded position."""
+        count = len(lines)
+        if not count:
+            return []
+        positions = {axis: np.full(count, np.nan) for axis in AXES}
+        for n, line in enumerate(lines):
+            command, words = parse_line(line)
+            if command in ('G0', 'G1', 'G2', 'G3'):
+                for axis in AXES:
+                    if words.get(axis) is not None:
+                        positions[axis][n] = words[axis]
+            elif command == 'G28':
+                for axis in [axis for axis in AXES if axis in words] or AXES:
+                    positions[axis][n] = 0.0
+        index = np.arange(count)
+        for axis, values in positions.items():  # Carry every position forward to the next command that moves it
+            known = np.maximum.accumulate(np.where(np.isnan(values), 0, index))
+            positions[axis] = values[known]
+
+        limit = np.full(count, np.inf)  # Plunger limit of the tip mounted at each line
+        for first, end, rack in self._mounts:
+            limit[first:end] = rack.working_volume if rack.working_volume is not None else MACHINE_ENVELOPE['V'][1]
+
+        checks = []
+        for axis, (low, high) in MACHINE_ENVELOPE.items():
+            values = positions[axis]
+            checks.append(('envelope', axis, (values < low) | (values > high),
+                           lambda value, axis=axis, low=low, high=high:
+                           f'-{axis}{value} is outside the reach of the axis ({low} to {high}).'))
+        checks.append(('tip_overfill', 'V', positions['V'] > limit + VOLUME_TOLERANCE,
+                       lambda value: f'-Plunger at {value} μL, over the working volume of the tip.'))
+
+        errors = []
+        for check, axis, bad, describe in checks:
+            starts = np.flatnonzero(bad & ~np.concatenate(([False], bad[:-1])))  # First line of every offending run
+            for line in starts:
+                value = round(float(positions[axis][line]), 4)
+                errors.append(dict({'check': check, 'message': describe(value)}, **self._where(line)))
+        return errors
+
+    def errors(self, ctx=None, exception=None):
+        """
+        Check the recorded run.
+
+        :param ctx: The context of the run (default is the active one)
+        :param exception: Exception that ended the run, if any
+        :return: List of error dictionaries, in order of G-code line
+        """
+        ctx = ctx if ctx is not None else current_context()
+        errors = list(self._problems)
+        if exception is not None and str(exception) not in [error['message'] for error in errors]:
+            call = self.failed if self.failed is not None else -1
+            errors.append(dict({'check': 'exception', 'message': f'{type(exception).__name__}: {exception}'},
+                               **self._located(call, ctx.step, len(ctx.emitter.lines) or None)))
+        errors += self._volume_errors()
+        errors += self._line_errors(ctx.emitter.lines)
+        errors.sort(key=lambda error: (error['line'] is None, error['line'] or 0))
+        return errors
+
+
+def validate(function, *args, tips=None, **kwargs):
+    """
+    Dry-run a function that generates G-code (a protocol entry point, a batch, ...) in a fresh context.
+
+    :param function: The function; its output is thrown away
+    :param tips: TipManager the run starts with (default is full tip racks); it is not changed
+    :return: Dictionary with the errors, the warnings, the number of lines, action calls and tip rack swaps and the
+             seconds the check took
+    """
+    if tips is not None:
+        tips = tips.copy()
+    start = time.perf_counter()
+    recorder = DryRun()
+    exception = None
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), \
+            ProtocolContext(profiler=recorder, tips=tips) as ctx:
+        recorder.sync()
+        try:
+            function(*args, **kwargs)
+        except Exception as error:
+            exception = error
+        recorder.sync()
+        problems = recorder.errors(ctx, exception)
+    return {
+        'errors': [error for error in problems if error['check'] not in WARNING_CHECKS],
+        'warnings': [error for error in problems if error['check'] in WARNING_CHECKS],
+        'lines': len(ctx.emitter.lines),
+        'actions': len(recorder.calls),
+        'rack_swaps': ctx.tips.swaps,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def validate_protocol(path, tips=None):
+    """
+    Dry-run a protocol script.
+
+    :param path: Path of the protocol script
+    :param tips: TipManager the run starts with (default is full tip racks)
+    :return: Dictionary from validate() with the protocol name
+    """
+    module = load_protocol(path)
+    report = validate(getattr(module, ENTRY_POINT), os.devnull, tips=tips)
+    report['protocol'] = os.path.splitext(os.path.basename(path))[0]
+    return report
+
+
+def format_report(report, warnings=True):
+    rows = [f"{report['protocol']}: {len(report['errors']) or 'no'} errors, {len(report['warnings']) or 'no'} warnings "
+            f"({report['lines']} lines, {report['actions']} actions, {report['rack_swaps']} tip rack swaps, checked in "
+            f"{1e3 * report['seconds']:.1f} ms)"]
+    for error in report['errors'] + (report['warnings'] if warnings else []):
+        where = f"line {error['line']}" if error['line'] is not None else 'no line'
+        if error['action'] is not None:
+            where += f", {error['action']} (call {error['call']})"
+        if error['step'] is not None:
+            where += f", step {error['step']}"
+        rows.append(f"  {error['check']:<15}  {where}: {error['message']}")
+    return '\n'.join(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Dry-run protocol scripts and check the deck state, tip volumes and '
+                                                 'reach of the whole run.')
+    parser.add_argument('scripts', nargs='+', help='Protocol scripts to check')
+    parser.add_argument('--json', help='Write the reports to this JSON file')
+    parser.add_argument('--no-warnings', action='store_true', help='Only list the errors')
+    parser.add_argument('--tip-state', help='Start from the tips left in this file (see TipManager.save())')
+    parser.add_argument('--no-swap', action='store_true', help='Report running out of tips instead of a rack swap')
+    args = parser.parse_args()
+
+    tips = TipManager(swap=not args.no_swap)
+    if args.tip_state:
+        tips.load(args.tip_state)
+    reports = [validate_protocol(script, tips=tips) for script in args.scripts]
+    for report in reports:
+        print(format_report(report, warnings=not args.no_warnings))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
+    sys.exit(1 if any(report['errors'] for report in reports) else 0)
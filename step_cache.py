@@ -0,0 +1,302 @@
+"""
+Memoized protocol steps for incremental regeneration.
+
+A protocol can declare named steps with the @cached_step decorator. The G-code a step emits is cached under a key
+made of:
+    - the step name and the source of the step function
+    - the step arguments
+    - the incoming state of the context: liquid in the tip, named preloads, volumes and reagents in every rack and
+      plate on the deck, tips left in the tip racks, pipette position and modal words, protocol step label, dwell and
+      motion models and the acceleration last set
+    - the sources of the generator and the other local modules the protocol imports
+When the key is already in the cache, the step is not run: its G-code and log messages are spliced into the output
+and the context is set to the state the step left behind. So after editing one step of a protocol, only that step
+and the steps whose incoming state changed are generated again.
+
+Steps should take everything they depend on as arguments (or read it from the context); module-level constants of
+the protocol that a step reads are not part of the key.
+
+Usage in a protocol:
+    from step_cache import cached_step
+
+    @cached_step
+    def wash(reagent, waste, feedrate):
+        ...
+
+    python step_cache.py magnetic_extraction_w_heater.py            # regenerate, list the cached and rebuilt steps
+    python step_cache.py magnetic_extraction_w_heater.py --clear
+"""
+import argparse
+import hashlib
+import inspect
+import os
+import pickle
+import shutil
+import time
+from contextlib import redirect_stdout
+from functools import wraps
+
+import numpy as np
+
+from compile_protocols import ENTRY_POINT, HERE, load_protocol, local_dependencies
+from gcode_generator_v1_2 import GENERATOR_VERSION, Labware, ProtocolContext, TubeRack, current_context, deck
+
+DEFAULT_CACHE_DIR = os.path.join(HERE, '.gcode_cache', 'steps')
+
+
+def _update(digest, value):
+    """Feed a value into a hash: labware by name, arrays by content, containers recursively, the rest by repr."""
+    if isinstance(value, Labware):
+        digest.update(f'<{type(value).__name__} {value.name}>'.encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(str(value.dtype).encode() + str(value.shape).encode() + np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b'{')
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            digest.update(b':')
+            _update(digest, value[key])
+        digest.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        digest.update(b'(' if isinstance(value, tuple) else b'[')
+        for item in value:
+            _update(digest, item)
+            digest.update(b',')
+        digest.update(b')')
+    elif callable(value):
+        digest.update(f'<{getattr(value, "__module__", "")}.{getattr(value, "__qualname__", repr(value))}>'.encode())
+    else:
+        digest.update(repr(value).encode())
+
+
+def fingerprint(*values):
+    """Hex digest of values, see _update()."""
+    digest = hashlib.sha256()
+    for value in values:
+        _update(digest, value)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _racks(ctx):
+    """This context's instance of every rack and plate on the deck, in deck order."""
+    return [ctx.labware(module) for module in deck.labware if isinstance(module, TubeRack)]
+
+
+def capture_state(ctx):
+    """
+    Snapshot of everything in a context that a step can read or change.
+
+    :param ctx: The ProtocolContext
+    :return: Dictionary of plain values and arrays (picklable)
+    """
+    racks = _racks(ctx)
+    lines = ctx.emitter.lines
+    last = ctx.last_settle
+    return {
+        'aspirated_volume': ctx.aspirated_volume,
+        'deadpump_volume': ctx.deadpump_volume,
+        'air_gap_volume': ctx.air_gap_volume,
+        'preloads': {name: {'module': racks.index(preload['module']), 'well_location': preload['well_location'],
+                            'volume': preload['volume']}
+                     for name, preload in ctx.preloads.items()},
+        'volumes': [rack.Vf.copy() for rack in racks],
+        'contents': {key: sorted(reagents) for key, reagents in ctx.contents.items()},
+        'tip_contents': sorted(ctx.tip_contents),
+        'tips': ctx.tips.snapshot(),
+        'position': dict(ctx.position),
+        'feedrate': ctx.feedrate,
+        'modal': dict(ctx.modal),
+        'step': ctx.step,
+        'dwell_model': ctx.dwell_model,
+        'motion_model': ctx.motion_model,
+        'accel': ctx.accel,
+        # A settle pause at the start of a step merges with one that ends the previous step
+        'last_settle': last[2] if last is not None and last[0] is lines and last[1] == len(lines) - 1 else None,
+    }
+
+
+def restore_state(ctx, state):
+    """
+    Put a context in a captured state (the emitted G-code is not touched).
+
+    :param ctx: The ProtocolContext
+    :param state: Dictionary from capture_state()
+    """
+    racks = _racks(ctx)
+    ctx.aspirated_volume = state['aspirated_volume']
+    ctx.deadpump_volume = state['deadpump_volume']
+    ctx.air_gap_volume = state['air_gap_volume']
+    ctx.preloads.clear()
+    for name, preload in state['preloads'].items():
+        ctx.preloads[name] = dict(preload, module=racks[preload['module']])
+    for rack, volumes in zip(racks, state['volumes']):
+        rack.Vf[:] = volumes
+    ctx.contents = {key: set(reagents) for key, reagents in state['contents'].items()}
+    ctx.tip_contents = set(state['tip_contents'])
+    ctx.tips.restore(state['tips'])
+    ctx.position.update(state['position'])
+    ctx.feedrate = state['feedrate']
+    ctx.modal.update(state['modal'])
+    ctx.step = state['step']
+    ctx.accel = state['accel']
+    lines = ctx.emitter.lines
+    ctx.last_settle = (lines, len(lines) - 1, state['last_settle']) if state['last_settle'] is not None else None
+
+
+class StepCache:
+    """
+    Store of step outputs, in memory and (optionally) on disk so they survive between runs.
+
+    :param directory: Directory of the on-disk cache (default is .gcode_cache/steps next to this file); None keeps
+                      the entries in memory only
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        self.enabled = True
+        self.entries = {}
+        self.hits = []  # Names of the steps spliced from the cache, in order
+        self.misses = []  # Names of the steps that were generated
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.pickle')
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None and self.directory is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    entry = self.entries[key] = pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError):
+                return None
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        if self.directory is None:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f'{path}.{os.getpid()}.tmp'  # Written next to the entry first, so readers never see half of it
+        try:
+            with open(partial, 'wb') as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(partial, path)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            pass  # The step returned something that cannot be pickled; keep the entry in memory only
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def clear(self):
+        self.entries.clear()
+        if self.directory is not None and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+    def reset_stats(self):
+        self.hits.clear()
+        self.misses.clear()
+
+
+default_cache = StepCache()
+
+
+def _code_digest(function):
+    """Hash of a step function's source and of the local modules its file imports (generator, planners, ...)."""
+    digest = hashlib.sha256(GENERATOR_VERSION.encode())
+    try:
+        digest.update(inspect.getsource(function).encode())
+        path = inspect.getsourcefile(function)
+    except (OSError, TypeError):
+        digest.update(function.__code__.co_code)
+        path = None
+    for dependency in local_dependencies(path) if path else []:
+        with open(dependency, 'rb') as f:
+            digest.update(b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def cached_step(function=None, *, name=None, cache=None):
+    """
+    Memoize a protocol step; use as @cached_step or @cached_step(name=..., cache=...).
+
+    The step is run normally (and not cached) while a profiler is attached to the context, so its actions are still
+    reported.
+
+    :param function: The step function
+    :param name: Name of the step (default is the function name)
+    :param cache: StepCache to use (default is default_cache)
+    """
+    def decorate(function):
+        step_name = name or function.__name__
+        code = []  # Computed on the first call, when the protocol module is fully loaded
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            store = cache if cache is not None else default_cache
+            ctx = current_context()
+            if not store.enabled or ctx.profiler is not None:
+                return function(*args, **kwargs)
+            if not code:
+                code.append(_code_digest(function))
+            incoming = capture_state(ctx)
+            key = fingerprint(step_name, code[0], args, kwargs, incoming)
+
+            emitter = ctx.emitter
+            entry = store.get(key)
+            if entry is not None and entry['previous_line'] is not None:
+                # The step merged its first settle pause into the pause ending the previous step. The key holds the
+                # length of that pause; only splice if the last line really is it.
+                if incoming['last_settle'] is None or emitter.lines[-1] != f"G4 P{incoming['last_settle']}":
+                    entry = None
+            if entry is not None:
+                if entry['previous_line'] is not None:
+                    emitter.lines[-1] = entry['previous_line']
+                emitter.lines.extend(entry['lines'])
+                for message in entry['messages']:
+                    emitter.log(message)
+                restore_state(ctx, entry['state'])
+                store.hits.append(step_name)
+                return entry['result']
+
+            start, first_message = len(emitter.lines), len(emitter.messages)
+            previous_line = emitter.lines[start - 1] if start else None
+            result = function(*args, **kwargs)
+            store.put(key, {
+                'lines': emitter.lines[start:],
+                'messages': emitter.messages[first_message:],
+                # Only kept when the step rewrote the line before it (a merged settle pause)
+                'previous_line': emitter.lines[start - 1] if start and emitter.lines[start - 1] != previous_line
+                else None,
+                'state': capture_state(ctx),
+                'result': result,
+            })
+            store.misses.append(step_name)
+            return result
+        return wrapper
+
+    return decorate(function) if function is not None else decorate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Regenerate a protocol, reusing the cached output of its unchanged '
+                                                 'steps.')
+    parser.add_argument('script', help='Protocol script')
+    parser.add_argument('-o', '--output', help='Where to write the G-code (default: the script name with .gcode)')
+    parser.add_argument('--clear', action='store_true', help='Empty the step cache first')
+    args = parser.parse_args()
+
+    from step_cache import default_cache  # The instance the protocol's @cached_step uses, not this __main__ copy
+
+    if args.clear:
+        default_cache.clear()
+    module = load_protocol(args.script)
+    output = args.output or os.path.splitext(args.script)[0] + '.gcode'
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull), ProtocolContext():
+        getattr(module, ENTRY_POINT)(output)
+    seconds = time.perf_counter() - start
+    for label, steps in (('cached', default_cache.hits), ('rebuilt', default_cache.misses)):
+        print(f"{len(steps)} {label}: {', '.join(steps) or '-'}")
+    print(f'{output} generated in {1e3 * seconds:.1f} ms')
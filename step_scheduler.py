@@ -0,0 +1,207 @@
+"""
+Step scheduler that hides incubations behind other work.
+
+A protocol (or a batch of samples) is split into steps that start and end with the pipette free, i.e. without a tip
+holding liquid. Each step declares the steps it follows and, for each of them, an incubation window:
+    Step('binding', binding, after={lysis: (8 * 60, 30 * 60)})
+starts 8 to 30 minutes after the end of 'lysis'. Instead of running the steps in a fixed order with a G4 for every
+wait, schedule() fills each wait with steps that are ready (another sample's transfers, the next reagent's aliquots)
+and only emits a G4 when nothing can run. Machine time comes from the motion model of gcode_time_estimator.
+
+The order is chosen greedily, earliest deadline first: a ready step is only started if a simulated run of the rest
+of the schedule still meets every window. Step durations for the simulation come from one dry run of the steps
+(generated and thrown away); the windows are checked again on the times of the G-code actually emitted, and a
+window that cannot be met raises ValueError.
+
+Usage:
+    lysis = Step('lysis', lambda: lysis_step(names))
+    schedule([lysis, Step('binding', lambda: binding_step(names), after={lysis: (8 * 60, None)})])
+"""
+import copy
+import math
+
+from gcode_generator_v1_2 import current_context, emit, protocol_step
+from gcode_time_estimator import MachineTimeEstimator
+from step_cache import capture_state, restore_state
+
+WINDOW_TOLERANCE = 1.0  # seconds; the dry-run duration of a step differs slightly from the real one
+
+
+class Step:
+    """
+    A block of protocol actions that starts and ends with the pipette free.
+
+    :param name: Name of the step, used for the protocol step label and the report
+    :param action: Function without arguments that emits the step
+    :param after: Steps that must be finished first: an iterable of Steps, or a dictionary Step -> (minimum,
+                  maximum) seconds between the end of that step and the start of this one (maximum None: no limit)
+    """
+    __slots__ = ('name', 'action', 'after')
+
+    def __init__(self, name, action, after=()):
+        self.name = name
+        self.action = action
+        if isinstance(after, dict):
+            self.after = {step: (window[0] or 0, window[1]) for step, window in after.items()}
+        else:
+            self.after = {step: (0, None) for step in after}
+
+    def __repr__(self):
+        return f'Step({self.name!r})'
+
+
+def _topological(steps):
+    """
+    The steps in an order that respects their dependencies.
+
+    :raises ValueError: For a dependency on an unscheduled step, an empty window or circular dependencies
+    """
+    for step in steps:
+        for before, (minimum, maximum) in step.after.items():
+            if before not in steps:
+                raise ValueError(f'-Step {step.name} follows {before.name}, which is not scheduled.')
+            if maximum is not None and maximum < minimum:
+                raise ValueError(f'-Step {step.name}: the window after {before.name} ends before it starts.')
+    order, remaining = [], list(steps)
+    while remaining:
+        ready = [step for step in remaining if all(before in order for before in step.after)]
+        if not ready:
+            raise ValueError(f"-Circular dependencies between steps: {', '.join(step.name for step in remaining)}")
+        order.extend(ready)
+        remaining = [step for step in remaining if step not in ready]
+    return order
+
+
+def _window(step, ends):
+    """Earliest and latest start of a step whose predecessors have ended (latest is inf without a maximum)."""
+    earliest, latest = 0.0, math.inf
+    for before, (minimum, maximum) in step.after.items():
+        earliest = max(earliest, ends[before] + minimum)
+        if maximum is not None:
+            latest = min(latest, ends[before] + maximum)
+    return earliest, latest
+
+
+def _simulate(pending, ends, now, durations, first=None):
+    """
+    Run the rest of a schedule on estimated durations, earliest deadline first.
+
+    :param pending: Steps not started yet, in declaration order
+    :param ends: Step -> end time of the steps already run
+    :param now: Current machine time
+    :param durations: Step -> estimated seconds
+    :param first: Step to start right now (None: the simulation picks)
+    :return: Total seconds by which windows are missed (0 when the schedule is feasible)
+    """
+    ends = dict(ends)
+    pending = list(pending)
+    late = 0.0
+    if first is not None:
+        _, latest = _window(first, ends)
+        late += max(0.0, now - latest)
+        now += durations[first]
+        ends[first] = now
+        pending.remove(first)
+    while pending:
+        ready = [(_window(step, ends), n, step) for n, step in enumerate(pending)
+                 if all(before in ends for before in step.after)]
+        startable = [entry for entry in ready if entry[0][0] <= now]
+        if not startable:
+            now = min(entry[0][0] for entry in ready)
+            continue
+        (_, latest), _, step = min(startable, key=lambda entry: (entry[0][1], entry[1]))
+        late += max(0.0, now - latest)
+        now += durations[step]
+        ends[step] = now
+        pending.remove(step)
+    return late
+
+
+def _dry_run(ctx, estimator, steps):
+    """Machine seconds of each step, from generating them in order and throwing the output away."""
+    lines, messages = ctx.emitter.lines, ctx.emitter.messages
+    start, first_message, first_problem = len(lines), len(messages), len(ctx.problems)
+    last_line = lines[-1] if lines else None
+    state = capture_state(ctx)
+    profiler, ctx.profiler = ctx.profiler, None  # Trial output is not profiled
+    trial = copy.deepcopy(estimator)
+    durations = {}
+    try:
+        for step in steps:
+            begin, clock = len(lines), trial.clock
+            step.action()
+            for line in lines[begin:]:
+                trial.feed(line)
+            durations[step] = trial.clock - clock
+    finally:
+        del lines[start:]
+        del messages[first_message:]
+        del ctx.problems[first_problem:]
+        if last_line is not None:
+            lines[-1] = last_line
+        restore_state(ctx, state)
+        ctx.profiler = profiler
+    return durations
+
+
+def schedule(steps):
+    """
+    Emit steps in the active context, filling incubation waits with other ready steps.
+
+    :param steps: List of Steps; with equal deadlines, earlier steps go first
+    :return: List of dictionaries (one per step, in the order run) with the step name, start and end machine
+             seconds (from the start of the protocol) and the idle seconds waited before it
+    :raises ValueError: For unknown or circular dependencies, or a window that cannot be met
+    """
+    order = _topological(steps)
+    ctx = current_context()
+    estimator = MachineTimeEstimator()
+    estimator.feed_lines(ctx.emitter.lines)
+    durations = _dry_run(ctx, estimator, order)
+
+    lines = ctx.emitter.lines
+    pending, ends, timeline = list(steps), {}, []
+    idle = 0.0
+    while pending:
+        now = estimator.clock
+        ready = [step for step in pending if all(before in ends for before in step.after)]
+        windows = {step: _window(step, ends) for step in ready}
+        startable = sorted((step for step in ready if windows[step][0] <= now),
+                           key=lambda step: (windows[step][1], pending.index(step)))
+        choice = next((step for step in startable if not _simulate(pending, ends, now, durations, first=step)),
+                      None)
+        if choice is None:
+            waiting = [windows[step][0] for step in ready if windows[step][0] > now]
+            if waiting and (not startable or not _simulate(pending, ends, min(waiting), durations)):
+                # Nothing can run now without missing a window later: wait for the next step to become ready
+                wait = min(waiting) - now
+                emit(f'G4 P{round(wait * 1000)}')
+                estimator.feed(lines[-1])
+                idle += wait
+                continue
+            choice = startable[0]  # No order meets every window; run the most urgent step, it is reported if late
+
+        _, latest = windows[choice]
+        if now > latest + WINDOW_TOLERANCE:
+            before = min((before for before, (_, maximum) in choice.after.items() if maximum is not None),
+                         key=lambda before: ends[before] + choice.after[before][1])
+            raise ValueError(f'-Step {choice.name} cannot start within {choice.after[before][1]} s of the end of '
+                             f'{before.name}: it starts {now - ends[before]:.0f} s after it.')
+        protocol_step(choice.name)
+        begin = len(lines)
+        choice.action()
+        for line in lines[begin:]:
+            estimator.feed(line)
+        ends[choice] = estimator.clock
+        pending.remove(choice)
+        timeline.append({'step': choice.name, 'start': now, 'end': estimator.clock, 'idle': idle})
+        idle = 0.0
+    return timeline
+
+
+def format_schedule(timeline):
+    width = max([len('Step')] + [len(entry['step']) for entry in timeline])
+    rows = [f"{'Step':<{width}}  {'Start s':>8}  {'End s':>8}  {'Idle s':>7}"]
+    for entry in timeline:
+        rows.append(f"{entry['step']:<{width}}  {entry['start']:>8.0f}  {entry['end']:>8.0f}  {entry['idle']:>7.0f}")
+    return '\n'.join(rows)
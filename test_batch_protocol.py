@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from batch_protocol import MAGNET_POSITIONS, allocate, expand, generate_batch, read_sample_sheet, sample_volumes
+from compile_protocols import HERE, load_protocol
+from gcode_generator_v1_2 import E1_yellow_tips, ProtocolContext, TipManager
+
+PROTOCOL = os.path.join(HERE, 'pUC19_cleanup.py')
+
+
+@pytest.fixture(scope='module')
+def protocol():
+    return load_protocol(PROTOCOL)
+
+
+def test_one_sample_matches_the_protocol(protocol, generate):
+    ctx, batch = generate_batch(PROTOCOL, ['S1'])
+    single = generate(protocol)
+    assert ctx.emitter.lines == single.emitter.lines
+    assert batch[0]['names']['Sample'] == 'S1 Sample'
+
+
+def test_samples_get_their_own_positions(protocol):
+    ctx, batch = generate_batch(PROTOCOL, ['S1', 'S2'])
+    first, second = (entry['positions'] for entry in batch)
+    assert all(first[role] != second[role] for role in protocol.SAMPLE_LAYOUT)
+    for role, (_, position, _) in protocol.SAMPLE_LAYOUT.items():
+        assert (second[role][1] in MAGNET_POSITIONS) == (position in MAGNET_POSITIONS)
+    assert {'S1 Wash1', 'S2 Wash1'} <= set(ctx.preloads)
+    assert ctx.emitter.lines.count('G28 X V') == 1  # Homed once
+
+
+def test_batch_too_large_for_the_deck(protocol):
+    with pytest.raises(ValueError, match='3 samples do not fit on the deck.*room for 2 samples'):
+        allocate(protocol.SAMPLE_LAYOUT, 3)
+
+
+def test_tips_are_checked_before_anything_is_emitted(protocol):
+    tips = TipManager(slots=[E1_yellow_tips], swap=False)
+    tips.bitmap(E1_yellow_tips)[:-1] = False  # One tip left
+    with ProtocolContext(tips=tips) as ctx:
+        with pytest.raises(ValueError, match='2 samples need 2 tips'):
+            expand(protocol.process_sample, protocol.SAMPLE_LAYOUT, ['S1', 'S2'])
+        assert ctx.emitter.lines == []
+        assert tips.left(E1_yellow_tips) == 1
+
+
+def test_sample_sheet(tmp_path, protocol):
+    sheet = tmp_path / 'samples.csv'
+    sheet.write_text('sample,Sample,RB\nS1,40,\nS2,45.5,30\n', encoding='utf-8')
+    samples = read_sample_sheet(str(sheet))
+    assert samples == [{'sample': 'S1', 'Sample': 40.0}, {'sample': 'S2', 'Sample': 45.5, 'RB': 30.0}]
+    first, second = (sample_volumes(protocol.SAMPLE_LAYOUT, sample) for sample in samples)
+    assert (first['Sample'], first['RB']) == (40, protocol.SAMPLE_LAYOUT['RB'][2])
+    assert (second['Sample'], second['RB']) == (45.5, 30)
+
+    sheet.write_text('id,Sample\nS1,40\n', encoding='utf-8')
+    with pytest.raises(ValueError, match="'sample' column"):
+        read_sample_sheet(str(sheet))
+
+
+def test_invalid_batches(protocol):
+    with pytest.raises(ValueError, match='Duplicate sample ids: S1'):
+        generate_batch(PROTOCOL, ['S1', 'S1'])
+    with pytest.raises(ValueError, match='exceeds'):
+        generate_batch(PROTOCOL, [{'sample': 'S1', 'Wash1': 10000}])
@@ -0,0 +1,8 @@
+from benchmark_generator import bench_dispense_volume
+from gcode_generator_v1_2 import plate_384_biorad
+
+
+def test_dispense_benchmark_dispenses_liquid(ctx):
+    assert bench_dispense_volume(120) == 120
+    assert ctx.problems == []  # No dispense from an empty tip
+    assert ctx.labware(plate_384_biorad).Vf.sum() == 120
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from compile_protocols import ENTRY_POINT, HERE, cache_key, compile_protocols, find_protocols, local_dependencies
+from conftest import PROTOCOLS
+
+SCRIPTS = [os.path.join(HERE, f'{name}.py') for name in PROTOCOLS]
+
+
+def test_find_protocols():
+    found = find_protocols()
+    assert set(SCRIPTS) <= set(found)
+    assert os.path.join(HERE, 'compile_protocols.py') not in found
+
+
+def test_local_dependencies():
+    dependencies = [os.path.basename(path) for path in local_dependencies(os.path.join(HERE, 'YWHAZ_qPCR_protocol.py'))]
+    assert 'gcode_generator_v1_2.py' in dependencies
+    assert 'tip_planner.py' in dependencies
+    assert 'gcode_time_estimator.py' in dependencies  # Through tip_planner
+
+
+def test_compiled_and_cached_outputs_match_generation(tmp_path, run_script):
+    output, cache = tmp_path / 'out', tmp_path / 'cache'
+    first = compile_protocols(SCRIPTS, output_dir=str(output), cache_dir=str(cache), jobs=2)
+    assert sorted(first['compiled']) == sorted(SCRIPTS) and not first['cached'] and not first['failed']
+    expected = {name: run_script(name) for name in PROTOCOLS}
+    for name in PROTOCOLS:
+        assert (output / f'{name}.gcode').read_text().splitlines() == expected[name]
+
+    for name in PROTOCOLS:
+        (output / f'{name}.gcode').unlink()
+    second = compile_protocols(SCRIPTS, output_dir=str(output), cache_dir=str(cache), jobs=2)
+    assert sorted(second['cached']) == sorted(SCRIPTS) and not second['compiled']
+    for name in PROTOCOLS:
+        assert (output / f'{name}.gcode').read_text().splitlines() == expected[name]
+
+
+def test_cache_key_follows_the_source(tmp_path):
+    script = tmp_path / 'variant.py'
+    script.write_text(f'from gcode_generator_v1_2 import *\n\n\ndef {ENTRY_POINT}(filename):\n    G28()\n')
+    key = cache_key(str(script), '1', 'deck')
+    assert cache_key(str(script), '2', 'deck') != key
+    assert cache_key(str(script), '1', 'other deck') != key
+    script.write_text(script.read_text() + '    G4 P500\n')
+    assert cache_key(str(script), '1', 'deck') != key
+
+
+def test_failing_script_is_reported(tmp_path):
+    script = tmp_path / 'broken.py'
+    script.write_text(f'def {ENTRY_POINT}(filename):\n    raise RuntimeError("-No deck")\n')
+    result = compile_protocols([str(script)], output_dir=str(tmp_path / 'out'), cache_dir=str(tmp_path / 'cache'),
+                               jobs=1)
+    assert list(result['failed']) == [str(script)]
+    assert isinstance(result['failed'][str(script)], RuntimeError)
+    assert not os.listdir(tmp_path / 'cache')  # No partial entry
+
+
+@pytest.mark.parametrize('force', [False, True])
+def test_force_recompiles(tmp_path, force):
+    kwargs = dict(output_dir=str(tmp_path / 'out'), cache_dir=str(tmp_path / 'cache'), jobs=1)
+    compile_protocols(SCRIPTS[2:3], **kwargs)
+    result = compile_protocols(SCRIPTS[2:3], force=force, **kwargs)
+    assert (result['compiled'] if force else result['cached']) == SCRIPTS[2:3]
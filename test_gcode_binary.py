@@ -0,0 +1,68 @@
+import glob
+import os
+
+import pytest
+
+from compile_protocols import HERE
+from gcode_binary import (EXTENSION, MAGIC, RAW, compare_file, decode, encode, encode_command, pack, read_lines,
+                          unpack_payload)
+from gcode_generator_v1_2 import GCodeEmitter
+
+LIBRARY = sorted(glob.glob(os.path.join(HERE, 'Gcodes_protocol_library', '*.gcode')))
+
+
+def test_generated_protocols_round_trip(protocol_name, generate, tmp_path):
+    ctx = generate(protocol_name)
+    data = ctx.emitter.to_compact()
+    assert len(data) < len(ctx.emitter.to_bytes())
+    decoded = decode(data)
+    assert ''.join(line + '\n' for line in decoded).encode('ascii') == ctx.emitter.to_bytes()
+
+    path = tmp_path / f'{protocol_name}{EXTENSION}'
+    ctx.emitter.to_file(str(path))
+    assert read_lines(str(path)) == ctx.emitter.lines
+
+
+def test_emitter_writes_compact_files(tmp_path):
+    lines = ['G28', 'G1 X10 Y20 F3000', 'G4 P500', 'M0 Press button to continue']
+    emitter = GCodeEmitter()
+    for line in lines:
+        emitter.emit(line)
+    path = tmp_path / f'out{EXTENSION}'
+    emitter.to_file(str(path))
+    assert path.read_bytes() == emitter.to_compact()
+    assert decode(path.read_bytes()) == lines
+
+
+@pytest.mark.parametrize('path', LIBRARY, ids=os.path.basename)
+def test_library_round_trip(path):
+    assert compare_file(path, repeat=1)['round_trip']
+
+
+@pytest.mark.parametrize('line', [
+    'G1 X-0.5 Y130.4 Z0 F3000', 'G1 V-0', 'G1 X007', 'G1 Z1e3', 'G1 X10  Y20', 'G28 X', 'G4 P0.000001',
+    'M0 Load the deck! Press button to continue', 'T0', '', 'G1 X1 Y2 Z3 V4 F5 I6 J7 P8',
+])
+def test_unusual_lines_round_trip(line):
+    assert decode(encode([line])) == [line]
+
+
+def test_words_are_tokenized():
+    assert encode_command('G1 X10 F3000')[0] >> 3 != RAW
+    assert encode_command('M0 Press button to continue')[0] >> 3 == RAW
+    assert len(encode_command('G1 X10 F3000')) == 6  # Command, X word, 1-byte 10, F word, 2-byte 3000
+
+
+def test_bad_header():
+    with pytest.raises(ValueError, match='bad header'):
+        decode(b'G28\n')
+    with pytest.raises(ValueError, match='version'):
+        decode(MAGIC + bytes((99,)))
+
+
+def test_packets():
+    packet = pack(300, 'G1 Z65 F3000')
+    payload, check = packet[2:-1], packet[-1]
+    assert packet[1] == len(payload)
+    assert unpack_payload(payload, check) == (300, 'G1 Z65 F3000')
+    assert unpack_payload(payload, check ^ 1) is None
@@ -0,0 +1,63 @@
+import io
+import os
+import subprocess
+import sys
+
+from gcode_generator_v1_2 import G1, GCodeEmitter, emit, get_emitter, log, use_emitter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+LINES = ['G28', 'G1 X10 Y20 F3000', 'G4 P500', 'M0 Press button to continue']
+
+
+def filled():
+    emitter = GCodeEmitter()
+    for line in LINES:
+        emitter.emit(line)
+    emitter.log('-A message')
+    return emitter
+
+
+def test_outputs_agree(tmp_path):
+    emitter = filled()
+    expected = ''.join(line + '\n' for line in LINES)
+    assert emitter.getvalue() == expected
+    assert emitter.to_bytes() == expected.encode('ascii')
+    assert list(emitter.iter_lines()) == [line + '\n' for line in LINES]
+
+    path = tmp_path / 'out.gcode'
+    emitter.to_file(str(path))
+    assert path.read_bytes() == expected.encode('ascii')
+    stream = io.StringIO()
+    emitter.to_file(stream)
+    assert stream.getvalue() == expected
+
+
+def test_log_is_kept_apart(capsys):
+    emitter = filled()
+    assert emitter.messages == ['-A message']
+    assert '-A message' not in emitter.getvalue()
+    assert capsys.readouterr().out == ''
+    echoing = GCodeEmitter(echo=True)
+    echoing.log('-Shown')
+    assert capsys.readouterr().out == '-Shown\n'
+
+
+def test_use_emitter_restores_the_previous_one():
+    with use_emitter() as outer:
+        emit('G28')
+        with use_emitter() as scratch:
+            G1(x=10, feedrate=3000)
+            log('-Inside')
+            assert get_emitter() is scratch
+        assert get_emitter() is outer
+    assert outer.lines == ['G28']
+    assert scratch.lines and scratch.messages == ['-Inside']
+
+
+def test_protocol_keeps_gcode_off_stdout(tmp_path):
+    path = tmp_path / 'pUC19_cleanup.gcode'
+    script = f'import pUC19_cleanup; pUC19_cleanup.generate_and_save_gcode({str(path)!r})'
+    result = subprocess.run([sys.executable, '-c', script], cwd=HERE, check=True, capture_output=True, text=True)
+    assert result.stdout == f'G-code has been saved to {path}\n'
+    assert 'G28 X' in path.read_text()
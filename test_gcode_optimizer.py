@@ -0,0 +1,43 @@
+import glob
+import os
+
+import pytest
+
+from gcode_optimizer import optimize, replay_positions, verify_equivalent
+
+LIBRARY = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Gcodes_protocol_library',
+                                        '*.gcode')))
+
+
+def check(lines):
+    optimized, summary = optimize(lines, report=True)
+    assert summary['mismatches'] == []
+    assert summary['lines_after'] <= summary['lines_before']
+    assert summary['seconds_after'] <= summary['seconds_before'] + 1e-9
+    assert optimize(optimized) == optimized  # Nothing left to remove
+
+
+def test_generated_protocols_keep_positions(protocol_name, run_script):
+    check(run_script(protocol_name))
+
+
+@pytest.mark.parametrize('path', LIBRARY, ids=os.path.basename)
+def test_library_keeps_positions(path):
+    with open(path) as f:
+        check(f.read().splitlines())
+
+
+def test_peephole_rules():
+    lines = ['G1 Z65 F3000', 'G1 Z65 F3000', 'G1 X10 F3000', 'G4 P100', 'G4 P200', 'G1 Z10', 'G1 Z5', 'G1 Z8',
+             'G1 Z8 F500', 'G1 X20', 'M204 S1000', 'M204 S1000']
+    assert optimize(lines) == ['G1 Z65 F3000', 'G1 X10', 'G4 P300', 'G1 Z5', 'G1 Z8', 'G1 X20 F500', 'M204 S1000']
+    # The reversal Z5 -> Z8 is kept, the same-direction Z10 -> Z5 is collapsed
+    assert optimize(lines, collapse=False)[3:6] == ['G1 Z10', 'G1 Z5', 'G1 Z8']
+
+
+def test_verify_equivalent_reports_a_moved_sync_point():
+    original = ['G1 X10 Z20 F3000', 'G4 P500', 'G1 X30']
+    assert verify_equivalent(original, original) == []
+    mismatches = verify_equivalent(original, ['G1 X10 F3000', 'G4 P500', 'G1 X30'])
+    assert len(mismatches) == 2  # At the dwell and at the end
+    assert replay_positions(original)[1] == {'X': 30.0, 'Y': None, 'Z': 20.0, 'V': None}
@@ -0,0 +1,70 @@
+from gcode_generator_v1_2 import (E1_yellow_tips, G28, ProtocolContext, aspirate_volume, current_context,
+                                  dispense_volume, eject, new_tip, pipette_pellet, plate_384_biorad, preload_volume,
+                                  protocol_step, tube2, tube3)
+from gcode_profiler import ActionProfiler, METRICS
+
+
+def program():
+    """:return: Line numbers where the pipette_pellet call starts and ends"""
+    lines = current_context().emitter.lines
+    G28()
+    preload_volume(tube2, '1', 500, 'buffer')
+    preload_volume(tube3, '13', 100, 'beads')
+    protocol_step('Transfer')
+    new_tip(E1_yellow_tips)
+    aspirate_volume(20, custom_name='buffer')
+    dispense_volume(20, dispense_modules=[plate_384_biorad], well_locations='B2')
+    eject()
+    protocol_step('Pellet; beads')
+    new_tip(E1_yellow_tips)
+    start = len(lines)
+    pipette_pellet(pellet_duration=1, custom_name='beads', action='aspirate', volume=20)  # Calls aspirate_volume
+    end = len(lines)
+    eject()
+    return start, end
+
+
+def profiled():
+    profiler = ActionProfiler(root='test')
+    with ProtocolContext(profiler=profiler) as ctx:
+        profiler.sync()
+        span = program()
+        profiler.sync()
+    return profiler, ctx, span
+
+
+def test_every_line_is_charged_once():
+    profiler, ctx, _ = profiled()
+    lines = ctx.emitter.lines
+    assert profiler.totals()['lines'] == sum(costs[1] for costs in profiler.stacks.values()) == len(lines)
+    assert sum(step['lines'] for step in profiler.steps()) == len(lines)
+    assert profiler.totals()['bytes'] == sum(len(line) + 1 for line in lines)
+    assert [step['step'] for step in profiler.steps()] == [None, 'Transfer', 'Pellet; beads']
+
+
+def test_nested_action_adds_up():
+    profiler, ctx, (start, end) = profiled()
+    pellet = next(call for call in profiler.calls if call['action'] == 'pipette_pellet')
+    nested = [call for call in profiler.calls if call['stack'][:-1] == pellet['stack']]
+    assert [call['action'] for call in nested] == ['aspirate_volume']
+    stack = tuple(pellet['stack'])
+    own, children = profiler.stacks[stack], profiler.stacks[stack + ('aspirate_volume',)]
+    assert pellet['lines'] == own[1] + children[1] == end - start
+    assert nested[0]['lines'] == children[1] > 0
+    for n, metric in enumerate(METRICS):
+        assert abs(pellet[metric] - own[n] - nested[0][metric]) < 1e-9
+
+    # The nested call is also one of the aspirate_volume calls
+    aspirate = next(action for action in profiler.summary() if action['action'] == 'aspirate_volume')
+    assert aspirate['calls'] == 2
+
+
+def test_collapsed_stacks():
+    profiler, _, _ = profiled()
+    rows = profiler.collapsed('lines')
+    stacks = [row.rsplit(' ', 1)[0].split(';') for row in rows]
+    assert ['test'] in stacks  # G28 before the first step
+    assert ['test', 'Transfer', 'new_tip'] in stacks
+    assert ['test', 'Pellet, beads', 'pipette_pellet', 'aspirate_volume'] in stacks
+    assert all(stack[0] == 'test' for stack in stacks)
+    assert sum(int(row.rsplit(' ', 1)[1]) for row in rows) == profiler.totals()['lines']
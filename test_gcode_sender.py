@@ -0,0 +1,49 @@
+import asyncio
+import os
+from functools import reduce
+
+import pytest
+
+from compile_protocols import HERE
+from gcode_binary import read_lines
+from gcode_sender import FakePrinter, checksum, frame, stream_to_fake, strip_command
+
+PROTOCOL = os.path.join(HERE, 'Gcodes_protocol_library', 'pUC19_amplification.gcode')
+
+
+def expected_commands(path=PROTOCOL):
+    return [command for command in map(strip_command, read_lines(path)) if command]
+
+
+def test_framing():
+    assert checksum('N1 G28') == reduce(lambda value, byte: value ^ byte, b'N1 G28', 0)
+    assert frame(12, 'G1 X10') == f"N12 G1 X10*{checksum('N12 G1 X10')}"
+    assert strip_command('  G4 P500 ; settle  ') == 'G4 P500'
+    assert strip_command('; only a comment') == ''
+
+
+@pytest.mark.parametrize('compact', [False, None])
+def test_every_line_arrives_in_order(compact):
+    printer = FakePrinter(compact=True)
+    stats, printer = asyncio.run(stream_to_fake(PROTOCOL, printer, compact=compact))
+    assert printer.received == expected_commands()
+    assert stats['lines'] == len(printer.received)
+    assert stats['compact'] is (compact is None)
+    assert stats['resends'] == 0 and stats['stalls'] == 0
+
+
+def test_compact_packets_are_smaller():
+    ascii_stats, _ = asyncio.run(stream_to_fake(PROTOCOL, FakePrinter(compact=True), compact=False))
+    compact_stats, _ = asyncio.run(stream_to_fake(PROTOCOL, FakePrinter(compact=True)))
+    assert compact_stats['bytes'] < ascii_stats['bytes']
+
+
+def test_corrupted_lines_are_resent():
+    stats, printer = asyncio.run(stream_to_fake(PROTOCOL, FakePrinter(error_every=50)))
+    assert stats['resends'] > 0
+    assert printer.received == expected_commands()
+
+
+def test_compact_required_but_unsupported():
+    with pytest.raises(ConnectionError, match='compact'):
+        asyncio.run(stream_to_fake(PROTOCOL, FakePrinter(compact=False), compact=True))
@@ -0,0 +1,55 @@
+import asyncio
+import os
+
+import pytest
+
+from compile_protocols import HERE
+from gcode_simulator import PALHSimulator, send_to_simulator
+from gcode_time_estimator import estimate_runtime
+
+PROTOCOL = os.path.join(HERE, 'Gcodes_protocol_library', 'pUC19_amplification.gcode')
+
+
+def library_lines():
+    with open(PROTOCOL) as f:
+        return f.read().splitlines()
+
+
+def test_clock_matches_the_estimate():
+    lines = library_lines()
+    report = PALHSimulator().run(lines)
+    assert report['clock'] == pytest.approx(estimate_runtime(lines)['total'])
+    assert report['commands'] == sum(1 for line in lines if line.split(';', 1)[0].strip())
+
+
+def test_machine_state():
+    simulator = PALHSimulator(pause_seconds=30)
+    report = simulator.run(['G28', 'G1 X10 Y20 Z30 F3000', 'G1 V25 F500', 'M140 S60', 'M0 Press button', 'M999'])
+    assert report['position'] == {'X': pytest.approx(10), 'Y': pytest.approx(20), 'Z': pytest.approx(30),
+                                  'V': pytest.approx(25)}
+    assert report['plunger_volume'] == pytest.approx(25)
+    assert report['pauses'] == 1
+    assert report['temperature'] > 22  # The heater warms up during the operator pause
+    assert report['warnings'] == [(6, 'Unknown command: M999')]
+
+
+def test_moves_before_homing_are_reported_once():
+    report = PALHSimulator().run(['G1 Z10 F600', 'G1 Z20', 'G28', 'G1 X5'])
+    assert report['warnings'] == [(1, 'Z moved before homing: G1 Z10 F600')]
+
+
+def test_wall_clock_scaling():
+    simulator = PALHSimulator(speed=10)
+    simulator.execute('G28')
+    assert simulator.execute('G4 P2000') == pytest.approx(0.2)
+    assert PALHSimulator().execute('G4 P2000') == 0
+
+
+def test_streamed_through_the_sender():
+    direct = PALHSimulator().run(library_lines())
+    simulator = PALHSimulator()
+    stats = asyncio.run(send_to_simulator(PROTOCOL, simulator))
+    assert stats['resends'] == 0
+    report = simulator.report()
+    assert report['clock'] == pytest.approx(direct['clock'])
+    assert report['position'] == direct['position']
@@ -0,0 +1,49 @@
+import pytest
+
+from gcode_time_estimator import (AMBIENT_TEMPERATURE, HEATING_RATE, MachineTimeEstimator, estimate_file,
+                                  estimate_runtime, parse_line, trapezoid_time)
+
+
+@pytest.mark.parametrize('line, expected', [
+    ('G1 Z65 F3000', ('G1', {'Z': 65.0, 'F': 3000.0})),
+    ('g1 x-2.5 ; comment', ('G1', {'X': -2.5})),
+    ('N12 G4 P500*73', ('G4', {'P': 500.0})),
+    ('M0 Load the deck! Press button to continue', ('M0', {})),
+    ('  ; only a comment', (None, {})),
+    ('G28 X', ('G28', {'X': None})),
+])
+def test_parse_line(line, expected):
+    assert parse_line(line) == expected
+
+
+def test_trapezoid_time():
+    assert trapezoid_time(100, 10, 100) == pytest.approx(100 / 10 + 10 / 100)  # Cruises
+    assert trapezoid_time(0.25, 10, 100) == pytest.approx(0.1)  # Never reaches the cruise speed
+    assert trapezoid_time(10, 5, 0) == 2
+    assert trapezoid_time(0, 5, 100) == 0
+
+
+def test_axis_limits_from_the_stream():
+    estimator = MachineTimeEstimator(accel=0)
+    estimator.feed_lines(['M92 X80', 'M203 X5'])
+    assert estimator.feed('G1 X100 F6000') == ('travel', pytest.approx(20))
+    assert estimator.feed('G1 X100') == (None, 0.0)  # Already there
+    assert estimator.feed('G1 Z10 F600') == ('z', pytest.approx(1))
+
+
+def test_dwell_heating_and_pauses():
+    report = estimate_runtime(['G4 P500', 'G4 S2', 'M190 S72', 'M0 Press button to continue'])
+    assert report['breakdown']['dwell'] == pytest.approx(2.5)
+    assert report['breakdown']['heating'] == pytest.approx((72 - AMBIENT_TEMPERATURE) / HEATING_RATE)
+    assert report['pauses'] == 1
+    assert report['lines'] == 4
+    assert report['total'] == pytest.approx(sum(report['breakdown'].values()))
+
+
+def test_file_and_lines_agree(tmp_path):
+    lines = ['G28', 'M204 S1000', 'G1 X50 Y80 F3000', 'G1 Z30', 'G1 V40 F500', 'G2 X60 Y80 I5 J0', 'G4 P250']
+    path = tmp_path / 'moves.gcode'
+    path.write_text(''.join(line + '\n' for line in lines))
+    report = estimate_runtime(lines)
+    assert estimate_file(str(path)) == report
+    assert all(report['counts'][category] for category in ('travel', 'z', 'plunger', 'dwell', 'homing'))
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from gcode_generator_v1_2 import AXIS_DECIMALS, G1, G28, emit, format_fixed, homing_pos, set_position
+
+
+@pytest.mark.parametrize('value, text', [
+    (65, '65'),
+    (65.0, '65'),
+    (12.34, '12.34'),
+    (12.340001, '12.34'),
+    (100.05, '100.05'),
+    (1.23456, '1.235'),
+    (2.0004, '2'),
+    (0.9996, '1'),
+    (-0.5, '-0.5'),
+    (-12.0, '-12'),
+    (-0.0, '0'),
+    (-0.0004, '0'),  # Rounds to zero, without a sign
+    (np.float64(3.1), '3.1'),
+    (np.int64(200), '200'),
+    (np.array(7.25), '7.25'),
+])
+def test_format_fixed(value, text):
+    assert format_fixed(value) == text
+
+
+def test_decimals_per_axis():
+    assert AXIS_DECIMALS['V'] == 4 and AXIS_DECIMALS['X'] == 3
+    assert format_fixed(12.34567, AXIS_DECIMALS['V']) == '12.3457'
+    assert format_fixed(12.34567, AXIS_DECIMALS['X']) == '12.346'
+    assert format_fixed(0.00006, AXIS_DECIMALS['V']) == '0.0001'
+    assert format_fixed(-1.10000, AXIS_DECIMALS['V']) == '-1.1'
+
+
+def test_only_changed_words_are_written(ctx):
+    G1(x=12.34567, y=20, p=12.34567, feedrate=3000)
+    G1(x=12.3461, y=25)  # X rounds to the same word
+    G1(y=25, feedrate=500)  # No move, only the feedrate changes
+    G1(z=10)
+    G1(z=10.0, feedrate=500)
+    G1(p=12.34574)  # V has 4 decimals
+    G1(p=12.34576)
+    assert ctx.emitter.lines == ['G1 X12.346 Y20 V12.3457 F3000', 'G1 Y25', 'G1 Z10 F500', 'G1 V12.3458']
+    assert ctx.position == {'X': 12.3461, 'Y': 25.0, 'Z': 10.0, 'V': 12.34576}
+
+
+def test_unknown_position_writes_the_words_again(ctx):
+    G1(x=50, y=50, feedrate=3000)
+    emit('G1 X0')  # A raw move the context does not follow
+    set_position(X=None)
+    G1(x=50, y=50)
+    assert ctx.emitter.lines == ['G1 X50 Y50 F3000', 'G1 X0', 'G1 X50']
+    assert ctx.position['X'] == 50
+
+
+@pytest.mark.parametrize('home, expected', [
+    (G28, ['G1 X50 Y50 Z20 F1000', 'G1 V10']),
+    (homing_pos, ['G1 X50 Y50 Z20 F1000']),  # Leaves the plunger where it was
+])
+def test_homing_writes_the_words_again(ctx, home, expected):
+    G1(x=50, y=50, z=20, p=10, feedrate=1000)
+    home()
+    start = len(ctx.emitter.lines)
+    G1(x=50, y=50, z=20, feedrate=1000)
+    G1(p=10)
+    assert ctx.emitter.lines[start:] == expected
+
+
+def test_homing_sets_the_feedrate(ctx):
+    G1(x=50, feedrate=1000)
+    G28()
+    G1(x=60, feedrate=3000)
+    assert ctx.emitter.lines[-1] == 'G1 X60'
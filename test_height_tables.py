@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from gcode_generator_v1_2 import HEIGHT_TABLE_TOLERANCE, check_height_tables, plate_384_biorad, tube2
+
+
+def test_tables_match_models():
+    deviations = check_height_tables()
+    assert deviations and max(deviations.values()) <= HEIGHT_TABLE_TOLERANCE
+
+
+@pytest.mark.parametrize('volume', [0, 5, 12.5, 40, 50])
+def test_scalar_volume(volume):
+    # 50 μL is beyond the 40 μL table of the plate and falls back to the exact model
+    height = plate_384_biorad.heights(volume)
+    assert np.shape(height) == ()
+    assert height == pytest.approx(plate_384_biorad.height(volume), abs=HEIGHT_TABLE_TOLERANCE)
+
+
+def test_array_shape_is_kept():
+    volumes = np.array([[0, 100, 2000], [250, 750, 1500]])
+    heights = tube2.heights(volumes)
+    assert heights.shape == volumes.shape
+    exact = [[tube2.height(volume) for volume in row] for row in volumes]
+    np.testing.assert_allclose(heights, exact, atol=HEIGHT_TABLE_TOLERANCE)
+
+
+def test_volumes_at_inverts_heights():
+    volumes = np.linspace(1, 40, 9)
+    np.testing.assert_allclose(plate_384_biorad.heights(plate_384_biorad.volumes_at(plate_384_biorad.heights(volumes))),
+                               plate_384_biorad.heights(volumes), atol=HEIGHT_TABLE_TOLERANCE)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from gcode_generator_v1_2 import plate_384_biorad, plate_96_biorad, well_creator, well_index
+
+# Well -> (flat index, X, Y) of the former dict plates, looked up as module['X'][row, col]
+FORMER_WELLS = {
+    '96-well plate (BioRad)': {
+        'A1': (0, 147.31, 100.25), 'A2': (1, 147.31, 109.25), 'B1': (12, 156.31, 100.25),
+        'B2': (13, 156.31, 109.25), 'C7': (30, 165.31, 154.25), 'H12': (95, 210.31, 199.25),
+    },
+    '384-well plate (BioRad)': {
+        'A1': (0, 145.04, 98.28), 'A2': (1, 145.04, 102.78), 'B1': (24, 149.54, 98.28),
+        'B2': (25, 149.54, 102.78), 'C7': (54, 154.04, 125.28), 'P24': (383, 212.54, 201.78),
+    },
+}
+# Arguments the plates were created with
+PLATES = [
+    (plate_96_biorad, dict(rows=8, cols=12, spacing=9.0, well1_diff_X=11.11, well1_diff_Y=14.25)),
+    (plate_384_biorad, dict(rows=16, cols=24, spacing=4.5, well1_diff_X=8.84, well1_diff_Y=12.28)),
+]
+
+
+def former_coordinates(rows, cols, spacing, well1_diff_X, well1_diff_Y):
+    """The element-by-element loop of the former well_creator()."""
+    X, Y = np.zeros((rows, cols)), np.zeros((rows, cols))
+    for i in range(rows):
+        for j in range(cols):
+            X[i, j] = 136.2 + well1_diff_X + i * spacing
+            Y[i, j] = 86 + well1_diff_Y + j * spacing
+    return X, Y
+
+
+@pytest.mark.parametrize('plate, layout', PLATES)
+def test_plates_keep_their_coordinates(plate, layout):
+    X, Y = former_coordinates(**layout)
+    assert np.array_equal(plate.X, X) and np.array_equal(plate.Y, Y)
+    assert np.array_equal(plate.Xf, X.ravel()) and np.array_equal(plate.Yf, Y.ravel())
+    assert (plate.rows, plate.cols) == (layout['rows'], layout['cols'])
+    for well, (index, x, y) in FORMER_WELLS[plate.name].items():
+        assert well_index(plate, well) == well_index(plate, well.lower()) == index
+        assert (plate.Xf[index], plate.Yf[index]) == (x, y)
+
+
+@pytest.mark.parametrize('plate, layout', PLATES)
+def test_well_names_follow_the_former_lookup(plate, layout):
+    names = plate.well_names()
+    assert len(names) == layout['rows'] * layout['cols'] == len(set(names))
+    X, Y = former_coordinates(**layout)
+    for name in names:
+        row, col = ord(name[0]) - ord('A'), int(name[1:]) - 1
+        index = well_index(plate, name)
+        assert index == row * layout['cols'] + col
+        assert (plate.Xf[index], plate.Yf[index]) == (X[row, col], Y[row, col])
+    assert well_index(plate, 'Q1') is None and well_index(plate, f"A{layout['cols'] + 1}") is None
+
+
+def test_created_plate_matches_the_former_loop():
+    layout = dict(rows=6, cols=10, spacing=7.3, well1_diff_X=3.3, well1_diff_Y=0.7)
+    plate = well_creator(Z0=1, top=10, height=lambda plate, v: v, well_radius=1, name='Test plate', **layout)
+    X, Y = former_coordinates(**layout)
+    assert np.array_equal(plate.X, X) and np.array_equal(plate.Y, Y)
+    assert plate.well_names()[:3] == ['A1', 'A2', 'A3'] and plate.well_names()[-1] == 'F10'
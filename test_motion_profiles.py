@@ -0,0 +1,84 @@
+import pytest
+
+from gcode_generator_v1_2 import (E1_yellow_tips, MOTION_PROFILES, ProtocolContext, aspirate_volume, dispense_volume,
+                                  eject, new_tip, pipette_load, plate_384_biorad, preload_volume, travel_feedrate,
+                                  tube2)
+
+# The program below with the former F3000 travel moves and firmware acceleration
+FIXED_LINES = [
+    'G1 Z65 F3000', 'G1 X93.5 Y112.7', 'G1 Z10', 'G1 Z3 F200', 'G1 Z65 F3000', 'G1 X129 Y61.6', 'G1 Z40',
+    'G1 V0 F1000', 'G1 V15 F500', 'G4 P500', 'G1 Z2.9 F3000', 'G1 V35 F500', 'G4 P500', 'G1 Z40 F3000',
+    'G1 V40 F300', 'G4 P100', 'G1 Z65 F3000', 'G1 X149.54 Y102.78', 'G1 Z11.4', 'G1 Z2.05', 'G1 V35 F500',
+    'G1 V15', 'G1 Z11.4 F3000', 'G1 Z100', 'G1 X62.5 Y75', 'G1 Z65', 'G1 Y48', 'G1 Z75 F200', 'G1 Z70 F500',
+    'G1 Y75 F3000',
+]
+
+
+def program():
+    preload_volume(tube2, '1', 500, 'buffer')
+    new_tip(E1_yellow_tips)
+    aspirate_volume(20, custom_name='buffer', air_gap=True)
+    dispense_volume(20, dispense_modules=[plate_384_biorad], well_locations='B2')
+    eject()
+
+
+@pytest.mark.parametrize('aspirated, deadpump, air_gap, load', [
+    (0, 0, 0, 'empty'),
+    (20, 0, 0, 'liquid'),
+    (20, 15, 5, 'liquid'),  # Liquid between the dead pump air and an air gap
+    (0, 15, 0, 'air'),
+    (0, 15, 5, 'air'),  # Dispensed, the air gap and dead pump air are left
+])
+def test_profile_follows_the_tip(ctx, aspirated, deadpump, air_gap, load):
+    ctx.aspirated_volume, ctx.deadpump_volume, ctx.air_gap_volume = aspirated, deadpump, air_gap
+    profile = MOTION_PROFILES[load]
+    assert pipette_load(ctx) == load
+    assert travel_feedrate('X', 'Y') == profile['X']
+    assert travel_feedrate('X', 'Y', 'Z') == profile['Z']
+    assert ctx.emitter.lines == [f"M204 S{profile['accel']}"]  # Set once for both moves
+
+
+def test_load_overrides_the_tip(ctx):
+    ctx.aspirated_volume = 20
+    assert travel_feedrate('X', 'Y', load='empty') == MOTION_PROFILES['empty']['X']
+    assert ctx.emitter.lines == [f"M204 S{MOTION_PROFILES['empty']['accel']}"]
+
+
+def test_travel_moves_take_the_profile_of_the_tip():
+    with ProtocolContext() as ctx:
+        program()
+    lines = ctx.emitter.lines
+    to_tips = lines.index('G1 X93.5 Y112.7 F12000')
+    to_well = lines.index('G1 X149.54 Y102.78 F3000')  # Liquid and an air gap
+    to_eject = lines.index('G1 X62.5 Y75 F9000')  # Air left after the dispense
+    accels = [line for line in lines if line.startswith('M204')]
+    assert accels == ['M204 S3000', 'M204 S1500', 'M204 S2000', 'M204 S1500', 'M204 S3000']
+    assert lines.index('M204 S3000') < to_tips < lines.index('M204 S1500') < to_well < lines.index('M204 S2000') < \
+        to_eject
+
+
+def test_fixed_model_keeps_the_former_travel():
+    with ProtocolContext(motion_model='fixed', dwell_model='fixed') as ctx:
+        program()
+    assert ctx.emitter.lines == FIXED_LINES
+    assert ctx.accel is None
+
+
+def test_no_redundant_acceleration(generate, protocol_name):
+    lines = generate(protocol_name).emitter.lines
+    accels = [line for line in lines if line.startswith('M204')]
+    assert accels
+    assert all(previous != accel for previous, accel in zip(accels, accels[1:]))
+
+
+def test_acceleration_is_only_set_on_change(ctx):
+    ctx.aspirated_volume = 20
+    travel_feedrate('X', 'Y')
+    ctx.aspirated_volume = 0
+    ctx.deadpump_volume = 15
+    travel_feedrate('Z')
+    travel_feedrate('X', 'Y', 'Z')
+    ctx.deadpump_volume = 0
+    ctx.accel = MOTION_PROFILES['empty']['accel']  # e.g. set by a raw M204
+    travel_feedrate('X', 'Y')
+    assert ctx.emitter.lines == ['M204 S1500', 'M204 S2000']
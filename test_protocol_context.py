@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import PROTOCOLS
+from gcode_generator_v1_2 import E1_yellow_tips, aspirate_volume, new_tip
+
+
+@pytest.fixture(scope='module')
+def contexts(generate):
+    return {name: generate(name).emitter.lines for name in PROTOCOLS}
+
+
+def test_context_matches_default_context(contexts, protocol_name, run_script):
+    assert run_script(protocol_name) == contexts[protocol_name]
+
+
+def test_concurrent_contexts_are_isolated(contexts, generate):
+    with ThreadPoolExecutor(max_workers=len(PROTOCOLS)) as pool:
+        outputs = [ctx.emitter.lines for ctx in pool.map(generate, PROTOCOLS * 2)]
+    assert outputs == [contexts[name] for name in PROTOCOLS * 2]
+
+
+def test_air_gap_at_current_position_needs_a_module(ctx):
+    new_tip(E1_yellow_tips)
+    lines = len(ctx.emitter.lines)
+    with pytest.raises(ValueError, match='air gap'):
+        aspirate_volume(10, air_gap=True)
+    assert len(ctx.emitter.lines) == lines
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from compile_protocols import HERE
+from gcode_generator_v1_2 import (E1_yellow_tips, G28, TipManager, aspirate_volume, dispense_volume, eject, emit,
+                                  new_tip, plate_384_biorad, preload_volume, protocol_step, tube2)
+from protocol_validator import validate, validate_protocol
+
+
+def checks(report):
+    return [error['check'] for error in report['errors']]
+
+
+def test_clean_protocol():
+    report = validate_protocol(os.path.join(HERE, 'pUC19_amplification.py'))
+    assert report['errors'] == []
+    assert [warning['check'] for warning in report['warnings']] == ['mix_volume']
+    assert report['protocol'] == 'pUC19_amplification'
+
+
+def test_drained_well_is_located():
+    report = validate_protocol(os.path.join(HERE, 'pUC19_cleanup.py'))
+    assert len(report['errors']) == 1
+    error = report['errors'][0]
+    assert error['check'] == 'negative_volume'
+    assert error['action'] == 'aspirate_volume'
+    assert 'location A1 is drained to -5.0 μL' in error['message']
+
+
+def drain_and_overflow():
+    G28()
+    preload_volume(tube2, '1', 50, 'buffer')
+    protocol_step('transfer')
+    new_tip(E1_yellow_tips)
+    aspirate_volume(80, custom_name='buffer')
+    dispense_volume(80, dispense_modules=[plate_384_biorad], well_locations='B2')
+    eject()
+
+
+def test_volume_errors():
+    report = validate(drain_and_overflow)
+    assert checks(report) == ['negative_volume', 'overflow']
+    drained, overflow = report['errors']
+    assert (drained['action'], drained['call'], drained['step']) == ('aspirate_volume', 2, 'transfer')
+    assert overflow['action'] == 'dispense_volume'
+    assert drained['line'] < overflow['line']
+
+
+def test_envelope_and_tip_volume():
+    def program():
+        G28()
+        emit('G1 X250 F3000')
+        new_tip(E1_yellow_tips)
+        emit('G1 V150 F500')
+    report = validate(program)
+    assert checks(report) == ['envelope', 'tip_overfill']
+    assert report['errors'][0]['message'].startswith('-X250.0 is outside the reach')
+
+
+def test_running_out_of_tips():
+    tips = TipManager(slots=[E1_yellow_tips], swap=False)
+    tips.bitmap(E1_yellow_tips)[:] = False
+
+    def program():
+        G28()
+        new_tip(E1_yellow_tips)
+    report = validate(program, tips=tips)
+    assert checks(report) == ['tips']
+    assert report['errors'][0]['action'] == 'new_tip'
+
+
+@pytest.mark.parametrize('swap', [True, False])
+def test_rack_swaps_are_counted(swap):
+    tips = TipManager(slots=[E1_yellow_tips], swap=swap)
+    tips.bitmap(E1_yellow_tips)[:-1] = False
+
+    def program():
+        G28()
+        for _ in range(2):
+            new_tip(E1_yellow_tips)
+            eject()
+    report = validate(program, tips=tips)
+    assert report['rack_swaps'] == (1 if swap else 0)
+    assert checks(report) == ([] if swap else ['tips'])
+    assert tips.left(E1_yellow_tips) == 1  # The manager passed in is left alone
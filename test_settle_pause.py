@@ -0,0 +1,69 @@
+import pytest
+
+from gcode_generator_v1_2 import (E1_yellow_tips, ProtocolContext, SETTLE_MAX, aspirate_volume, dispense_volume,
+                                  eject, emit, mix, new_tip, pipette_mix, plate_384_biorad, preload_volume,
+                                  settle_pause, settle_time, tube2)
+
+# The pauses the program below got before the settle model
+FORMER_PAUSES = ['G4 P500', 'G4 P500', 'G4 P100'] + ['G4 P1000'] * 6 + ['G4 P500'] * 4
+
+
+def program(**settle):
+    preload_volume(tube2, '1', 500, 'buffer')
+    new_tip(E1_yellow_tips)
+    aspirate_volume(50, custom_name='buffer', air_gap=True, **settle)
+    dispense_volume(50, dispense_modules=[plate_384_biorad], well_locations='B2')
+    mix(3, 40, custom_name='buffer', **settle)
+    pipette_mix(2, lower_limit=60, upper_limit=100, mix_feedrate=2500, **settle)
+    eject()
+
+
+def pauses(lines):
+    return [line for line in lines if line.startswith('G4')]
+
+
+def test_settle_time_is_shorter_for_small_and_slow_moves():
+    assert settle_time(95, 2500) == 0.34
+    assert settle_time(100, 500) == 0.18
+    assert settle_time(50, 100) < settle_time(50, 500) < settle_time(50, 2500)
+    assert settle_time(10, 2500) < settle_time(95, 2500)
+    assert settle_time(-95, 2500) == settle_time(95, 2500)
+    assert settle_time(1000, 2500) == SETTLE_MAX
+
+
+def test_back_to_back_pauses_are_merged(ctx):
+    settle_pause(10, 500)
+    settle_pause(95, 2500)
+    settle_pause(10, 500)  # The longer pause wins
+    assert ctx.emitter.lines == ['G4 P340']
+    emit('G1 V0 F2500')
+    settle_pause(10, 500)
+    emit('G4 P5000')  # Not a settle pause, left alone
+    settle_pause(10, 500)
+    assert ctx.emitter.lines == ['G4 P340', 'G1 V0 F2500', 'G4 P60', 'G4 P5000', 'G4 P60']
+
+
+def test_settle_overrides(ctx):
+    settle_pause(95, 2500, settle=0)
+    assert ctx.emitter.lines == []
+    settle_pause(10, 500, settle=1.5)
+    assert ctx.emitter.lines == ['G4 P1500']
+
+
+@pytest.mark.parametrize('settle, expected', [(0, []), (0.25, ['G4 P250'] * 11)])
+def test_actions_take_the_settle_override(settle, expected):
+    with ProtocolContext() as ctx:
+        program(settle=settle)
+    assert pauses(ctx.emitter.lines) == expected
+
+
+def test_fixed_model_keeps_the_former_pauses():
+    with ProtocolContext(dwell_model='fixed') as fixed:
+        program()
+    with ProtocolContext() as settled:
+        program()
+    assert pauses(fixed.emitter.lines) == FORMER_PAUSES
+    assert pauses(settled.emitter.lines) == ['G4 P120'] + ['G4 P170'] * 10
+    # Only the pauses differ
+    assert [line for line in fixed.emitter.lines if not line.startswith('G4')] == \
+        [line for line in settled.emitter.lines if not line.startswith('G4')]
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import step_cache
+from compile_protocols import HERE, load_protocol
+from gcode_generator_v1_2 import preload_volume, tube2
+from step_cache import StepCache, capture_state, restore_state
+
+PROTOCOL = os.path.join(HERE, 'magnetic_extraction_w_heater.py')
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = StepCache(directory=None)
+    monkeypatch.setattr(step_cache, 'default_cache', cache)
+    return cache
+
+
+def test_cache_hit_matches_fresh_generation(cache, generate):
+    module = load_protocol(PROTOCOL)
+    cache.enabled = False
+    fresh = generate(module).emitter.lines
+    cache.enabled = True
+    cold = generate(module).emitter.lines
+    cache.reset_stats()
+    warm = generate(module).emitter.lines
+    assert cache.hits and not cache.misses
+    assert cold == fresh
+    assert warm == fresh
+
+
+def test_edit_before_cached_step_is_not_reverted(cache, generate):
+    module = load_protocol(PROTOCOL)
+    generate(module)  # Fill the cache with an 8 minute lysis incubation
+    module.LYSIS_INCUBATION = (10 * 60, None)
+    warm = generate(module).emitter.lines
+    cache.enabled = False
+    fresh = generate(module).emitter.lines
+    assert 'G4 P600000' in fresh
+    assert warm == fresh
+
+
+def test_restore_state_round_trip(ctx):
+    preload_volume(tube2, '1', 100, 'buffer')
+    state = capture_state(ctx)
+    preload_volume(tube2, '1', 20, 'buffer')
+    ctx.aspirated_volume = 50
+    restore_state(ctx, state)
+    assert ctx.labware(tube2).Vf[0] == 100
+    assert ctx.preloads['buffer']['volume'] == 100
+    assert ctx.aspirated_volume == 0
+    assert step_cache.fingerprint(capture_state(ctx)) == step_cache.fingerprint(state)
@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from batch_protocol import expand, generate_batch
+from compile_protocols import HERE, load_protocol
+from gcode_generator_v1_2 import ProtocolContext, emit
+from gcode_time_estimator import estimate_runtime
+from step_scheduler import Step, schedule
+
+PROTOCOL = os.path.join(HERE, 'magnetic_extraction_w_heater.py')
+
+
+def work(name, seconds):
+    # A step that keeps the machine busy for a known time
+    return Step(name, lambda: emit(f'G4 P{seconds * 1000}'))
+
+
+def run(steps):
+    with ProtocolContext() as ctx:
+        timeline = schedule(steps)
+    return ctx, [(entry['step'], entry['start'], entry['end'], entry['idle']) for entry in timeline]
+
+
+def test_wait_is_filled_with_ready_steps():
+    a, c, d = work('a', 10), work('c', 20), work('d', 20)
+    b = Step('b', lambda: emit('G4 P5000'), after={a: (60, None)})
+    ctx, timeline = run([a, b, c, d])
+    assert timeline == [('a', 0, 10, 0), ('c', 10, 30, 0), ('d', 30, 50, 0), ('b', 70, 75, 20)]
+    assert ctx.emitter.lines == ['G4 P10000', 'G4 P20000', 'G4 P20000', 'G4 P20000', 'G4 P5000']
+
+
+def test_earliest_deadline_first():
+    a, c = work('a', 10), work('c', 20)
+    b = Step('b', lambda: emit('G4 P5000'), after={a: (0, 15)})
+    _, timeline = run([a, c, b])
+    assert [entry[0] for entry in timeline] == ['a', 'b', 'c']
+
+
+def test_window_that_cannot_be_met():
+    a = work('a', 10)
+    b = Step('b', lambda: emit('G4 P10000'), after={a: (0, 5)})
+    c = Step('c', lambda: emit('G4 P10000'), after={a: (0, 5)})
+    with pytest.raises(ValueError, match='cannot start within 5 s of the end of a'):
+        run([a, b, c])
+
+
+def test_invalid_dependencies():
+    a = work('a', 1)
+    b = Step('b', lambda: None, after=[a])
+    a.after = {b: (0, None)}
+    with pytest.raises(ValueError, match='Circular'):
+        run([a, b])
+    with pytest.raises(ValueError, match='not scheduled'):
+        run([Step('c', lambda: None, after=[work('d', 1)])])
+    with pytest.raises(ValueError, match='ends before it starts'):
+        e = work('e', 1)
+        run([e, Step('f', lambda: None, after={e: (10, 5)})])
+
+
+def test_batch_lysis_incubations_overlap():
+    module = load_protocol(PROTOCOL)
+    ctx, _ = generate_batch(PROTOCOL, ['S1', 'S2'])
+    with ProtocolContext() as sequential:
+        expand(module.process_sample, module.SAMPLE_LAYOUT, ['S1', 'S2'])
+    assert estimate_runtime(ctx.emitter.lines)['total'] < estimate_runtime(sequential.emitter.lines)['total']
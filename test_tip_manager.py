@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+from compile_protocols import HERE
+from gcode_generator_v1_2 import E1_yellow_tips, ProtocolContext, TipManager, TipRack, eject, new_tip
+from protocol_chain import chain
+
+SPARE = TipRack(name='Spare tips', locs=[[20, 10], [29, 10]], top=65, rim=10, bottom=3.0, spacing=9, next=1,
+                working_volume=110)
+
+
+def test_pool_takes_the_asked_rack_first():
+    tips = TipManager(slots=[E1_yellow_tips, SPARE])
+    assert tips.take(SPARE) == (SPARE, 0)
+    assert tips.take(SPARE) == (SPARE, 1)
+    assert tips.take(SPARE) == (E1_yellow_tips, 0)  # Then the other slots
+    assert tips.take(E1_yellow_tips) == (E1_yellow_tips, 1)
+    assert tips.taken == {SPARE.name: 2, E1_yellow_tips.name: 2}
+    assert tips.left(SPARE) == len(E1_yellow_tips.locs) - 2
+
+
+def test_rack_outside_the_slots_is_its_own_pool():
+    tips = TipManager(slots=[E1_yellow_tips])
+    assert tips.pool(SPARE) == [SPARE]
+    assert tips.left(SPARE) == 2
+
+
+def test_empty_pool_prompts_for_full_racks():
+    tips = TipManager(slots=[SPARE])
+    with ProtocolContext(tips=tips) as ctx:
+        for _ in range(3):
+            new_tip(SPARE)
+            eject()
+    prompts = [line for line in ctx.emitter.lines if line.startswith('M0')]
+    assert prompts == ['M0 Replace the empty tip racks (Spare tips) with full ones! Press button to continue']
+    assert tips.swaps == 1 and tips.taken == {SPARE.name: 3}
+    assert tips.left(SPARE) == 1
+
+
+def test_empty_pool_without_swapping():
+    tips = TipManager(slots=[SPARE], swap=False)
+    with ProtocolContext(tips=tips) as ctx:
+        new_tip(SPARE)
+        new_tip(SPARE)
+        with pytest.raises(ValueError, match='No tips left in Spare tips'):
+            new_tip(SPARE)
+    assert [problem[0] for problem in ctx.problems] == ['tips']
+
+
+def test_save_and_load(tmp_path):
+    tips = TipManager(slots=[E1_yellow_tips, SPARE])
+    for _ in range(5):
+        tips.take(E1_yellow_tips)
+    tips.take(SPARE)
+    path = tmp_path / 'tips.json'
+    tips.save(str(path))
+
+    loaded = TipManager(slots=[E1_yellow_tips, SPARE])
+    loaded.load(str(path))
+    assert loaded.take(E1_yellow_tips) == (E1_yellow_tips, 5)
+    assert loaded.left(SPARE) == tips.left(SPARE) - 1
+
+
+def test_copy_is_independent():
+    tips = TipManager(slots=[SPARE])
+    tips.take(SPARE)
+    clone = tips.copy()
+    clone.take(SPARE)
+    assert tips.left(SPARE) == 1 and clone.left(SPARE) == 0
+    assert clone.last is SPARE
+
+
+def test_chained_protocols_share_the_racks():
+    path = os.path.join(HERE, 'pUC19_amplification.py')
+    tips = TipManager()
+    job, parts = chain([path, path], tips)
+    assert parts[0]['tips'] == parts[1]['tips'] > 0
+    assert tips.taken == {E1_yellow_tips.name: 2 * parts[0]['tips']}
+    assert tips.left(E1_yellow_tips) == len(E1_yellow_tips.locs) - 2 * parts[0]['tips']
+    assert job.lines.count('M0 Load the deck for pUC19_amplification! Press button to continue') == 1
+    assert len(job.lines) == parts[0]['lines'] + parts[1]['lines'] + 1
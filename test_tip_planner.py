@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+
+from gcode_generator_v1_2 import (E1_yellow_tips, aspirate_volume, current_context, dispense_volume, eject, new_tip,
+                                  plate_384_biorad, preload_volume, tube2, tube3_rimless)
+from tip_planner import MaxTransfersPerTip, NewTipOnSourceChange, plan_tips
+
+
+def premixed_plate(wells):
+    # Stocks 'a' and 'b' and a premix dispensed into the given plate wells
+    preload_volume(tube3_rimless, '1', 100, 'a')
+    preload_volume(tube3_rimless, '2', 100, 'b')
+    preload_volume(tube2, '1', 300, 'premix')
+    new_tip(E1_yellow_tips)
+    for well in wells:
+        aspirate_volume(15, custom_name='premix')
+        dispense_volume(15, dispense_modules=[plate_384_biorad], well_locations=well)
+    eject()
+
+
+def test_contents_follow_dispenses(ctx):
+    premixed_plate(['B2'])
+    assert ctx.contents[(plate_384_biorad.name, 'B2')] == {'premix'}
+    assert ctx.contents[(tube3_rimless.name, '1')] == {'a'}
+    assert not ctx.contents.get((plate_384_biorad.name, 'B4'))
+
+
+def test_reused_tip_never_returns_to_stock(ctx):
+    transfers = [('a', 'B2', 5), ('a', 'B4', 5), ('a', 'B6', 5), ('a', 'B8', 5), ('b', 'B4', 5), ('b', 'B10', 5)]
+    premixed_plate(['B2', 'B4'])
+    # One aspiration holds all the transfers of a source
+    plan = plan_tips(transfers, rules=[NewTipOnSourceChange()], destination_module=plate_384_biorad)
+    assert plan == [transfers[:4], transfers[4:]]
+    # It holds a single transfer: wells holding premix end a tip, the empty wells B6 and B8 share one
+    plan = plan_tips(transfers, rules=[NewTipOnSourceChange()], destination_module=plate_384_biorad,
+                     working_volume=20)
+    assert plan == [[('a', 'B2', 5)], [('a', 'B4', 5)], [('a', 'B6', 5), ('a', 'B8', 5)],
+                    [('b', 'B4', 5)], [('b', 'B10', 5)]]
+
+
+def test_empty_destinations_share_a_tip(ctx):
+    transfers = [('a', well, 5) for well in ('B2', 'B4', 'B6', 'B8', 'B10')]
+    preload_volume(tube3_rimless, '1', 100, 'a')
+    assert plan_tips(transfers, destination_module=plate_384_biorad) == [transfers]
+    assert plan_tips(transfers, rules=[MaxTransfersPerTip(2)], destination_module=plate_384_biorad) == \
+        [transfers[:2], transfers[2:4], transfers[4:]]
+
+
+class StockVisits:
+    """Profiler recording what the tip holds whenever it aspirates in the template step."""
+
+    def __init__(self):
+        self.visits = []
+
+    def sync(self):
+        pass
+
+    @contextmanager
+    def action(self, name):
+        ctx = current_context()
+        if name == 'aspirate_volume' and ctx.step.startswith('Step 3'):
+            self.visits.append(set(ctx.tip_contents))
+        yield
+
+
+def test_ywhaz_templates_use_one_tip_per_template(generate):
+    recorder = StockVisits()
+    ctx = generate('YWHAZ_qPCR_protocol', profiler=recorder)
+    assert '-Used 7 tips and 7 aspirations for 21 transfers' in ctx.emitter.messages
+    assert recorder.visits == [set()] * 7  # Every template is aspirated with a fresh tip
@@ -0,0 +1,57 @@
+import pytest
+
+from gcode_generator_v1_2 import (E1_yellow_tips, eject, new_tip, plan_transfers, plate_384_biorad,
+                                  preload_volume, run_transfers, tube2, tube3_rimless, well_index)
+
+WELLS = ['B2', 'B4', 'B6', 'B8', 'B10', 'B12', 'B14', 'B16', 'B18', 'B20', 'B22',
+         'C2', 'C4', 'C6', 'C8', 'C10', 'C12', 'C14', 'C16', 'C18', 'C20']
+
+
+@pytest.fixture
+def ctx(ctx):
+    preload_volume(tube2, '1', 1000, 'Premix')
+    preload_volume(tube3_rimless, '8', 180, 'PT2X')
+    return ctx
+
+
+def test_aliquots_fill_the_tip(ctx):
+    transfers = [('Premix', well, 15) for well in WELLS]
+    plan = plan_transfers(transfers, destination_module=plate_384_biorad, excess_vol=10, deadpump=False)
+    # 110 μL working volume less the 10 μL excess leaves room for six 15 μL dispenses
+    assert [len(batch['dispenses']) for batch in plan] == [6, 6, 6, 3]
+    assert [batch['volume'] for batch in plan] == [100, 100, 100, 55]
+    assert [dispense[1] for batch in plan for dispense in batch['dispenses']] == WELLS
+
+
+def test_large_transfer_is_split_equally(ctx):
+    plan = plan_transfers([('PT2X', 'Premix', 297)], deadpump_vol=5)
+    assert [batch['volume'] for batch in plan] == [99, 99, 99]
+    assert all(dispense[3] == 'Premix' for batch in plan for dispense in batch['dispenses'])
+
+
+def test_batches_fit_the_working_volume(ctx):
+    volumes = [37, 5, 60, 12.5, 80, 3, 44, 19]
+    transfers = [('Premix', well, volume) for well, volume in zip(WELLS, volumes)]
+    plan = plan_transfers(transfers, destination_module=plate_384_biorad, air_gap=True)
+    capacity = E1_yellow_tips.working_volume - 15 - 5
+    assert all(batch['volume'] <= capacity for batch in plan)
+    assert sum(batch['volume'] for batch in plan) == pytest.approx(sum(volumes))
+    # First-fit decreasing into 90 μL: 80+5+3, 60+19, 44+37, then 12.5 fits nowhere
+    assert sorted(batch['volume'] for batch in plan) == [12.5, 79, 81, 88]
+
+
+def test_invalid_plans(ctx):
+    with pytest.raises(ValueError, match='Unknown transfer source'):
+        plan_transfers([('NFW', 'B2', 5)], destination_module=plate_384_biorad)
+    with pytest.raises(ValueError, match='leaves no room'):
+        plan_transfers([('Premix', 'B2', 5)], working_volume=15, destination_module=plate_384_biorad)
+
+
+def test_run_transfers_dispenses_every_volume(ctx):
+    transfers = [('Premix', (plate_384_biorad, well), 15) for well in WELLS]
+    new_tip(E1_yellow_tips)
+    run_transfers(transfers, excess_vol=10, deadpump=False)
+    eject()
+    plate = ctx.labware(plate_384_biorad)
+    assert [plate.Vf[well_index(plate, well)] for well in WELLS] == [15] * len(WELLS)
+    assert ctx.preloads['Premix']['volume'] == pytest.approx(1000 - 4 * 10 - 15 * len(WELLS))
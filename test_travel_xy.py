@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+import gcode_generator_v1_2
+from gcode_generator_v1_2 import G1, Deck, path_is_clear, travel_xy
+
+# A 20 x 20 mm box, 80 mm tall, centred on X50 Y50
+BOX = Deck(labware=[], stations=[{'X': 50, 'Y': 50, 'top': 80, 'width': 20, 'depth': 20}]).obstacles(0)
+
+
+@pytest.fixture
+def boxed_deck(ctx, monkeypatch):
+    monkeypatch.setattr(gcode_generator_v1_2, 'deck_obstacles', BOX)
+    return ctx
+
+
+def travel(ctx, z):
+    G1(x=0, y=0, z=z, feedrate=3000)
+    start = len(ctx.emitter.lines)
+    travel_xy(100, 100)
+    return [line.split(' F')[0] for line in ctx.emitter.lines[start:] if line.startswith('G1')]
+
+
+def test_clear_path_is_a_single_diagonal(boxed_deck):
+    assert travel(boxed_deck, 90) == ['G1 X100 Y100']
+
+
+def test_blocked_path_falls_back_to_x_then_y(boxed_deck):
+    assert travel(boxed_deck, 50) == ['G1 X100', 'G1 Y100']
+
+
+def test_real_deck_at_safe_height(ctx):
+    # Above every labware but the ejector, which the diagonal passes by
+    G1(x=10, y=10, z=70, feedrate=3000)
+    assert path_is_clear(10, 10, 110, 240, 70)
+    assert not path_is_clear(10, 10, 110, 240, 50)  # Through the tip rack
+    start = len(ctx.emitter.lines)
+    travel_xy(110, 240)
+    assert [line.split(' F')[0] for line in ctx.emitter.lines[start:] if line.startswith('G1')] == ['G1 X110 Y240']
+
+
+@pytest.mark.parametrize('segment, clear', [
+    ((0, 50, 100, 50), False),  # Straight through
+    ((0, 0, 100, 5), True),  # Passes below the box
+    ((0, 60, 100, 60), False),  # Along the edge
+    ((0, 80, 80, 0), False),  # Touches the corner X40 Y40
+    ((0, 79, 79, 0), True),  # Misses the corner
+    ((50, 0, 50, 39.9), True),  # Stops short of the box
+    ((50, 0, 50, 40), False),  # Ends on the edge
+    ((60.1, 0, 60.1, 100), True),  # Beside the box, parallel to Y
+    ((60, 0, 60, 100), False),  # On the edge, parallel to Y
+    ((50, 50, 50, 50), False),  # Zero-length move inside the box
+    ((30, 30, 30, 30), True),  # Zero-length move outside the box
+])
+def test_segment_against_a_box(segment, clear):
+    assert path_is_clear(*segment, z=50, obstacles=BOX) is clear
+    assert path_is_clear(*segment, z=80, obstacles=BOX)  # Level with the top: not blocking
+    assert path_is_clear(*segment[2:], *segment[:2], z=50, obstacles=BOX) is clear  # Either direction
+
+
+def test_no_obstacles():
+    assert path_is_clear(0, 0, 100, 100, 0, obstacles=np.empty((0, 5)))
@@ -0,0 +1,54 @@
+import random
+
+import numpy as np
+import pytest
+
+from gcode_generator_v1_2 import (E1_yellow_tips, ProtocolContext, aspirate_volume, dispense_volume, new_tip,
+                                  path_travel_time, plate_384_biorad, preload_volume, serpentine_order,
+                                  shortest_order, travel_time_matrix, tube2)
+from gcode_time_estimator import MachineTimeEstimator, estimate_runtime
+
+# 24 wells of a 384-well plate in shuffled order, as a sample sheet might list them
+WELLS = [f'{row}{col}' for row in 'BDFH' for col in range(2, 24, 4)]
+random.Random(3).shuffle(WELLS)
+
+
+@pytest.mark.parametrize('feedrate, accel', [(3000, 1500), (3000, None), (60000, 3000)])
+def test_travel_time_follows_the_estimator(feedrate, accel):
+    points = np.array([[10, 20], [10.5, 20], [130, 20], [10, 200], [200, 150]])
+    cost = travel_time_matrix(points, feedrate, accel)
+    estimator = MachineTimeEstimator(accel=accel) if accel else MachineTimeEstimator()
+    for i, a in enumerate(points):
+        for j, b in enumerate(points):
+            expected = estimator.move_time({'X': b[0] - a[0], 'Y': b[1] - a[1]}, feedrate)
+            assert cost[i, j] == pytest.approx(expected)
+
+
+def test_orders_start_at_the_first_point():
+    points = np.array([[0, 0], [9, 0], [0, 4.5], [9, 4.5], [4.5, 0]])
+    assert serpentine_order(points) == [0, 4, 1, 3, 2]
+    path = shortest_order(points, start=2)
+    assert path[0] == 2 and sorted(path) == list(range(len(points)))
+    assert path_travel_time(points, path) <= path_travel_time(points, [2, 0, 1, 3, 4])
+
+
+def aliquot(order):
+    with ProtocolContext() as ctx:
+        preload_volume(tube2, '1', 500, 'Premix')
+        new_tip(E1_yellow_tips)
+        aspirate_volume(3 * len(WELLS), custom_name='Premix')
+        start = len(ctx.emitter.lines)
+        dispense_volume([3] * len(WELLS), dispense_modules=[plate_384_biorad] * len(WELLS), well_locations=WELLS,
+                        order=order)
+    return ctx, ctx.emitter.lines[start:]
+
+
+@pytest.mark.parametrize('order', ['serpentine', 'shortest'])
+def test_reordered_aliquot_keeps_the_volumes(order):
+    given, given_lines = aliquot('given')
+    ordered, ordered_lines = aliquot(order)
+    assert np.array_equal(ordered.labware(plate_384_biorad).Vf, given.labware(plate_384_biorad).Vf)
+    assert ordered.preloads['Premix']['volume'] == given.preloads['Premix']['volume']
+    assert ordered_lines[:3] == given_lines[:3]  # Still goes to the first well first
+    travel = estimate_runtime(ordered_lines)['breakdown']['travel']
+    assert travel < 0.6 * estimate_runtime(given_lines)['breakdown']['travel']
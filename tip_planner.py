@@ -0,0 +1,295 @@
+"""
+Tip-reuse planner for PALH protocols.
+
+Protocols usually wrap every transfer in new_tip()/eject(). Each tip cycle is a trip to the tip rack and over the
+ejector at Z100, so a protocol with many small transfers spends a large part of its runtime changing tips. The planner
+takes the list of transfers and a contamination policy, and groups the transfers into as few tips as the policy
+allows. Transfers into the same destination always keep their relative order.
+
+run_tip_plan() aspirates once for consecutive transfers of a tip from the same source, as many as fit in the tip, and
+dispenses them in turn (see run_transfers()). Only a new aspiration takes the tip back into the stock, and whatever the
+policy, a tip never goes back into a stock after touching a reagent the stock does not hold. The contents of the wells
+come from the context (preloads and the dispenses done so far) and are followed through the plan.
+
+The policy is a list of rules. A rule is called with the current tip, the next transfer and the known contents of the
+destination, and returns False if that transfer needs a fresh tip:
+    NewTipOnSourceChange()              - a tip only ever aspirates one reagent
+    NewTipAfterContact('1ug', ...)      - a tip that visited a well containing one of these is discarded
+    NeverTouch('PT2X', ...)             - a used tip never enters a well that already contains one of these
+    MaxTransfersPerTip(n)               - at most n transfers per tip
+
+Usage:
+    plan = plan_tips(transfers, rules=[NewTipOnSourceChange()], destination_module=plate_384_biorad, air_gap=True)
+    print(tip_savings(transfers, plan))
+    run_tip_plan(plan, E1_yellow_tips, destination_module=plate_384_biorad, air_gap=True, touch_tip=True, direct=True,
+                 blowout=True)
+"""
+from gcode_generator_v1_2 import (E1_yellow_tips, ProtocolContext, aspiration_capacity, current_context, eject,
+                                  eject_station, log, new_tip, resolve_destination, run_transfers)
+from gcode_time_estimator import MachineTimeEstimator
+
+
+class Tip:
+    """
+    What a tip in use has been exposed to.
+
+    :param source: Reagent the tip aspirates (None for a fresh tip)
+    :param transfers: Number of transfers done with the tip
+    :param exposed: Reagents the tip has held or found in the destinations it has entered
+    :param load: Volume in μL dispensed so far from the last aspiration
+    """
+    __slots__ = ('source', 'transfers', 'exposed', 'load')
+
+    def __init__(self):
+        self.source = None
+        self.transfers = 0
+        self.exposed = set()
+        self.load = 0
+
+    def aspirates(self, source, volume, capacity):
+        """Whether a transfer needs a new aspiration, rather than dispensing from the last one."""
+        return self.source != source or self.load + volume > capacity + 1e-9
+
+    def take(self, source, volume, capacity):
+        """Count a transfer done with the tip."""
+        self.load = (0 if self.aspirates(source, volume, capacity) else self.load) + volume
+        self.source = source
+        self.transfers += 1
+
+
+class NewTipOnSourceChange:
+    """Use a fresh tip whenever the source reagent changes."""
+
+    def __call__(self, tip, source, destination, contents):
+        return tip.source is None or tip.source == source
+
+    def __repr__(self):
+        return 'NewTipOnSourceChange()'
+
+
+class NewTipAfterContact:
+    """
+    Discard a tip once it has entered a destination that contained one of the given reagents.
+
+    :param reagents: Reagent names; if none are given, any reagent other than the tip's own source
+    """
+
+    def __init__(self, *reagents):
+        self.reagents = set(reagents)
+
+    def __call__(self, tip, source, destination, contents):
+        foreign = tip.exposed - {tip.source}
+        return not (foreign & self.reagents if self.reagents else foreign)
+
+    def __repr__(self):
+        return f"NewTipAfterContact({', '.join(map(repr, sorted(self.reagents)))})"
+
+
+class NeverTouch:
+    """
+    Never enter a destination that already contains one of the given reagents with a used tip.
+
+    :param reagents: Reagent names; if none are given, any reagent other than the transferred one
+    """
+
+    def __init__(self, *reagents):
+        self.reagents = set(reagents)
+
+    def __call__(self, tip, source, destination, contents):
+        if tip.source is None:
+            return True
+        present = contents - {source}
+        return not (present & self.reagents if self.reagents else present)
+
+    def __repr__(self):
+        return f"NeverTouch({', '.join(map(repr, sorted(self.reagents)))})"
+
+
+class MaxTransfersPerTip:
+    """
+    Limit the number of transfers done with one tip.
+
+    :param limit: Maximum number of transfers per tip
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __call__(self, tip, source, destination, contents):
+        return tip.transfers < self.limit
+
+    def __repr__(self):
+        return f'MaxTransfersPerTip({self.limit})'
+
+
+DEFAULT_RULES = (NewTipOnSourceChange(),)
+
+
+def _initial_contents(module, well_location):
+    # Reagents already in a well: the preloads and what the protocol has dispensed into it so far
+    return set(current_context().contents.get((module.name, str(well_location)), ()))
+
+
+def plan_tips(transfers, rules=DEFAULT_RULES, destination_module=None, contents=None, tips=E1_yellow_tips,
+              working_volume=None, excess_vol=0, deadpump=True, deadpump_vol=15, air_gap=False, air_gap_vol=5):
+    """
+    Group transfers into tips.
+
+    The transfers are taken greedily: the current tip keeps taking the earliest remaining transfer that every rule
+    allows, as long as no earlier remaining transfer goes to the same destination, and, if the transfer needs a new
+    aspiration, the tip holds nothing the source stock does not. When none is left, the tip is ejected and the
+    earliest remaining transfer starts a new tip. The aspiration options must be the ones given to run_tip_plan().
+
+    :param transfers: List of (source, destination, volume) tuples, see plan_transfers()
+    :param rules: Contamination policy, a list of rules (default is DEFAULT_RULES)
+    :param destination_module: Module used for destinations given as a plain well location
+    :param contents: Optional dictionary mapping (module name, well location) to the reagents already in the well,
+                     on top of what the context tells
+    :param tips: Tip rack in use, provides the working volume (default is E1_yellow_tips)
+    :param working_volume: Override of the tip working volume in μL
+    :param excess_vol: Extra volume aspirated on top of each aspiration and not dispensed (default is 0)
+    :param deadpump: Boolean to determine if deadpump is used (default is True)
+    :param deadpump_vol: Volume of the dead pump in μL (default is 15)
+    :param air_gap: Boolean to determine if an air gap is added after aspiration (default is False)
+    :param air_gap_vol: Volume of the air gap in μL (default is 5)
+    :return: List of tips, each a list of (source, destination, volume) tuples in pipetting order
+    """
+    capacity = aspiration_capacity(tips, working_volume, excess_vol, deadpump, deadpump_vol, air_gap, air_gap_vol)
+    known = {}
+    for key, reagents in (contents or {}).items():
+        known[(key[0], str(key[1]))] = set(reagents)
+
+    def contents_of(module, well_location):
+        key = (module.name, str(well_location))
+        if key not in known:
+            known[key] = _initial_contents(module, well_location)
+        return key
+
+    preloads = current_context().preloads
+    stocks = {}  # Source -> key of its stock well (None when the source is not a named preload)
+    remaining = []
+    for source, destination, volume in transfers:
+        module, well_location, _ = resolve_destination(destination, destination_module)
+        key = contents_of(module, well_location)
+        if source not in stocks:
+            preload = preloads.get(source)
+            stocks[source] = contents_of(preload['module'], preload['well_location']) if preload else None
+        remaining.append((key, (source, destination, volume)))
+
+    def stock_allows(tip, source, volume):
+        if not tip.aspirates(source, volume, capacity):
+            return True  # Dispensed from the last aspiration, the tip stays out of the stock
+        stock = known[stocks[source]] if stocks[source] is not None else set()
+        return not (tip.exposed - stock - {source})
+
+    plan = []
+    tip = None
+    while remaining:
+        chosen = None
+        if tip is not None:
+            blocked = set()
+            for n, (key, (source, destination, volume)) in enumerate(remaining):
+                if key not in blocked and stock_allows(tip, source, volume) and \
+                        all(rule(tip, source, destination, known[key]) for rule in rules):
+                    chosen = n
+                    break
+                blocked.add(key)
+        if chosen is None:
+            tip = Tip()
+            plan.append([])
+            chosen = 0
+        key, transfer = remaining.pop(chosen)
+        source, destination, volume = transfer
+        stock = known[stocks[source]] if stocks[source] is not None else set()
+        if volume > capacity + 1e-9 and known[key] - stock - {source}:
+            raise ValueError(f"-{volume} μL of {source} into {destination} takes more than one aspiration, and the tip "
+                             f"would carry {', '.join(sorted(known[key] - stock - {source}))} back into the stock.")
+        tip.take(source, volume, capacity)
+        tip.exposed |= stock | {source} | known[key]
+        known[key] |= stock | {source}
+        plan[-1].append(transfer)
+    return plan
+
+
+def tip_cycle_seconds(tips=E1_yellow_tips):
+    """
+    Estimated machine time of one new_tip()/eject() cycle, starting and ending at the ejector.
+
+    :param tips: The tip rack (default is E1_yellow_tips)
+    :return: Time in seconds
+    """
+    with ProtocolContext() as scratch:  # Leaves the tip pointer and position of the protocol alone
+        new_tip(tips)
+        eject()
+
+    estimator = MachineTimeEstimator()
+    estimator.feed(f"G1 X{eject_station['X']} Y{eject_station['approach_Y']} Z70 F3000")
+    start = estimator.clock
+    estimator.feed_lines(scratch.emitter.lines)
+    return estimator.clock - start
+
+
+def tip_savings(transfers, plan, tips=E1_yellow_tips):
+    """
+    Compare a tip plan with the one-tip-per-transfer baseline.
+
+    :param transfers: The planned transfers
+    :param plan: The tip plan returned by plan_tips()
+    :param tips: The tip rack (default is E1_yellow_tips)
+    :return: Dictionary with the tips used before and after, the tips saved and the estimated seconds saved
+    """
+    saved = len(transfers) - len(plan)
+    seconds_per_tip = tip_cycle_seconds(tips)
+    return {
+        'tips_before': len(transfers),
+        'tips_after': len(plan),
+        'tips_saved': saved,
+        'seconds_per_tip': seconds_per_tip,
+        'seconds_saved': saved * seconds_per_tip,
+    }
+
+
+def run_tip_plan(plan, tips=E1_yellow_tips, destination_module=None, working_volume=None, excess_vol=0,
+                 aspirate_feedrate=500, dispense_feedrate=500, deadpump=True, deadpump_vol=15, air_gap=False,
+                 air_gap_vol=5, direct=False, blowout=None, touch_tip=False, order='given'):
+    """
+    Pipette a tip plan: every tip is picked up with new_tip(), used for its transfers, then ejected. Consecutive
+    transfers from the same source share one aspiration, as plan_tips() counted them, and are dispensed with
+    run_transfers().
+
+    :param plan: The tip plan returned by plan_tips()
+    :param tips: The tip rack (default is E1_yellow_tips)
+    :param destination_module: Module used for destinations given as a plain well location
+    :param working_volume: Override of the tip working volume in μL
+    :param excess_vol: Extra volume aspirated on top of each aspiration and not dispensed (default is 0)
+    :param aspirate_feedrate: Velocity of aspiration (default is 500)
+    :param dispense_feedrate: Velocity of dispense (default is 500)
+    :param deadpump: Boolean to determine if deadpump is used (default is True)
+    :param deadpump_vol: Volume of the dead pump in μL (default is 15)
+    :param air_gap: Boolean to determine if an air gap is added after aspiration (default is False)
+    :param air_gap_vol: Volume of the air gap in μL (default is 5)
+    :param direct: Boolean to move directly to the first destination of each aspiration (default is False)
+    :param blowout: Blow out after dispensing, see run_transfers()
+    :param touch_tip: Touch tip after dispensing, see run_transfers()
+    :param order: Order of visiting the destinations of an aspiration, see run_transfers()
+    """
+    aspiration = dict(tips=tips, working_volume=working_volume, excess_vol=excess_vol, deadpump=deadpump,
+                      deadpump_vol=deadpump_vol, air_gap=air_gap, air_gap_vol=air_gap_vol)
+    capacity = aspiration_capacity(**aspiration)
+    aspirations = 0
+    for group in plan:
+        new_tip(tips)
+        tip = Tip()
+        batches = []
+        for source, destination, volume in group:
+            if tip.aspirates(source, volume, capacity):
+                batches.append([])
+            tip.take(source, volume, capacity)
+            batches[-1].append((source, destination, volume))
+        for batch in batches:
+            aspirations += len(run_transfers(batch, destination_module=destination_module,
+                                             aspirate_feedrate=aspirate_feedrate, dispense_feedrate=dispense_feedrate,
+                                             direct=direct, blowout=blowout, touch_tip=touch_tip, order=order,
+                                             **aspiration))
+        eject()
+    log(f'-Used {len(plan)} tips and {aspirations} aspirations for {sum(len(group) for group in plan)} transfers')